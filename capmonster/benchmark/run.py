@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+from pymongo import monitoring
+
+# Repo root for capmonster.*, and /local/ for server.py's flat imports
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "local"))
+
+from capmonster.benchmark.stub import CapMonsterStub
+
+"""
+    End-to-end throughput benchmark: N synthetic clients -> MongoDB -> server.py -> CapMonster stub
+
+    Runs server.py's run_indefinitely() in-process against a local CapMonsterStub and a local mongod (--mdb-uri,
+    default MDB_URI) or an in-memory Motor stand-in (--mongo memory, needs mongomock-motor, no change streams).
+    Clients submit jobs back to back and poll their status. Reports jobs/sec, submit-to-solution latency
+    percentiles and MongoDB commands per job issued by server.py.
+
+        python -m capmonster.benchmark.run --clients 20 --duration 60 --workers 10 --solve-time lognormal:8,0.4 \\
+            --errors ERROR_RECAPTCHA_TIMEOUT=0.05,ERROR_PROXY_BANNED=0.02,ERROR_NO_SLOT_AVAILABLE=0.01
+
+    Uses its own collections (benchmark_jobs, benchmark_keys, benchmark_intake), dropped at the start of each run.
+"""
+
+FINISHED = {"solved", "failed", "expired", "dead"}
+BENCHMARK_GOOGLEKEY = "6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-"
+BENCHMARK_PAGEURL = "https://www.google.com/recaptcha/api2/demo"
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts MongoDB commands sent by one client, by command name
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+
+    def started(self, event):
+        self.counts[event.command_name] = self.counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+def configure_env(args: argparse.Namespace, stub: CapMonsterStub):
+    """
+    server.py and its modules read settings at import time, so they are set before the first import
+    """
+    os.environ.update({
+        "MDB_COLLECTION": args.collection,
+        "MDB_COLLECTION_KEYS": f"{args.collection}_keys",
+        "MDB_COLLECTION_INTAKE": f"{args.collection}_intake",
+        "CAPMONSTER_ENDPOINTS": stub.address,
+        "SERVER_WORKERS": str(args.workers),
+        "CLIENT_INIT_SLEEP": str(args.init_sleep),
+        "CLIENT_RETRY_SLEEP": str(args.retry_sleep),
+        "HIT_DB_DELAY": str(args.retry_sleep),
+        "INTAKE_MODE": args.intake,
+        "WARM_POOL_PAIRS": "",
+        "METRICS_PORT": "0",
+    })
+    if args.mdb_uri:
+        os.environ["MDB_URI"] = args.mdb_uri
+    for name, default in (("GARBAGE_TIMER", "60"), ("HTTPX_TIMEOUT", "120"), ("SOLVE_ATTEMPTS", "3"),
+                          ("ROOT_API_KEY", "benchmark")):
+        os.environ.setdefault(name, default)
+
+
+def percentile(latencies: List[float], pct: int) -> Optional[float]:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else None
+    return statistics.quantiles(latencies, n=100)[pct - 1]
+
+
+async def synthetic_client(collection, results: List[dict], deadline: float, poll: float, timeout: float):
+    """
+    Submits one job at a time until deadline, waiting for each to finish
+    """
+    from capmonster.fastapi.app.schema.recaptcha import ReCaptchaInCreate
+
+    while time.monotonic() < deadline:
+        job = ReCaptchaInCreate(api_key=os.environ["ROOT_API_KEY"], googlekey=BENCHMARK_GOOGLEKEY,
+                                pageurl=BENCHMARK_PAGEURL)
+        submitted = time.monotonic()
+        inserted = await collection.insert_one(job.dict())
+        status = "timeout"
+        while time.monotonic() - submitted < timeout:
+            await asyncio.sleep(poll)
+            document = await collection.find_one({"_id": inserted.inserted_id}, projection={"status": 1})
+            if document and document.get("status") in FINISHED:
+                status = document["status"]
+                break
+        results.append({"status": status, "latency": time.monotonic() - submitted, "finished": time.monotonic()})
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    stub = CapMonsterStub(port=args.stub_port, solve_time=args.solve_time, errors=args.errors, slots=args.stub_slots)
+    await stub.start()
+    configure_env(args, stub)
+
+    # Deferred until the environment is configured
+    import server
+    from connections import Connections
+    from mdb import MongoDB
+
+    counter = CommandCounter()
+    if args.mongo == "memory":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("--mongo memory needs the mongomock-motor package")
+        server_mongo = MongoDB()
+        server_mongo.client = AsyncMongoMockClient()
+        client_mongo = server_mongo
+    else:
+        # certifi CA bundle only for TLS deployments such as Atlas
+        tls = {} if args.tls else {"tlsCAFile": None}
+        # Only server.py's client is monitored, the synthetic clients use their own
+        server_mongo = MongoDB(event_listeners=[counter], **tls)
+        client_mongo = MongoDB(**tls)
+
+    collection = await client_mongo.get_collection()
+    if not args.keep:
+        database = collection.database
+        for name in (args.collection, f"{args.collection}_keys", f"{args.collection}_intake"):
+            await database.drop_collection(name)
+
+    server_task = asyncio.create_task(server.run_indefinitely(Connections(mongo=server_mongo)))
+    # Let ensure_indexes and the listener start before the clock runs
+    await asyncio.sleep(args.warmup)
+    commands_before = dict(counter.counts)
+
+    results: List[dict] = []
+    started = time.monotonic()
+    deadline = started + args.duration
+    clients = [asyncio.create_task(synthetic_client(collection, results, deadline, args.client_poll, args.job_timeout))
+               for _ in range(args.clients)]
+    await asyncio.gather(*clients)
+    elapsed = max(result["finished"] for result in results) - started if results else args.duration
+
+    server_task.cancel()
+    await asyncio.gather(server_task, return_exceptions=True)
+    await stub.close()
+    if client_mongo is not server_mongo:
+        client_mongo.client.close()
+
+    latencies = sorted(result["latency"] for result in results if result["status"] == "solved")
+    outcomes: Dict[str, int] = {}
+    for result in results:
+        outcomes[result["status"]] = outcomes.get(result["status"], 0) + 1
+    commands = {name: count - commands_before.get(name, 0) for name, count in counter.counts.items()}
+    commands = {name: count for name, count in commands.items() if count}
+    return {
+        "clients": args.clients,
+        "workers": args.workers,
+        "duration": round(elapsed, 2),
+        "jobs": len(results),
+        "outcomes": outcomes,
+        "jobs_per_sec": round(len(results) / elapsed, 3) if elapsed else None,
+        "solved_per_sec": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "mongo_ops_per_job": round(sum(commands.values()) / len(results), 2)
+        if results and args.mongo != "memory" else None,
+        "mongo_ops": commands if args.mongo != "memory" else None,
+        "stub_requests": stub.requests,
+        "stub_answers": stub.answers,
+    }
+
+
+def print_report(report: dict):
+    def seconds(value: Optional[float]) -> str:
+        return f"{value:.2f}s" if value is not None else "n/a"
+
+    print(f"{report['clients']} clients, {report['workers']} workers, {report['duration']}s")
+    print(f"  jobs:            {report['jobs']} {report['outcomes']}")
+    print(f"  jobs/sec:        {report['jobs_per_sec']} (solved {report['solved_per_sec']})")
+    print(f"  latency p50/p95/p99: {seconds(report['latency_p50'])} / {seconds(report['latency_p95'])} / "
+          f"{seconds(report['latency_p99'])}")
+    print(f"  mongo ops/job:   {report['mongo_ops_per_job'] if report['mongo_ops_per_job'] is not None else 'n/a'}")
+    if report["mongo_ops"]:
+        print(f"                   {report['mongo_ops']}")
+    print(f"  stub:            {report['stub_requests']} {report['stub_answers']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark for server.py")
+    parser.add_argument("--clients", type=int, default=10, help="Synthetic clients submitting jobs back to back")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds clients keep submitting")
+    parser.add_argument("--workers", type=int, default=10, help="SERVER_WORKERS for server.py")
+    parser.add_argument("--solve-time", default="lognormal:8,0.4",
+                        help="fixed:S, uniform:LO,HI, normal:MEAN,SD or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--errors", default="", help="CODE=PROBABILITY,... e.g. ERROR_RECAPTCHA_TIMEOUT=0.05")
+    parser.add_argument("--stub-slots", type=int, default=0, help="Stub capacity, 0 for unlimited")
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--mongo", choices=["mongod", "memory"], default="mongod")
+    parser.add_argument("--mdb-uri", default=None, help="Defaults to MDB_URI, e.g. mongodb://localhost:27017")
+    parser.add_argument("--tls", action="store_true", help="Connect with TLS (Atlas), off for a local mongod")
+    parser.add_argument("--collection", default="benchmark_jobs")
+    parser.add_argument("--keep", action="store_true", help="Do not drop the benchmark collections first")
+    parser.add_argument("--intake", choices=["auto", "stream", "poll"], default="auto")
+    parser.add_argument("--init-sleep", type=int, default=1, help="CLIENT_INIT_SLEEP for server.py")
+    parser.add_argument("--retry-sleep", type=int, default=1, help="CLIENT_RETRY_SLEEP and HIT_DB_DELAY")
+    parser.add_argument("--client-poll", type=float, default=0.25, help="Seconds between client status checks")
+    parser.add_argument("--job-timeout", type=float, default=300)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    # server.py modules log at INFO, only show warnings and errors during the run
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    logging.basicConfig(handlers=[handler])
+    report = asyncio.run(benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,124 @@
+import argparse
+import datetime
+import json
+import sys
+import time
+from datetime import timezone
+from pathlib import Path
+from typing import Callable, Dict, List
+import bson
+import orjson
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+# Repo root for capmonster.*
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from capmonster.fastapi.app.db.job_state import STATUS_FIELDS, infer_status, result_2captcha
+from capmonster.fastapi.app.schema.common import JobStatusEnum, utc_isoformat
+from capmonster.fastapi.app.schema.recaptcha import ReCaptchaResponse, ReCaptchaSolved
+
+"""
+    Per-request CPU of the /2captcha and /{job_id} status reads, model path vs projection path
+
+    No MongoDB needed: each request decodes the BSON a find_one would receive (the whole job document, or only the
+    projected fields) and builds the response from it, once the way get_recaptcha + pydantic + jsonable_encoder did
+    and once the way get_job + result_2captcha / job_response + orjson do.
+
+        python -m capmonster.benchmark.status_read --requests 20000
+"""
+
+RESPONSE_FIELDS = tuple(field.alias for field in ReCaptchaSolved.__fields__.values())
+
+
+def solved_job() -> dict:
+    """
+    A solved job as server.py leaves it, with the bookkeeping fields a status read does not need
+    """
+    now = datetime.datetime.now(timezone.utc).replace(microsecond=0)
+    return {"_id": ObjectId(), "key": "1abc234de56fab7c89012d34e56fa7b8", "method": "userrecaptcha",
+            "googlekey": "6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-",
+            "pageurl": "https://www.google.com/recaptcha/api2/demo", "proxy": "username:password@192.168.0.1:1500",
+            "proxytype": "HTTP", "status": JobStatusEnum.solved.value, "created_on": now, "claimed_on": now,
+            "submitted_on": now, "finished_on": now, "in_queue": False, "captcha_id": 123456789, "attempts": 2,
+            "errors": ["ERROR_RECAPTCHA_TIMEOUT"], "worker": "server-1", "solution": "03AGdBq2" + "x" * 500}
+
+
+def project(document: dict, fields) -> bytes:
+    return bson.encode({field: document[field] for field in fields if field in document})
+
+
+def model_2captcha(raw: bytes) -> str:
+    result = bson.decode(raw)
+    result["status"] = infer_status(result)
+    job = ReCaptchaSolved(**result) if "solution" in result else ReCaptchaResponse(**result)
+    if job.status == JobStatusEnum.solved:
+        return f"OK|{job.solution}"
+    return "CAPCHA_NOT_READY"
+
+
+def projection_2captcha(raw: bytes) -> str:
+    return result_2captcha(bson.decode(raw))[0]
+
+
+def model_job(raw: bytes) -> bytes:
+    result = bson.decode(raw)
+    result["status"] = infer_status(result)
+    job = ReCaptchaSolved(**result) if "solution" in result else ReCaptchaResponse(**result)
+    content = jsonable_encoder(job, by_alias=True, exclude_none=True, exclude_unset=True)
+    # starlette JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def projection_job(raw: bytes) -> bytes:
+    document = bson.decode(raw)
+    body = {}
+    for field in RESPONSE_FIELDS:
+        value = document.get(field)
+        if value is not None:
+            body[field] = utc_isoformat(value) if isinstance(value, datetime.datetime) else value
+    body["status"] = infer_status(document).value
+    return orjson.dumps(body)
+
+
+def cpu_per_request(read: Callable[[bytes], object], raw: bytes, requests: int) -> float:
+    """
+    Process CPU microseconds per request
+    """
+    started = time.process_time()
+    for _ in range(requests):
+        read(raw)
+    return (time.process_time() - started) / requests * 1e6
+
+
+def benchmark(args: argparse.Namespace) -> List[Dict]:
+    job = solved_job()
+    full = bson.encode(job)
+    cases = [
+        ("/2captcha", "model", model_2captcha, full),
+        ("/2captcha", "projection", projection_2captcha, project(job, STATUS_FIELDS + ("created_on",))),
+        ("/{job_id}", "model", model_job, full),
+        ("/{job_id}", "projection", projection_job, project(job, RESPONSE_FIELDS)),
+    ]
+    report = []
+    for endpoint, mode, read, raw in cases:
+        cpu_per_request(read, raw, args.warmup)
+        report.append({"endpoint": endpoint, "mode": mode, "requests": args.requests, "bson_bytes": len(raw),
+                       "cpu_us": round(cpu_per_request(read, raw, args.requests), 2)})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request CPU of status reads, model path vs projection path")
+    parser.add_argument("--requests", type=int, default=20000, help="Requests per endpoint and mode")
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'endpoint':<12}{'mode':<12}{'bson bytes':>12}{'cpu us':>10}")
+        for row in report:
+            print(f"{row['endpoint']:<12}{row['mode']:<12}{row['bson_bytes']:>12}{row['cpu_us']:>10}")
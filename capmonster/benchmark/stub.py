@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import logging
+import random
+import secrets
+import time
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+"""
+    Local 2Captcha-protocol stand-in for CapMonster
+
+    Serves in.php / res.php over plain HTTP/1.1 (keep-alive) on localhost. Every captcha "solves" after a delay drawn
+    from a configurable distribution and then answers OK|token or one of the configured error codes.
+    res.php understands action=get with id= or multi-id ids=, and action=getbalance (used by the endpoint probes).
+
+        python -m capmonster.benchmark.stub --port 8090 --solve-time lognormal:8,0.4 --errors ERROR_PROXY_BANNED=0.02
+"""
+
+# Errors answered by in.php instead of res.php
+UPLOAD_ERRORS = {"ERROR_NO_SLOT_AVAILABLE", "ERROR_ZERO_BALANCE", "ERROR_WRONG_USER_KEY"}
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def parse_distribution(spec: str) -> Callable[[], float]:
+    """
+    Parses a solve time distribution in seconds: fixed:S, uniform:LO,HI, normal:MEAN,SD or lognormal:MEDIAN,SIGMA
+    """
+    kind, _, raw = spec.partition(":")
+    args = [float(arg) for arg in raw.split(",") if arg]
+    if kind == "fixed":
+        return lambda: args[0]
+    if kind == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(args[0], args[1]))
+    if kind == "lognormal":
+        median, sigma = args
+        return lambda: median * random.lognormvariate(0, sigma)
+    raise ValueError(f"Unknown solve time distribution: {spec}")
+
+
+def parse_error_mix(spec: str) -> Dict[str, float]:
+    """
+    Parses CODE=PROBABILITY pairs, e.g. ERROR_RECAPTCHA_TIMEOUT=0.05,ERROR_NO_SLOT_AVAILABLE=0.01
+    """
+    mix = {}
+    for pair in filter(None, (pair.strip() for pair in spec.split(","))):
+        code, _, probability = pair.partition("=")
+        mix[code] = float(probability)
+    if sum(mix.values()) > 1:
+        raise ValueError("Error probabilities add up to more than 1")
+    return mix
+
+
+class CapMonsterStub:
+    """
+    In-process fake CapMonster. Start with await stub.start(), point CAPMONSTER_ENDPOINTS at stub.address
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, solve_time: str = "lognormal:8,0.4",
+                 errors: str = "", slots: int = 0):
+        self.host = host
+        self.port = port
+        self.sample_solve_time = parse_distribution(solve_time)
+        self.error_mix = parse_error_mix(errors)
+        # Max captchas solving at once, 0 for unlimited. Uploads beyond it get ERROR_NO_SLOT_AVAILABLE
+        self.slots = slots
+        self._ids = itertools.count(10000)
+        # captcha id -> (ready at, final answer)
+        self._captchas: Dict[str, Tuple[float, str]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.requests: Dict[str, int] = {"in.php": 0, "res.php": 0}
+        self.answers: Dict[str, int] = {}
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    @property
+    def solving(self) -> int:
+        now = time.monotonic()
+        return sum(1 for ready_at, _ in self._captchas.values() if ready_at > now)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"CapMonster stub listening on {self.address}")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _draw_outcome(self) -> Optional[str]:
+        roll = random.random()
+        for code, probability in self.error_mix.items():
+            if roll < probability:
+                return code
+            roll -= probability
+        return None
+
+    def upload(self) -> str:
+        error = self._draw_outcome()
+        if self.slots and self.solving >= self.slots:
+            error = "ERROR_NO_SLOT_AVAILABLE"
+        if error in UPLOAD_ERRORS:
+            self._count(error)
+            return error
+        cap_id = str(next(self._ids))
+        answer = error or f"OK|03AGdBq2{secrets.token_urlsafe(48)}"
+        self._captchas[cap_id] = (time.monotonic() + self.sample_solve_time(), answer)
+        return f"OK|{cap_id}"
+
+    def result(self, cap_id: str) -> str:
+        captcha = self._captchas.get(cap_id)
+        if not captcha:
+            return "ERROR_WRONG_CAPTCHA_ID"
+        ready_at, answer = captcha
+        if time.monotonic() < ready_at:
+            return "CAPCHA_NOT_READY"
+        del self._captchas[cap_id]
+        self._count(answer.split("|")[0])
+        return answer
+
+    def route(self, path: str, params: Dict[str, str]) -> str:
+        if path.endswith("in.php"):
+            self.requests["in.php"] += 1
+            return self.upload()
+        if path.endswith("res.php"):
+            self.requests["res.php"] += 1
+            if params.get("action") == "getbalance":
+                return "1000"
+            if "ids" in params:
+                # Multi-id answers carry the bare token, like 2Captcha
+                answers = [self.result(cap_id) for cap_id in params["ids"].split(",")]
+                return "|".join(answer[3:] if answer.startswith("OK|") else answer for answer in answers)
+            return self.result(params.get("id", ""))
+        return "ERROR"
+
+    def _count(self, outcome: str):
+        self.answers[outcome] = self.answers.get(outcome, 0) + 1
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get("content-length", 0)):
+                    await reader.readexactly(int(headers["content-length"]))
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                url = urlsplit(target)
+                params = {name: values[0] for name, values in parse_qs(url.query).items()}
+                body = self.route(url.path, params).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int, solve_time: str, errors: str, slots: int):
+    stub = CapMonsterStub(host, port, solve_time, errors, slots)
+    await stub.start()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info(f"requests={stub.requests} answers={stub.answers} solving={stub.solving}")
+    finally:
+        await stub.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Local 2Captcha-protocol CapMonster stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--solve-time", default="lognormal:8,0.4")
+    parser.add_argument("--errors", default="")
+    parser.add_argument("--slots", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.solve_time, args.errors, args.slots))
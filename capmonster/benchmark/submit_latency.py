@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.write_concern import WriteConcern
+
+# Repo root for capmonster.*
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from capmonster.fastapi.app.schema.recaptcha import ReCaptchaInCreate, ReCaptchaInDb
+
+"""
+    Per-submit MongoDB latency of create_recaptcha, with and without reading the job back after the insert
+
+    Runs the same insert sequentially with each write concern, once as insert + find_one (the old create_recaptcha)
+    and once as insert only (the current one), and reports p50/p95/p99 milliseconds per submit.
+
+        python -m capmonster.benchmark.submit_latency --mdb-uri "mongodb+srv://..." --submits 200 --w majority,1
+
+    Writes to its own collection (benchmark_submits), dropped at the end unless --keep.
+"""
+
+BENCHMARK_GOOGLEKEY = "6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-"
+BENCHMARK_PAGEURL = "https://www.google.com/recaptcha/api2/demo"
+
+
+def new_job() -> dict:
+    return ReCaptchaInCreate(api_key="benchmark", googlekey=BENCHMARK_GOOGLEKEY, pageurl=BENCHMARK_PAGEURL).dict()
+
+
+async def insert_and_read(collection) -> ReCaptchaInDb:
+    inserted = await collection.insert_one(new_job())
+    return ReCaptchaInDb(**await collection.find_one({"_id": inserted.inserted_id}))
+
+
+async def insert_only(collection) -> ReCaptchaInDb:
+    document = new_job()
+    await collection.insert_one(document)
+    return ReCaptchaInDb(**document)
+
+
+async def measure(collection, submit, submits: int) -> List[float]:
+    latencies = []
+    for _ in range(submits):
+        started = time.perf_counter()
+        await submit(collection)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {"p50": round(percentiles[49], 2), "p95": round(percentiles[94], 2), "p99": round(percentiles[98], 2),
+            "mean": round(statistics.mean(latencies), 2)}
+
+
+async def benchmark(args: argparse.Namespace) -> List[dict]:
+    client = AsyncIOMotorClient(args.mdb_uri)
+    base = client[args.database][args.collection]
+    # Connection pool and server selection warm-up
+    await base.database.command("ping")
+
+    report = []
+    try:
+        for w in args.w.split(","):
+            collection = base.with_options(write_concern=WriteConcern(w=int(w) if w.isdigit() else w))
+            for name, submit in (("insert+find_one", insert_and_read), ("insert", insert_only)):
+                await measure(collection, submit, args.warmup)
+                report.append({"w": w, "mode": name, "submits": args.submits,
+                               **summarize(await measure(collection, submit, args.submits))})
+    finally:
+        if not args.keep:
+            await base.drop()
+        client.close()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-submit MongoDB latency of create_recaptcha")
+    parser.add_argument("--mdb-uri", default=os.getenv("MDB_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--database", default=os.getenv("MDB_DATABASE", "capmonster"))
+    parser.add_argument("--collection", default="benchmark_submits")
+    parser.add_argument("--submits", type=int, default=200, help="Sequential submits per write concern and mode")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--w", default="majority,1", help="Comma separated write concerns to compare")
+    parser.add_argument("--keep", action="store_true", help="Do not drop the benchmark collection afterwards")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'w':<10}{'mode':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+        for row in report:
+            print(f"{row['w']:<10}{row['mode']:<18}{row['p50']:>10}{row['p95']:>10}{row['p99']:>10}{row['mean']:>10}")
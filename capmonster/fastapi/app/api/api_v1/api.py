@@ -1,9 +1,12 @@
 from fastapi import APIRouter, Depends
 from app.api.api_v1.endpoints.recaptcha import router as recaptcha_router
+from app.api.api_v1.endpoints.stream import router as stream_router
 from app.api.api_v1.endpoints.user import router as user_router
 
 
 router = APIRouter()
+# Ahead of recaptcha_router, whose GET /{job_id} would otherwise take /stream
+router.include_router(stream_router)
 router.include_router(recaptcha_router)
 router.include_router(user_router)
 
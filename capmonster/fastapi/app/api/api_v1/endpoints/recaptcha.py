@@ -1,18 +1,20 @@
+import logging
 from bson import ObjectId
-from fastapi import APIRouter, Depends, HTTPException, Query
-from typing import Any, Union, Optional
-from pydantic import ValidationError
-from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure
-from fastapi.responses import PlainTextResponse
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from typing import Any, Dict, List, Union, Optional
+from pydantic import ValidationError, conlist
+from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure, PyMongoError
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 
 from app.core.config import settings
-from app.core.utils import create_aliased_response
-from app.crud.api_key import get_api_key, subtract_credit
-from app.crud.recaptcha import get_one_recaptcha, get_all_recaptcha, create_recaptcha, get_recaptcha, purge_garbage
+from app.crud.api_key import get_api_key, consume_credit, consume_credits, refund_credit
+from app.crud.recaptcha import get_one_recaptcha, get_all_recaptcha, create_recaptcha, create_recaptchas, \
+    get_job, job_response, purge_garbage, wait_for_recaptcha
+from app.db.job_state import result_2captcha
 from app.db.mongodb import AsyncIOMotorClient, get_database
 from app.schema.common import PyObjectId
 from app.schema.recaptcha import ReCaptchaResponse, ReCaptchaInDb, ReCaptchaCreate, ReCaptchaSolved, \
-    ReCaptchaResponse2Captcha
+    ReCaptchaResponse2Captcha, ReCaptchaBatchItem, ReCaptchaBatchResponse
 
 """ 
 Error codes hard-coded from: https://2captcha.com/2captcha-api#error_handling
@@ -20,6 +22,8 @@ Error codes hard-coded from: https://2captcha.com/2captcha-api#error_handling
 
 router = APIRouter(tags=["recaptcha"],)
 
+logger = logging.getLogger(__name__)
+
 
 @router.get("/", response_model=str)
 async def database_status(
@@ -55,65 +59,94 @@ async def submit_recaptcha(recaptcha: ReCaptchaCreate,
     Create new ReCaptcha job.
     """
     validate_key = await get_api_key(db, apikey=recaptcha.api_key)
-    if validate_key:
-        if validate_key.credits < 1:
-            return PlainTextResponse("ERROR_ZERO_BALANCE", status_code=401)
-
     if not validate_key and recaptcha.api_key != settings.ROOT_API_KEY:
         raise HTTPException(
             status_code=401,
             detail=f"API Key not authorized",
         )
-    result = await create_recaptcha(db, recaptcha)
-    if result and validate_key:
-        subtracted = await subtract_credit(db, apikey=validate_key.key)
-    return result
+    # Checks and takes the credit in one write, concurrent submits cannot overdraw the key
+    if validate_key and not await consume_credit(db, validate_key.key):
+        return PlainTextResponse("ERROR_ZERO_BALANCE", status_code=401)
+    try:
+        return await create_recaptcha(db, recaptcha)
+    except Exception:
+        if validate_key:
+            await refund_credit(db, validate_key.key)
+        raise
+
+
+@router.post("/submit/batch", response_model=ReCaptchaBatchResponse, response_model_exclude_none=True)
+async def submit_recaptcha_batch(recaptchas: conlist(ReCaptchaCreate, min_items=1,
+                                                      max_items=settings.BATCH_SUBMIT_MAX) = Body(...),
+                                 db: AsyncIOMotorClient = Depends(get_database), ):
+    """
+    Create many ReCaptcha jobs at once. Takes a list of 1 to BATCH_SUBMIT_MAX /submit payloads, each with its own
+    key. An invalid payload rejects the whole batch (422), like it does on /submit.
+    Credits are taken once per key for all of its jobs, and the jobs are written with a single insert_many.
+    Returns the job ids in request order, with a 2Captcha error code instead for every job that was not created.
+    """
+    results = [ReCaptchaBatchItem() for _ in recaptchas]
+
+    # Jobs by API key, as (request index, job)
+    by_key: Dict[str, List[tuple]] = {}
+    for index, recaptcha in enumerate(recaptchas):
+        by_key.setdefault(recaptcha.api_key, []).append((index, recaptcha))
+
+    accepted = []
+    for key, jobs in by_key.items():
+        validate_key = await get_api_key(db, apikey=key)
+        if not validate_key and key != settings.ROOT_API_KEY:
+            for index, _ in jobs:
+                results[index].error = "ERROR_WRONG_USER_KEY"
+            continue
+        # One write per key. A short balance covers the first jobs, the rest get ERROR_ZERO_BALANCE
+        covered = await consume_credits(db, validate_key.key, len(jobs)) if validate_key else len(jobs)
+        for index, _ in jobs[covered:]:
+            results[index].error = "ERROR_ZERO_BALANCE"
+        accepted.extend((index, recaptcha, validate_key) for index, recaptcha in jobs[:covered])
+
+    refunds: Dict[str, int] = {}
+    try:
+        created, failed = await create_recaptchas(db, [recaptcha for _, recaptcha, _ in accepted])
+    except PyMongoError:
+        # Some jobs may have been written, so their credits are not refunded
+        logger.exception(f"Batch submit of {len(accepted)} jobs failed")
+        raise
+    for position, (index, _, validate_key) in enumerate(accepted):
+        if position in failed:
+            results[index].error = "ERROR_INTERNAL_SERVER_ERROR"
+            if validate_key:
+                refunds[validate_key.key] = refunds.get(validate_key.key, 0) + 1
+        else:
+            results[index].id = str(created[position].id)
+    for key, amount in refunds.items():
+        await refund_credit(db, key, amount)
+    return ReCaptchaBatchResponse(submitted=len(accepted) - len(failed), results=results)
 
 
 @router.get("/2captcha", response_class=PlainTextResponse)
 async def get_recaptcha_job_2captcha(key: str,
                                      job_id: PyObjectId = Query(..., alias="id"),
                                      action: str = "get",
+                                     wait: float = Query(0, ge=0),
                                      db: AsyncIOMotorClient = Depends(get_database), ):
     """
     Mimic 2Captcha API endpoint parameters to retrieve a ReCaptcha job by job_id.
+    wait (not part of the 2Captcha API) holds the request for up to that many seconds, capped at JOB_WAIT_MAX,
+    and answers as soon as the job is solved or has failed
     """
     if key != settings.ROOT_API_KEY:
         return PlainTextResponse("ERROR_WRONG_USER_KEY", status_code=401)
 
-    job = await get_recaptcha(db, ObjectId(job_id))
-    # The job_id does not exist in the database, return ERROR_WRONG_CAPTCHA_ID
-    if not job:
-        return PlainTextResponse("ERROR_WRONG_CAPTCHA_ID", status_code=404)
-
-    # The job is finished if the solution exists
-    s = getattr(job, "solution", None)
-    if s is not None:
-        return f"OK|{s}"
-
-    # If a job is in_queue without a solution, it is still processing
-    q = getattr(job, "in_queue", None)
-    if q:
-        return "CAPCHA_NOT_READY"
-
-    # If the job contains an error code/message, return it
-    err = getattr(job, "error", None)
-    if err is not None:
-        return PlainTextResponse(str(job.error), status_code=400)
-
-    # The job has a finished_on timestamp indicating finished, but no solution
-    f = getattr(job, "finished_on", None)
-    if f:
-        return PlainTextResponse("ERROR_CAPTCHA_UNSOLVABLE", status_code=408)
-
-    # The Local CapMonster script has not yet received the captcha job
-    c = getattr(job, "captcha_id", None)
-    if not c and not f:
-        # TODO: Check created_on delta
-        return PlainTextResponse("CAPCHA_NOT_READY", status_code=425)
-
-    # Unhandled error
-    return PlainTextResponse("ERROR_CAPTCHA_UNSOLVABLE", status_code=418)
+    wait = min(wait, settings.JOB_WAIT_MAX)
+    if wait:
+        job = await wait_for_recaptcha(db, ObjectId(job_id), wait)
+    else:
+        # Only the status fields, mapped straight to the answer without a model
+        job = await get_job(db, ObjectId(job_id), "status")
+    # TODO: Check created_on delta of jobs server.py has not yet received
+    text, status_code = result_2captcha(job)
+    return PlainTextResponse(text, status_code=status_code)
 
 
 @router.post("/2captcha/submit", response_class=PlainTextResponse)
@@ -123,24 +156,29 @@ async def submit_recaptcha_2captcha(key: str,
                                     method: str = "userrecaptcha",
                                     proxy: Optional[str] = None,
                                     proxytype: Optional[str] = None,
+                                    pingback: Optional[str] = None,
                                     json: int = 0,
                                     db: AsyncIOMotorClient = Depends(get_database), ):
     """
     Mimic 2Captcha API endpoint parameters to create a new ReCaptcha job.
+    With a pingback URL the result is POSTed there (id, code) once the job finishes, no polling needed.
     """
     validate_key = await get_api_key(db, apikey=key)
-    if validate_key:
-        if validate_key.credits < 1:
-            return PlainTextResponse("ERROR_ZERO_BALANCE", status_code=401)
     if not validate_key and key != settings.ROOT_API_KEY:
         return PlainTextResponse("ERROR_WRONG_USER_KEY", status_code=401)
     try:
         proxytype = proxytype.upper() if proxytype else None
         recaptcha = ReCaptchaCreate(api_key=key, method=method, googlekey=googlekey, pageurl=pageurl, proxy=proxy,
-                                    proxytype=proxytype)
-        result = await create_recaptcha(db, recaptcha)
-        if result and validate_key:
-            subtracted = await subtract_credit(db, apikey=validate_key.key)
+                                    proxytype=proxytype, pingback=pingback)
+        # Checks and takes the credit in one write, concurrent submits cannot overdraw the key
+        if validate_key and not await consume_credit(db, validate_key.key):
+            return PlainTextResponse("ERROR_ZERO_BALANCE", status_code=401)
+        try:
+            result = await create_recaptcha(db, recaptcha)
+        except Exception:
+            if validate_key:
+                await refund_credit(db, validate_key.key)
+            raise
         if json == 0:
             return f"OK|{result.id}"
         return {"status": 1, "request": f"{result.id}"}
@@ -157,12 +195,11 @@ async def get_recaptcha_job(job_id: PyObjectId,
     """
     Retrieve ReCaptcha job by job_id.
     """
-    print(job_id)
-    print(type(job_id))
-    job = await get_recaptcha(db, ObjectId(job_id))
+    job = await get_job(db, ObjectId(job_id))
     if not job:
         raise HTTPException(
             status_code=404,
             detail=f"Job with id '{job_id}' not found",
         )
-    return create_aliased_response(job)
+    # The response model is only documentation here, the projected document is serialized as is
+    return ORJSONResponse(job_response(job))
@@ -0,0 +1,103 @@
+import asyncio
+from fastapi import APIRouter, Depends, WebSocket, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.requests import Request
+from starlette.websockets import WebSocketDisconnect
+
+from app.core.config import settings
+from app.core.stream import STREAM_UNAVAILABLE, SubscriberClosed, job_event_hub
+from app.crud.api_key import get_api_key
+from app.db.mongodb import AsyncIOMotorClient, get_database
+
+"""
+Job events per API key: one event per job created or changing status, with the job as returned by GET /{job_id}
+and its id
+"""
+
+router = APIRouter(tags=["stream"],)
+
+
+async def is_authorized(db: AsyncIOMotorClient, key: str) -> bool:
+    return key == settings.ROOT_API_KEY or await get_api_key(db, apikey=key) is not None
+
+
+async def sse_events(request: Request, db: AsyncIOMotorClient, key: str):
+    # Subscribed once the response starts, so the finally below always unsubscribes
+    subscriber = job_event_hub.subscribe(db, key)
+    try:
+        yield ": connected\n\n"
+        while not await request.is_disconnected():
+            try:
+                event = await subscriber.get(settings.STREAM_PING)
+            except SubscriberClosed as sc:
+                yield f"event: error\ndata: {sc.reason}\n\n"
+                return
+            if event is None:
+                # Keep-alive for proxies that drop idle connections
+                yield ": ping\n\n"
+            else:
+                yield f"event: job\ndata: {event}\n\n"
+    finally:
+        job_event_hub.unsubscribe(subscriber)
+
+
+async def websocket_disconnected(websocket: WebSocket):
+    """
+    Returns once the client disconnects, clients have nothing to send
+    """
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+@router.get("/stream")
+async def stream_sse(request: Request,
+                     key: str,
+                     db: AsyncIOMotorClient = Depends(get_database), ):
+    """
+    Server-Sent Events of an API key's jobs. A `job` event (the job and its id as JSON) whenever one is created or
+    changes status, and an `error` event before the server ends the stream (e.g. ERROR_STREAM_OVERFLOW for a client
+    that fell STREAM_BUFFER events behind)
+    """
+    if not await is_authorized(db, key):
+        return PlainTextResponse("ERROR_WRONG_USER_KEY", status_code=401)
+    if not job_event_hub.available:
+        return PlainTextResponse(STREAM_UNAVAILABLE, status_code=503)
+    return StreamingResponse(sse_events(request, db, key), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.websocket("/stream")
+async def stream_websocket(websocket: WebSocket,
+                           key: str,
+                           db: AsyncIOMotorClient = Depends(get_database), ):
+    """
+    WebSocket of an API key's jobs, one JSON message (the job and its id) whenever one is created or changes status.
+    {"error": ...} is sent before the server closes the connection
+    """
+    if not await is_authorized(db, key):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not job_event_hub.available:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        return
+    await websocket.accept()
+    subscriber = job_event_hub.subscribe(db, key)
+    disconnected = asyncio.create_task(websocket_disconnected(websocket))
+    try:
+        # A disconnect is noticed within STREAM_PING seconds
+        while not disconnected.done():
+            try:
+                event = await subscriber.get(settings.STREAM_PING)
+            except SubscriberClosed as sc:
+                await websocket.send_json({"error": sc.reason})
+                await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+                return
+            if event is not None:
+                await websocket.send_text(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        disconnected.cancel()
+        job_event_hub.unsubscribe(subscriber)
@@ -0,0 +1,57 @@
+"""
+In-process TTL + LRU cache
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+# get() result for a key that is not cached, so a cached None (negative entry) can be told apart
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded mapping whose entries expire after a per-entry TTL. The least recently used entry is evicted when full.
+    Not shared between processes, every worker has its own
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 30):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        # key -> (expires at, value)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Cached value for key, or MISSING if there is none or it expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return MISSING
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
@@ -46,6 +46,53 @@ class Settings(BaseSettings):
     # Number of minutes before captcha database entries are removed
     GARBAGE_TIMER = int(os.getenv("GARBAGE_TIMER", 60))
 
+    # Seconds an API key lookup is cached per process (0 disables), and how long an unknown key is remembered
+    API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", 30))
+    API_KEY_CACHE_NEGATIVE_TTL = int(os.getenv("API_KEY_CACHE_NEGATIVE_TTL", 10))
+    API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", 10000))
+    # Refresh cached keys from a change stream on the keys collection (needs a replica set), so credit and key changes
+    # made by other processes show up at once instead of after API_KEY_CACHE_TTL
+    API_KEY_CACHE_WATCH: bool = strtobool(os.getenv("API_KEY_CACHE_WATCH", "false"))
+
+    # Credits each API process takes from a key at once and debits locally (0 or 1 = one conditional write per
+    # submit), and seconds without a submit before unused leased credits are returned to the key
+    CREDIT_LEASE_BLOCK = int(os.getenv("CREDIT_LEASE_BLOCK", 0))
+    CREDIT_LEASE_IDLE = int(os.getenv("CREDIT_LEASE_IDLE", 60))
+
+    # Write concern ("majority", "1", "0") of job inserts on submit, empty for the MDB_URI default. "1" acknowledges
+    # once the primary has the job, which is enough for server.py to claim it
+    SUBMIT_WRITE_CONCERN: Optional[str] = os.getenv("SUBMIT_WRITE_CONCERN")
+    # Max jobs in one /submit/batch request
+    BATCH_SUBMIT_MAX = int(os.getenv("BATCH_SUBMIT_MAX", 500))
+
+    # Max seconds a /2captcha?wait= request is held until its job finishes (0 disables waiting and the job change
+    # stream), and seconds between re-reads of the job while waiting without a change stream (standalone MongoDB)
+    JOB_WAIT_MAX = int(os.getenv("JOB_WAIT_MAX", 60))
+    JOB_WAIT_POLL = float(os.getenv("JOB_WAIT_POLL", 1))
+
+    # Concurrent pingback deliveries per API process (0 disables the dispatcher), and per pingback host
+    PINGBACK_CONCURRENCY = int(os.getenv("PINGBACK_CONCURRENCY", 50))
+    PINGBACK_HOST_CONCURRENCY = int(os.getenv("PINGBACK_HOST_CONCURRENCY", 5))
+    # Seconds before a pingback POST times out, delivery attempts per job, and the retry backoff bounds in seconds
+    PINGBACK_TIMEOUT = int(os.getenv("PINGBACK_TIMEOUT", 10))
+    PINGBACK_ATTEMPTS = int(os.getenv("PINGBACK_ATTEMPTS", 5))
+    PINGBACK_BASE_DELAY = int(os.getenv("PINGBACK_BASE_DELAY", 5))
+    PINGBACK_MAX_DELAY = int(os.getenv("PINGBACK_MAX_DELAY", 300))
+    # Seconds between checks for due pingbacks. Finished jobs are picked up at once through the job change stream
+    PINGBACK_POLL = int(os.getenv("PINGBACK_POLL", 5))
+    # Pingback hosts that may resolve to private or loopback addresses, e.g. a callback service on the same network
+    PINGBACK_ALLOWED_HOSTS = CommaSeparatedStrings(os.getenv("PINGBACK_ALLOWED_HOSTS", ""))
+
+    # Finished jobs cached per process for /2captcha and /{job_id} status reads (0 disables the cache), kept until
+    # GARBAGE_TIMER purges them. Jobs still in progress (and unknown ids) are cached for JOB_CACHE_PENDING_TTL seconds
+    JOB_CACHE_SIZE = int(os.getenv("JOB_CACHE_SIZE", 20000))
+    JOB_CACHE_PENDING_TTL = float(os.getenv("JOB_CACHE_PENDING_TTL", 1))
+
+    # Job events buffered per /stream subscriber before a consumer too slow to keep up is disconnected, and seconds
+    # between keep-alive comments on idle SSE streams
+    STREAM_BUFFER = int(os.getenv("STREAM_BUFFER", 1000))
+    STREAM_PING = int(os.getenv("STREAM_PING", 15))
+
     class Config:
         case_sensitive = True
 
@@ -0,0 +1,72 @@
+"""
+Prometheus metrics for the FastAPI app, exposed at /metrics
+
+Each worker process keeps its own metrics. When the API runs with several workers (uvicorn/gunicorn --workers),
+set PROMETHEUS_MULTIPROCESS_DIR to an empty directory shared by the workers: every worker then writes its metrics
+there and /metrics adds up all of them, whichever worker answers. Without it /metrics only shows the worker that
+answered, which is only right with a single worker.
+"""
+import os
+import time
+from functools import wraps
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Read by prometheus_client itself when the metrics below are created. Must be empty when the server starts
+MULTIPROCESS_DIR = os.getenv("PROMETHEUS_MULTIPROCESS_DIR")
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+MONGO_LATENCY = Histogram("capmonster_api_mongo_seconds", "MongoDB latency per CRUD function", ["operation"],
+                          buckets=LATENCY_BUCKETS)
+JOBS_SUBMITTED = Counter("capmonster_api_jobs_submitted_total", "ReCaptcha jobs created through the API")
+API_KEY_CACHE = Counter("capmonster_api_key_cache_total", "API key lookups by cache result (hit, negative_hit, miss)",
+                        ["result"])
+CREDITS_CONSUMED = Counter("capmonster_api_credits_consumed_total", "API key credits subtracted for submitted jobs")
+PINGBACKS = Counter("capmonster_api_pingbacks_total", "Pingback delivery attempts by result (delivered, retry, failed)",
+                    ["result"])
+# Gauges are summed over the live workers in multiprocess mode
+STREAM_SUBSCRIBERS = Gauge("capmonster_api_stream_subscribers", "Open /stream connections (SSE and WebSocket)",
+                           multiprocess_mode="livesum")
+STREAM_OVERFLOWS = Counter("capmonster_api_stream_overflows_total",
+                           "/stream subscribers disconnected for falling STREAM_BUFFER events behind")
+JOB_CACHE = Counter("capmonster_api_job_cache_total", "Job status reads by cache result (hit, coalesced, miss)",
+                    ["result"])
+JOB_WAITERS = Gauge("capmonster_api_job_waiters", "/2captcha?wait= requests held until their job finishes",
+                    multiprocess_mode="livesum")
+
+
+def latest_metrics() -> bytes:
+    """
+    The metrics in the Prometheus text format, of every worker in multiprocess mode
+    """
+    if not MULTIPROCESS_DIR:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def mark_worker_dead():
+    """
+    Drops this worker's live gauges in multiprocess mode, call when the worker shuts down
+    """
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def observe_mongo(operation: str):
+    """
+    Decorator recording the latency of an async CRUD function under MONGO_LATENCY{operation}
+    """
+    histogram = MONGO_LATENCY.labels(operation)
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
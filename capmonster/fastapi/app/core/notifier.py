@@ -0,0 +1,116 @@
+"""
+In-process notifications of finished jobs, for requests that wait on a solution instead of polling
+"""
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Set
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.core.config import settings
+from app.core.metrics import JOB_WAITERS
+from app.db.job_state import FINISHED_STATUSES
+
+# $changeStream stage is only supported on replica sets
+CHANGE_STREAM_UNSUPPORTED = {40573}
+
+logger = logging.getLogger(__name__)
+
+
+class JobNotifier:
+    """
+    Wakes the requests waiting on a job once it is solved, failed, expired or dead. One change stream on the jobs
+    collection per process feeds every waiter. Without change streams (standalone MongoDB) waiters fall back to
+    re-reading the job every JOB_WAIT_POLL seconds. Listeners (e.g. the pingback dispatcher) are called with every
+    finished job the stream sees
+    """
+
+    def __init__(self, poll_interval: float = settings.JOB_WAIT_POLL):
+        self.poll_interval = poll_interval
+        # True while the change stream is open, waiters only wake up on notify() then
+        self.streaming = False
+        self._waiters: Dict[ObjectId, Set[asyncio.Future]] = {}
+        self._listeners: List[Callable[[ObjectId, str], None]] = []
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def subscribe(self, job_id: ObjectId) -> asyncio.Future:
+        """
+        Future resolved with the job's status when it finishes. Subscribe before reading the job, so a job finishing
+        between the read and the wait is not missed
+        """
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(job_id, set()).add(waiter)
+        return waiter
+
+    def unsubscribe(self, job_id: ObjectId, waiter: asyncio.Future):
+        waiters = self._waiters.get(job_id)
+        if waiters is None:
+            return
+        waiters.discard(waiter)
+        if not waiters:
+            del self._waiters[job_id]
+
+    def add_listener(self, listener: Callable[[ObjectId, str], None]):
+        self._listeners.append(listener)
+
+    def notify(self, job_id: ObjectId, status: Optional[str] = None):
+        for waiter in self._waiters.pop(job_id, ()):
+            if not waiter.done():
+                waiter.set_result(status)
+
+    def notify_all(self):
+        """
+        Wakes every waiter to re-read its job, for changes that may have been missed while the stream was down
+        """
+        for job_id in list(self._waiters):
+            self.notify(job_id)
+
+    async def wait(self, waiter: asyncio.Future, timeout: float):
+        """
+        Waits up to timeout seconds for waiter, at most JOB_WAIT_POLL seconds without a change stream
+        """
+        if not self.streaming:
+            timeout = min(timeout, self.poll_interval)
+        await asyncio.wait({waiter}, timeout=timeout)
+
+    async def run(self, conn: AsyncIOMotorClient):
+        """
+        Notifies waiters from a change stream on the jobs collection, forever
+        Returns (waiters then poll) if the deployment has no change streams
+        """
+        collection = conn[settings.MDB_DATABASE][settings.MDB_COLLECTION]
+        # Only the transition into a finished status, server.py writes it with update_one
+        finished = [status.value for status in FINISHED_STATUSES]
+        pipeline = [{"$match": {"operationType": "update",
+                                "updateDescription.updatedFields.status": {"$in": finished}}}]
+        while True:
+            try:
+                async with collection.watch(pipeline) as stream:
+                    self.streaming = True
+                    self.notify_all()
+                    async for change in stream:
+                        status = change["updateDescription"]["updatedFields"]["status"]
+                        # Listeners first, e.g. the job cache is invalidated before the woken waiters re-read
+                        for listener in self._listeners:
+                            listener(change["documentKey"]["_id"], status)
+                        self.notify(change["documentKey"]["_id"], status)
+            except OperationFailure as of:
+                if of.code in CHANGE_STREAM_UNSUPPORTED:
+                    logger.warning(f"Waiting requests fall back to polling every {self.poll_interval}s: {of}")
+                    return
+                logger.error(f"Job change stream failed: {of}")
+            except PyMongoError as pme:
+                logger.error(f"Job change stream failed: {pme}")
+            finally:
+                self.streaming = False
+                # Waiters re-read their job and poll until the stream is back
+                self.notify_all()
+            await asyncio.sleep(5)
+
+
+job_notifier = JobNotifier()
+JOB_WAITERS.set_function(lambda: job_notifier.waiting)
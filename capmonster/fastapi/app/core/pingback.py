@@ -0,0 +1,201 @@
+"""
+Pingback (webhook) delivery of finished jobs
+
+Jobs submitted with a pingback URL get their result POSTed there once they finish, the way 2Captcha does:
+form fields id (job id) and code (the solution, or the error). Any 2xx response counts as delivered. Failed
+deliveries are retried with backoff, up to PINGBACK_ATTEMPTS, and the outcome is stored on the job in
+pingback_status / pingback_attempts / pingback_error.
+
+Pingback URLs come from API clients, so a host that resolves to a private, loopback, link-local or otherwise
+non-public address is never called (the API must not be a proxy into its own network), unless it is listed in
+PINGBACK_ALLOWED_HOSTS. Such deliveries fail at once, without retries.
+
+Every API process runs a dispatcher. Pingbacks are claimed from MongoDB with a lease, so processes do not deliver
+the same pingback twice unless a delivery outlives its lease (delivery is at least once).
+"""
+import asyncio
+import ipaddress
+import logging
+import random
+import socket
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Sequence, Set
+from urllib.parse import urlsplit
+import httpx
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+
+from app.core.config import settings
+from app.core.metrics import PINGBACKS
+from app.crud.recaptcha import claim_pingback, record_pingback
+from app.schema.common import JobStatusEnum, PingbackStatusEnum
+
+logger = logging.getLogger(__name__)
+
+
+async def non_public_address(host: str) -> Optional[str]:
+    """
+    Resolves a pingback host
+    :return: The first address it resolves to that is not publicly routable, None if all of them are
+    :raises OSError: The host could not be resolved
+    """
+    try:
+        ipaddress.ip_address(host)
+        addresses = [host]
+    except ValueError:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        addresses = [info[4][0] for info in infos]
+    for address in addresses:
+        # Link-local IPv6 addresses carry a scope, e.g. fe80::1%eth0
+        ip = ipaddress.ip_address(address.split("%")[0])
+        # is_global is False for private, loopback, link-local, reserved, shared (CGNAT) and unspecified addresses
+        if not ip.is_global or ip.is_multicast:
+            return address
+    return None
+
+
+class PingbackDispatcher:
+    """
+    Delivers due pingbacks over one keep-alive httpx.AsyncClient, at most PINGBACK_CONCURRENCY at once and
+    PINGBACK_HOST_CONCURRENCY per host. Woken by the job change stream (see JobNotifier.add_listener) when a job
+    finishes, and checks for due retries every PINGBACK_POLL seconds
+    """
+
+    def __init__(self, concurrency: int = settings.PINGBACK_CONCURRENCY,
+                 host_concurrency: int = settings.PINGBACK_HOST_CONCURRENCY,
+                 attempts: int = settings.PINGBACK_ATTEMPTS, base_delay: int = settings.PINGBACK_BASE_DELAY,
+                 max_delay: int = settings.PINGBACK_MAX_DELAY, timeout: int = settings.PINGBACK_TIMEOUT,
+                 poll: int = settings.PINGBACK_POLL, allowed_hosts: Sequence[str] = settings.PINGBACK_ALLOWED_HOSTS):
+        self.concurrency = concurrency
+        self.host_concurrency = max(1, host_concurrency)
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.poll = poll
+        # Hosts that may be called even though they resolve to a non-public address
+        self.allowed_hosts = {host.lower() for host in allowed_hosts}
+        # A claimed pingback has this long to be delivered, including time spent waiting for a host slot
+        self.lease_seconds = timeout * 3 + poll
+        # Created in run(), on the app's event loop
+        self._wake: Optional[asyncio.Event] = None
+        # host -> (semaphore, deliveries holding or waiting for it)
+        self._hosts: Dict[str, list] = {}
+        self._deliveries: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.concurrency > 0
+
+    def wake(self, job_id: ObjectId = None, status: str = None):
+        """
+        JobNotifier listener, a job finished and its pingback may be due
+        """
+        if self._wake is not None:
+            self._wake.set()
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Seconds to wait after the attempt-th failed delivery, with equal jitter
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @asynccontextmanager
+    async def host_slot(self, host: str):
+        """
+        Holds one of the host's PINGBACK_HOST_CONCURRENCY slots, a slow callback host cannot take every delivery
+        """
+        entry = self._hosts.setdefault(host, [asyncio.Semaphore(self.host_concurrency), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._hosts[host]
+
+    async def deliver(self, client: httpx.AsyncClient, conn: AsyncIOMotorClient, job: dict):
+        if job.get("status") == JobStatusEnum.solved.value:
+            code = job.get("solution")
+        else:
+            code = job.get("error") or "ERROR_CAPTCHA_UNSOLVABLE"
+        url = urlsplit(job["pingback"])
+        error = None
+        blocked = None
+        try:
+            async with self.host_slot(url.netloc):
+                if (url.hostname or "").lower() not in self.allowed_hosts:
+                    blocked = await non_public_address(url.hostname or "")
+                if blocked:
+                    error = f"Pingback host {url.hostname} resolves to non-public address {blocked}"
+                else:
+                    response = await client.post(job["pingback"], data={"id": str(job["_id"]), "code": str(code)})
+                    if not response.is_success:
+                        error = f"HTTP {response.status_code}"
+        except httpx.HTTPError as he:
+            error = f"{type(he).__name__}: {he}"
+        except OSError as oe:
+            # The host did not resolve, may be temporary
+            error = f"{type(oe).__name__}: {oe}"
+
+        attempt = job.get("pingback_attempts", 1)
+        if error is None:
+            PINGBACKS.labels("delivered").inc()
+            await record_pingback(conn, job["_id"], PingbackStatusEnum.delivered)
+        elif blocked or attempt >= self.attempts:
+            PINGBACKS.labels("failed").inc()
+            logger.warning(f"Pingback of {job['_id']} to {job['pingback']} failed {attempt} times: {error}")
+            await record_pingback(conn, job["_id"], PingbackStatusEnum.failed, error=error)
+        else:
+            PINGBACKS.labels("retry").inc()
+            await record_pingback(conn, job["_id"], PingbackStatusEnum.pending, error=error,
+                                  retry_in=self.backoff(attempt))
+
+    async def _deliver(self, client: httpx.AsyncClient, conn: AsyncIOMotorClient, job: dict,
+                       slots: asyncio.Semaphore):
+        try:
+            await self.deliver(client, conn, job)
+        except PyMongoError as pme:
+            # The lease runs out and the pingback is claimed again
+            logger.error(f"Failed to record pingback of {job['_id']}: {pme}")
+        finally:
+            slots.release()
+
+    async def run(self, conn: AsyncIOMotorClient):
+        """
+        Claims and delivers due pingbacks, forever
+        """
+        self._wake = asyncio.Event()
+        slots = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            try:
+                while True:
+                    # Cleared before claiming, a job finishing meanwhile wakes the next round
+                    self._wake.clear()
+                    try:
+                        while True:
+                            await slots.acquire()
+                            job = await claim_pingback(conn, self.lease_seconds)
+                            if not job:
+                                slots.release()
+                                break
+                            task = asyncio.create_task(self._deliver(client, conn, job, slots))
+                            self._deliveries.add(task)
+                            task.add_done_callback(self._deliveries.discard)
+                    except PyMongoError as pme:
+                        slots.release()
+                        logger.error(f"Failed to claim pingbacks: {pme}")
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), self.poll)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                for task in self._deliveries:
+                    task.cancel()
+
+
+pingback_dispatcher = PingbackDispatcher()
@@ -0,0 +1,165 @@
+"""
+Per API key fan-out of job events, for the /stream SSE and WebSocket endpoints
+"""
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+import orjson
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.core.config import settings
+from app.core.metrics import STREAM_OVERFLOWS, STREAM_SUBSCRIBERS
+from app.core.notifier import CHANGE_STREAM_UNSUPPORTED
+from app.crud.recaptcha import job_response
+
+# Close reasons, sent to the client before its stream ends
+STREAM_OVERFLOW = "ERROR_STREAM_OVERFLOW"
+STREAM_UNAVAILABLE = "ERROR_STREAM_UNAVAILABLE"
+
+# Queued by JobSubscriber.close() to wake a consumer waiting on an empty buffer
+_CLOSED = object()
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriberClosed(Exception):
+    """Raised by JobSubscriber.get() once the subscriber is closed and its buffer is drained"""
+    def __init__(self, reason: str):
+        self.reason = reason
+        super().__init__(reason)
+
+
+class JobSubscriber:
+    """
+    Events of one API key's jobs for one connection, in a buffer of at most STREAM_BUFFER events. A consumer that
+    falls that far behind is closed with STREAM_OVERFLOW rather than buffering without bound
+    """
+
+    def __init__(self, key: str, buffer: int = settings.STREAM_BUFFER):
+        self.key = key
+        self.closed: Optional[str] = None
+        self._events: asyncio.Queue = asyncio.Queue(maxsize=max(1, buffer))
+
+    def put(self, event: str):
+        if self.closed:
+            return
+        try:
+            self._events.put_nowait(event)
+        except asyncio.QueueFull:
+            STREAM_OVERFLOWS.inc()
+            self.close(STREAM_OVERFLOW)
+
+    def close(self, reason: str):
+        if self.closed:
+            return
+        self.closed = reason
+        try:
+            self._events.put_nowait(_CLOSED)
+        except asyncio.QueueFull:
+            # The consumer finds closed once it drains the buffer
+            pass
+
+    async def get(self, timeout: float) -> Optional[str]:
+        """
+        Next event (the job as JSON), None if there was none within timeout
+        :raises SubscriberClosed: Closed, and every event buffered before that was consumed
+        """
+        if self.closed and self._events.empty():
+            raise SubscriberClosed(self.closed)
+        try:
+            event = await asyncio.wait_for(self._events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if event is _CLOSED:
+            raise SubscriberClosed(self.closed)
+        return event
+
+
+class JobEventHub:
+    """
+    Fans one change stream on the jobs collection out to every subscriber in the process, by API key. Each event is
+    a job created or changing status, as GET /{job_id} returns it plus its id. The stream only runs while someone is
+    subscribed and resumes where it left off after an error
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[JobSubscriber]] = {}
+        self._task: Optional[asyncio.Task] = None
+        # False once the deployment turned out to have no change streams (standalone MongoDB)
+        self.available = True
+
+    @property
+    def subscribers(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def subscribe(self, conn: AsyncIOMotorClient, key: str) -> JobSubscriber:
+        subscriber = JobSubscriber(key)
+        self._subscribers.setdefault(key, set()).add(subscriber)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(conn))
+        return subscriber
+
+    def unsubscribe(self, subscriber: JobSubscriber):
+        subscribers = self._subscribers.get(subscriber.key)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.key]
+        if not self._subscribers:
+            self.stop()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def publish(self, document: dict):
+        subscribers = self._subscribers.get(document.get("key"))
+        if not subscribers:
+            return
+        try:
+            # Encoded once for every subscriber of the key. The response has no id, a client needs it to tell its jobs
+            # apart
+            event = orjson.dumps({"id": str(document["_id"]), **job_response(document)}).decode()
+        except orjson.JSONEncodeError as je:
+            logger.error(f"Job {document.get('_id')} skipped by /stream: {je}")
+            return
+        for subscriber in list(subscribers):
+            subscriber.put(event)
+
+    async def run(self, conn: AsyncIOMotorClient):
+        collection = conn[settings.MDB_DATABASE][settings.MDB_COLLECTION]
+        # Inserts and status transitions, not lease renewals and other bookkeeping writes
+        pipeline = [{"$match": {"$or": [{"operationType": "insert"},
+                                        {"operationType": "update",
+                                         "updateDescription.updatedFields.status": {"$exists": True}}]}},
+                    {"$project": {"fullDocument": 1}}]
+        resume_after = None
+        while True:
+            try:
+                async with collection.watch(pipeline, full_document="updateLookup",
+                                            resume_after=resume_after) as stream:
+                    async for change in stream:
+                        resume_after = stream.resume_token
+                        # None if the job was deleted before the lookup
+                        if change.get("fullDocument"):
+                            self.publish(change["fullDocument"])
+            except OperationFailure as of:
+                if of.code in CHANGE_STREAM_UNSUPPORTED:
+                    logger.warning(f"/stream is unavailable without change streams: {of}")
+                    self.available = False
+                    for subscribers in self._subscribers.values():
+                        for subscriber in subscribers:
+                            subscriber.close(STREAM_UNAVAILABLE)
+                    return
+                logger.error(f"Job event stream failed: {of}")
+                # The resume token may have fallen off the oplog, start from now
+                resume_after = None
+            except PyMongoError as pme:
+                logger.error(f"Job event stream failed: {pme}")
+            await asyncio.sleep(5)
+
+
+job_event_hub = JobEventHub()
+STREAM_SUBSCRIBERS.set_function(lambda: job_event_hub.subscribers)
@@ -1,11 +1,27 @@
+import asyncio
+import logging
+import time
 from fastapi.encoders import jsonable_encoder
 from motor.motor_asyncio import AsyncIOMotorClient
-from typing import Union
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+from typing import Dict, Tuple, Union
 
+from app.core.cache import TTLCache, MISSING
 from app.core.config import settings
+from app.core.metrics import API_KEY_CACHE, CREDITS_CONSUMED, observe_mongo
 from app.schema.api_key import APIKeyCaptchaCreate, APIKeyCaptchaBase, APIKeyCaptchaInResponse
 
+# $changeStream stage is only supported on replica sets
+CHANGE_STREAM_UNSUPPORTED = {40573}
 
+logger = logging.getLogger(__name__)
+
+# Per-process cache of get_api_key(apikey=...) results. None entries are unknown keys (negative caching)
+api_key_cache = TTLCache(maxsize=settings.API_KEY_CACHE_SIZE, ttl=settings.API_KEY_CACHE_TTL)
+
+
+@observe_mongo("create_api_key")
 async def create_api_key(conn: AsyncIOMotorClient, apikey: APIKeyCaptchaBase) -> APIKeyCaptchaInResponse:
     """
 
@@ -13,30 +29,198 @@ async def create_api_key(conn: AsyncIOMotorClient, apikey: APIKeyCaptchaBase) ->
     # Add DateTime
     new_apikey = APIKeyCaptchaCreate(**apikey.dict())
     new_apikey_doc = jsonable_encoder(new_apikey)
-    inserted_apikey = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].insert_one(new_apikey_doc)
-    created_apikey = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].find_one(
-        {"_id": inserted_apikey.inserted_id})
-    return APIKeyCaptchaInResponse(**created_apikey)
-
+    # insert_one adds the generated _id to new_apikey_doc, no need to read the key back
+    await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].insert_one(new_apikey_doc)
+    # Drop a negative entry left by requests made with this key before it existed
+    api_key_cache.invalidate(new_apikey_doc["key"])
+    return APIKeyCaptchaInResponse(**new_apikey_doc)
 
-async def get_api_key(conn: AsyncIOMotorClient, apikey: str = None, user_id: str = None) -> Union[APIKeyCaptchaInResponse, None]:
-    if not apikey and not user_id:
-        return None
-    if apikey:
-        query = {"key": apikey}
-    else:
-        query = {"user": user_id}
 
+@observe_mongo("get_api_key")
+async def find_api_key(conn: AsyncIOMotorClient, query: dict) -> Union[APIKeyCaptchaInResponse, None]:
     found_key = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].find_one(query)
     if not found_key:
         return None
     return APIKeyCaptchaInResponse(**found_key)
 
 
-async def subtract_credit(conn: AsyncIOMotorClient, apikey: str = None, user_id: str = None) -> None:
-    if apikey:
-        query = {"key": apikey}
+async def get_api_key(conn: AsyncIOMotorClient, apikey: str = None, user_id: str = None) -> Union[APIKeyCaptchaInResponse, None]:
+    """
+    Lookups by apikey go through api_key_cache, unknown keys included. Lookups by user_id always read MongoDB
+    """
+    if not apikey and not user_id:
+        return None
+    if not apikey:
+        return await find_api_key(conn, {"user": user_id})
+    if not api_key_cache.enabled:
+        return await find_api_key(conn, {"key": apikey})
+
+    cached = api_key_cache.get(apikey)
+    if cached is not MISSING:
+        API_KEY_CACHE.labels("hit" if cached else "negative_hit").inc()
+        return cached
+    API_KEY_CACHE.labels("miss").inc()
+    found_key = await find_api_key(conn, {"key": apikey})
+    api_key_cache.set(apikey, found_key, ttl=None if found_key else settings.API_KEY_CACHE_NEGATIVE_TTL)
+    return found_key
+
+
+def _cache_balance(found_key: Union[dict, None]):
+    """
+    Refreshes the cached balance of a key this process uses from a document it just wrote
+    """
+    if found_key and api_key_cache.get(found_key["key"]) is not MISSING:
+        api_key_cache.set(found_key["key"], APIKeyCaptchaInResponse(**found_key))
+
+
+@observe_mongo("reserve_credit")
+async def reserve_credit(conn: AsyncIOMotorClient, apikey: str) -> bool:
+    """
+    Takes one credit from a key in a single conditional write, so concurrent submits cannot overdraw it
+    :return: False if the key has no credits left
+    """
+    updated_key = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].find_one_and_update(
+        {"key": apikey, "credits": {"$gte": 1}}, {"$inc": {"credits": -1}}, return_document=ReturnDocument.AFTER)
+    _cache_balance(updated_key)
+    return updated_key is not None
+
+
+@observe_mongo("refund_credit")
+async def refund_credit(conn: AsyncIOMotorClient, apikey: str, amount: int = 1):
+    """
+    Gives credits back, e.g. for a submit whose job insert failed
+    """
+    updated_key = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].find_one_and_update(
+        {"key": apikey}, {"$inc": {"credits": amount}}, return_document=ReturnDocument.AFTER)
+    _cache_balance(updated_key)
+
+
+@observe_mongo("take_credits")
+async def take_credits(conn: AsyncIOMotorClient, apikey: str, block: int) -> int:
+    """
+    Takes up to block credits from a key in one write, fewer if its balance is lower. Used for credit leases and
+    batch submits
+    :return: Number of credits taken
+    """
+    # Pipeline update (MongoDB 4.2+): never drives the balance below zero
+    previous = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].find_one_and_update(
+        {"key": apikey, "credits": {"$gte": 1}},
+        [{"$set": {"credits": {"$max": [0, {"$subtract": ["$credits", block]}]}}}],
+        projection={"credits": 1}, return_document=ReturnDocument.BEFORE)
+    if not previous:
+        return 0
+    return min(previous["credits"], block)
+
+
+class CreditLeases:
+    """
+    Credits leased by this process in blocks of CREDIT_LEASE_BLOCK, debited locally. Turns the per-submit write on
+    a busy key into one write per block. Leased credits do not show in the key's balance until they are used or
+    returned, so unused ones go back after CREDIT_LEASE_IDLE seconds without a submit and on shutdown
+    """
+
+    def __init__(self, block: int = settings.CREDIT_LEASE_BLOCK, idle: int = settings.CREDIT_LEASE_IDLE):
+        self.block = block
+        self.idle = idle
+        # key -> (credits left, monotonic time of last use)
+        self._leases: Dict[str, Tuple[int, float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.block > 1
+
+    async def consume(self, conn: AsyncIOMotorClient, apikey: str) -> bool:
+        left, _ = self._leases.get(apikey, (0, 0.0))
+        if left < 1:
+            left = await take_credits(conn, apikey, self.block)
+            if left < 1:
+                return False
+            # Concurrent submits may have leased meanwhile, keep both blocks
+            left += self._leases.get(apikey, (0, 0.0))[0]
+        self._leases[apikey] = (left - 1, time.monotonic())
+        return True
+
+    async def release(self, conn: AsyncIOMotorClient, idle_only: bool = False) -> int:
+        """
+        Returns unused leased credits to their keys, only those idle for CREDIT_LEASE_IDLE seconds if idle_only
+        :return: Number of credits returned
+        """
+        returned = 0
+        now = time.monotonic()
+        for apikey, (left, used_at) in list(self._leases.items()):
+            if idle_only and now - used_at < self.idle:
+                continue
+            del self._leases[apikey]
+            if left > 0:
+                await refund_credit(conn, apikey, left)
+                returned += left
+        return returned
+
+    async def run(self, conn: AsyncIOMotorClient):
+        """
+        Returns idle leases every CREDIT_LEASE_IDLE seconds, forever
+        """
+        while True:
+            await asyncio.sleep(self.idle)
+            try:
+                await self.release(conn, idle_only=True)
+            except PyMongoError as pme:
+                logger.error(f"Failed to return leased credits: {pme}")
+
+
+credit_leases = CreditLeases()
+
+
+async def consume_credit(conn: AsyncIOMotorClient, apikey: str) -> bool:
+    """
+    Spends one credit of a key for a new job, from this process's lease if leasing is enabled
+    :return: False if the key has no credits left
+    """
+    if credit_leases.enabled:
+        consumed = await credit_leases.consume(conn, apikey)
     else:
-        query = {"user": user_id}
-    updated_key = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS].update_one(query,
-                                                                                         {"$inc": {"credits": -1}})
+        consumed = await reserve_credit(conn, apikey)
+    if consumed:
+        CREDITS_CONSUMED.inc()
+    return consumed
+
+
+async def consume_credits(conn: AsyncIOMotorClient, apikey: str, count: int) -> int:
+    """
+    Spends up to count credits of a key for a batch of jobs, straight from its balance
+    :return: Number of credits spent, the first that many jobs of the batch are covered
+    """
+    consumed = await take_credits(conn, apikey, count)
+    CREDITS_CONSUMED.inc(consumed)
+    return consumed
+
+
+async def watch_api_keys(conn: AsyncIOMotorClient):
+    """
+    Keeps api_key_cache in step with the keys collection across processes, from a change stream
+    Returns (cache then relies on its TTL) if the deployment has no change streams
+    """
+    collection = conn[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS]
+    while True:
+        try:
+            async with collection.watch(full_document="updateLookup") as stream:
+                # Changes missed while the stream was down
+                api_key_cache.clear()
+                async for change in stream:
+                    document = change.get("fullDocument")
+                    if not document or "key" not in document:
+                        # Deleted (or deleted before the lookup), the key string is unknown here
+                        api_key_cache.clear()
+                    elif change["operationType"] == "insert":
+                        api_key_cache.invalidate(document["key"])
+                    elif api_key_cache.get(document["key"]) is not MISSING:
+                        # Refresh keys this process uses, e.g. credits spent through another process
+                        api_key_cache.set(document["key"], APIKeyCaptchaInResponse(**document))
+        except OperationFailure as of:
+            if of.code in CHANGE_STREAM_UNSUPPORTED:
+                logger.warning(f"API key cache falls back to its {settings.API_KEY_CACHE_TTL}s TTL: {of}")
+                return
+            logger.error(f"API key change stream failed: {of}")
+        except PyMongoError as pme:
+            logger.error(f"API key change stream failed: {pme}")
+        await asyncio.sleep(5)
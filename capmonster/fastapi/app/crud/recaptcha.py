@@ -1,20 +1,40 @@
 """
 CRUD Operations for ReCaptcha
 """
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Dict, Set, Tuple
+import asyncio
 import datetime
-from datetime import timezone
+import logging
 import secrets
+import time
+from datetime import timezone
 from bson import ObjectId
-from fastapi.encoders import jsonable_encoder
 from pydantic import EmailStr
-from pymongo import DeleteOne
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
 
-from app.db.mongodb import AsyncIOMotorClient
+from app.db.expiry import parse_created_on, purge_expired
+from app.db.job_state import FINISHED_STATUSES, STATUS_FIELDS, infer_status
+from app.db.mongodb import AsyncIOMotorClient, parse_write_concern
+from app.schema.common import JobStatusEnum, PingbackStatusEnum, utc_isoformat
 from app.schema.recaptcha import ReCaptchaResponse, ReCaptchaCreate, ReCaptchaInDb, ReCaptchaSolved, ReCaptchaInCreate
 from app.core.config import settings
+from app.core.cache import TTLCache, MISSING
+from app.core.metrics import JOB_CACHE, JOBS_SUBMITTED, observe_mongo
+from app.core.notifier import job_notifier
+
+# Write concern of job inserts, the URI's default if SUBMIT_WRITE_CONCERN is unset
+SUBMIT_WRITE_CONCERN = parse_write_concern(settings.SUBMIT_WRITE_CONCERN)
+
+logger = logging.getLogger(__name__)
 
+# Per-process cache of get_job results by (job _id, view). Finished jobs never change, they stay until GARBAGE_TIMER
+job_cache = TTLCache(maxsize=settings.JOB_CACHE_SIZE, ttl=settings.GARBAGE_TIMER * 60 if settings.JOB_CACHE_SIZE else 0)
+# (job _id, view) -> the MongoDB read every concurrent get_job of that job and view waits on
+_job_reads: Dict[Tuple[ObjectId, str], asyncio.Task] = {}
 
+
+@observe_mongo("total_docs_in_db")
 async def total_docs_in_db(conn: AsyncIOMotorClient) -> int:
     """
     Counts and returns the number of total documents in the database
@@ -22,6 +42,7 @@ async def total_docs_in_db(conn: AsyncIOMotorClient) -> int:
     return await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].count_documents({})
 
 
+@observe_mongo("get_one_recaptcha")
 async def get_one_recaptcha(conn: AsyncIOMotorClient) -> ReCaptchaResponse:
     """
     Test function for retrieving a single entry from the collection
@@ -30,6 +51,7 @@ async def get_one_recaptcha(conn: AsyncIOMotorClient) -> ReCaptchaResponse:
     return ReCaptchaResponse(**one)
 
 
+@observe_mongo("get_all_recaptcha")
 async def get_all_recaptcha(conn: AsyncIOMotorClient) -> List[ReCaptchaResponse]:
     """
     Returns all documents in the recaptcha collection
@@ -43,51 +65,243 @@ async def get_all_recaptcha(conn: AsyncIOMotorClient) -> List[ReCaptchaResponse]
     return rsp
 
 
+@observe_mongo("create_recaptcha")
 async def create_recaptcha(conn: AsyncIOMotorClient, recaptcha: ReCaptchaCreate) -> ReCaptchaInDb:
     """
     Adds a recaptcha job to the database
     """
-    # Add DateTime
+    # Add DateTime. Stored as a native date so the created_on TTL index and range deletes apply
     recaptcha = ReCaptchaInCreate(**recaptcha.dict())
-    recaptcha_doc = jsonable_encoder(recaptcha)
-    new_recaptcha = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].insert_one(recaptcha_doc)
-    created_recaptcha = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].find_one({"_id": new_recaptcha.inserted_id})
+    recaptcha_doc = recaptcha.dict()
+    collection = conn[settings.MDB_DATABASE][settings.MDB_COLLECTION]
+    if SUBMIT_WRITE_CONCERN is not None:
+        collection = collection.with_options(write_concern=SUBMIT_WRITE_CONCERN)
+    # insert_one adds the generated _id to recaptcha_doc, no need to read the job back
+    await collection.insert_one(recaptcha_doc)
+    JOBS_SUBMITTED.inc()
+    return ReCaptchaInDb(**recaptcha_doc)
 
-    return ReCaptchaInDb(**created_recaptcha)
 
+@observe_mongo("create_recaptchas")
+async def create_recaptchas(conn: AsyncIOMotorClient,
+                            recaptchas: List[ReCaptchaCreate]) -> Tuple[List[ReCaptchaInDb], Set[int]]:
+    """
+    Adds a batch of recaptcha jobs with one unordered insert_many, a failed job does not stop the others
+    :return: The jobs in input order, and the indexes of the jobs that were certainly not inserted
+    :raises PyMongoError: The insert failed and which jobs were written could not be checked
+    """
+    if not recaptchas:
+        return [], set()
+    recaptcha_docs = [ReCaptchaInCreate(**recaptcha.dict()).dict() for recaptcha in recaptchas]
+    collection = conn[settings.MDB_DATABASE][settings.MDB_COLLECTION]
+    if SUBMIT_WRITE_CONCERN is not None:
+        collection = collection.with_options(write_concern=SUBMIT_WRITE_CONCERN)
+    failed: Set[int] = set()
+    try:
+        # Every document gets its _id before anything is sent
+        await collection.insert_many(recaptcha_docs, ordered=False)
+    except BulkWriteError as bwe:
+        for write_error in bwe.details.get("writeErrors", []):
+            failed.add(write_error["index"])
+            logger.error(f"Batch job {write_error['index']} was not inserted: {write_error.get('errmsg')}")
+    except PyMongoError as pme:
+        # E.g. the connection dropped mid-write, some jobs may be in. Their _ids are known, so look them up
+        logger.error(f"Batch insert failed, checking which jobs were written: {pme}")
+        ids = [recaptcha_doc["_id"] for recaptcha_doc in recaptcha_docs]
+        written = {found["_id"] async for found in collection.find({"_id": {"$in": ids}}, {"_id": 1})}
+        failed = {index for index, recaptcha_doc in enumerate(recaptcha_docs) if recaptcha_doc["_id"] not in written}
+    JOBS_SUBMITTED.inc(len(recaptcha_docs) - len(failed))
+    return [ReCaptchaInDb(**recaptcha_doc) for recaptcha_doc in recaptcha_docs], failed
 
-async def get_recaptcha(conn: AsyncIOMotorClient, job_id: ObjectId) -> Union[ReCaptchaResponse, ReCaptchaSolved, None]:
+
+def recaptcha_from_document(result: dict) -> Union[ReCaptchaResponse, ReCaptchaSolved]:
     """
-    Retrieve a captcha job from the DB using job_id
+    Response model of a job document, ReCaptchaSolved once it has a solution
     """
-    result = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].find_one({"_id": job_id})
-    if not result:
-        return None
+    # Documents from before the status field get theirs from migrate_status() on startup, infer it until then
+    result["status"] = infer_status(result)
     if 'solution' in result.keys():
         return ReCaptchaSolved(**result)
     return ReCaptchaResponse(**result)
 
 
+# Fields of a GET /{job_id} response, everything ReCaptchaSolved shows and nothing else (e.g. not the API key)
+RESPONSE_FIELDS = tuple(field.alias for field in ReCaptchaSolved.__fields__.values())
+RESPONSE_PROJECTION = {"_id": 0, **{field: 1 for field in RESPONSE_FIELDS}}
+# Fields of a /2captcha status read, plus created_on for job_cache
+STATUS_PROJECTION = {"_id": 0, "created_on": 1, **{field: 1 for field in STATUS_FIELDS}}
+JOB_VIEWS = {"response": RESPONSE_PROJECTION, "status": STATUS_PROJECTION}
+
+
+def job_response(document: dict) -> dict:
+    """
+    GET /{job_id} body of a job document, its RESPONSE_FIELDS that are set. Serialized as is, no model involved.
+    Dates take the ...Z form the response models' json_encoders give them
+    """
+    body = {}
+    for field in RESPONSE_FIELDS:
+        value = document.get(field)
+        if value is not None:
+            body[field] = utc_isoformat(value) if isinstance(value, datetime.datetime) else value
+    body["status"] = infer_status(document).value
+    return body
+
+
+@observe_mongo("get_recaptcha")
+async def read_job(conn: AsyncIOMotorClient, job_id: ObjectId, projection: dict) -> Optional[dict]:
+    """
+    The projection's fields of a job document, without building a model. status is inferred for documents that
+    predate it
+    """
+    document = await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].find_one({"_id": job_id}, projection)
+    if document is not None:
+        document["status"] = infer_status(document).value
+    return document
+
+
+def cache_ttl(document: Optional[dict]) -> float:
+    """
+    Seconds job_cache keeps a job: finished ones until GARBAGE_TIMER purges them, others JOB_CACHE_PENDING_TTL.
+    A finished job whose pingback is still pending changes again once the dispatcher delivers it, so it counts as
+    in progress
+    """
+    if document is None or JobStatusEnum(document["status"]) not in FINISHED_STATUSES or not document.get("created_on"):
+        return settings.JOB_CACHE_PENDING_TTL
+    if document.get("pingback_status") == PingbackStatusEnum.pending.value:
+        return settings.JOB_CACHE_PENDING_TTL
+    created_on = document["created_on"]
+    if not isinstance(created_on, datetime.datetime):
+        # ISO string of an older job, until migrate_created_on() has converted it
+        try:
+            created_on = parse_created_on(str(created_on))
+        except ValueError:
+            return settings.JOB_CACHE_PENDING_TTL
+    if created_on.tzinfo is None:
+        # Motor returns naive UTC dates
+        created_on = created_on.replace(tzinfo=timezone.utc)
+    return job_cache.ttl - (datetime.datetime.now(timezone.utc) - created_on).total_seconds()
+
+
+async def _read_and_cache(conn: AsyncIOMotorClient, job_id: ObjectId, view: str):
+    document = await read_job(conn, job_id, JOB_VIEWS[view])
+    # Not if the job changed (see forget_recaptcha) while this read was in flight
+    if _job_reads.get((job_id, view)) is asyncio.current_task():
+        job_cache.set((job_id, view), document, ttl=cache_ttl(document))
+    return document
+
+
+def _read_done(cache_key: Tuple[ObjectId, str], read: asyncio.Task):
+    if _job_reads.get(cache_key) is read:
+        del _job_reads[cache_key]
+
+
+async def get_job(conn: AsyncIOMotorClient, job_id: ObjectId, view: str = "response") -> Optional[dict]:
+    """
+    A job document with the fields of a JOB_VIEWS view, from job_cache if it is there. Concurrent calls for one job
+    and view share a single MongoDB read. The returned dict is shared too, do not modify it
+    """
+    if not job_cache.enabled:
+        return await read_job(conn, job_id, JOB_VIEWS[view])
+    cache_key = (job_id, view)
+    document = job_cache.get(cache_key)
+    if document is not MISSING:
+        JOB_CACHE.labels("hit").inc()
+        return document
+    read = _job_reads.get(cache_key)
+    if read is None:
+        JOB_CACHE.labels("miss").inc()
+        read = asyncio.ensure_future(_read_and_cache(conn, job_id, view))
+        _job_reads[cache_key] = read
+        read.add_done_callback(lambda done: _read_done(cache_key, done))
+    else:
+        JOB_CACHE.labels("coalesced").inc()
+    # Shielded, a caller that goes away does not cancel the read for the others
+    return await asyncio.shield(read)
+
+
+async def get_recaptcha(conn: AsyncIOMotorClient, job_id: ObjectId) -> Union[ReCaptchaResponse, ReCaptchaSolved, None]:
+    """
+    Retrieve a captcha job from the DB using job_id
+    """
+    document = await get_job(conn, job_id)
+    if document is None:
+        return None
+    return recaptcha_from_document(dict(document))
+
+
+def forget_recaptcha(job_id: ObjectId, status: Optional[str] = None):
+    """
+    Drops a job that just changed from job_cache, and lets the next read start afresh. JobNotifier listener, so
+    /2captcha?wait= requests woken by the change do not read the job from before it
+    """
+    for view in JOB_VIEWS:
+        job_cache.invalidate((job_id, view))
+        _job_reads.pop((job_id, view), None)
+
+
+job_notifier.add_listener(forget_recaptcha)
+
+
+async def wait_for_recaptcha(conn: AsyncIOMotorClient, job_id: ObjectId, wait: float) -> Optional[dict]:
+    """
+    get_job(view="status"), but a job that is not finished yet is held for up to wait seconds until it is. Woken by
+    job_notifier, so a waiting request reads the job twice instead of once per poll
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        # Subscribed before the read, a job finishing in between still wakes the waiter
+        waiter = job_notifier.subscribe(job_id)
+        try:
+            document = await get_job(conn, job_id, "status")
+            remaining = deadline - time.monotonic()
+            if not document or JobStatusEnum(document["status"]) in FINISHED_STATUSES or remaining <= 0:
+                return document
+            await job_notifier.wait(waiter, remaining)
+        finally:
+            job_notifier.unsubscribe(job_id, waiter)
+
+
+@observe_mongo("claim_pingback")
+async def claim_pingback(conn: AsyncIOMotorClient, lease_seconds: int) -> Optional[dict]:
+    """
+    Takes the finished job whose pingback is due the longest, and holds it for lease_seconds. A dispatcher that
+    dies mid-delivery leaves the pingback to be claimed again once the lease runs out
+    :return: The job's _id, pingback, status, solution, error and pingback_attempts, None if no pingback is due
+    """
+    now = datetime.datetime.now(timezone.utc)
+    return await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].find_one_and_update(
+        {"pingback_status": PingbackStatusEnum.pending.value,
+         "status": {"$in": [status.value for status in FINISHED_STATUSES]},
+         "pingback_due": {"$lte": now}},
+        {"$set": {"pingback_due": now + datetime.timedelta(seconds=lease_seconds)}, "$inc": {"pingback_attempts": 1}},
+        projection={"pingback": 1, "status": 1, "solution": 1, "error": 1, "pingback_attempts": 1},
+        sort=[("pingback_due", ASCENDING)], return_document=ReturnDocument.AFTER)
+
+
+@observe_mongo("record_pingback")
+async def record_pingback(conn: AsyncIOMotorClient, job_id: ObjectId, status: PingbackStatusEnum,
+                          error: Optional[str] = None, retry_in: Optional[float] = None):
+    """
+    Stores the outcome of a pingback delivery attempt. A pending status is retried after retry_in seconds
+    """
+    update = {"$set": {"pingback_status": status.value}}
+    if error is not None:
+        update["$set"]["pingback_error"] = error
+    if status == PingbackStatusEnum.pending:
+        update["$set"]["pingback_due"] = datetime.datetime.now(timezone.utc) + datetime.timedelta(seconds=retry_in or 0)
+    else:
+        update["$unset"] = {"pingback_due": ""}
+    await conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].update_one({"_id": job_id}, update)
+    # Other processes cached the job for JOB_CACHE_PENDING_TTL at most while its pingback was pending
+    forget_recaptcha(job_id)
+
+
+@observe_mongo("purge_garbage")
 async def purge_garbage(conn: AsyncIOMotorClient) -> int:
     """
-    Purges documents older than GARBAGE_TIMER
-    """
-    all_docs = conn[settings.MDB_DATABASE][settings.MDB_COLLECTION].find({})
-    updates = []
-    async for document in all_docs:
-        if "created_on" in document.keys():
-            created_on = document['created_on']
-            if isinstance(document['created_on'], str):
-                created_on = datetime.datetime.fromisoformat(document['created_on'].replace("Z", "+00:00")).replace(tzinfo=timezone.utc)
-            elif isinstance(document['created_on'], datetime.datetime):
-                created_on = (document['created_on']).replace(tzinfo=timezone.utc)
-            else:
-                raise TypeError
-            if ((datetime.datetime.now(timezone.utc) - created_on).total_seconds() / 60) >= settings.GARBAGE_TIMER:
-                updates.append(DeleteOne({'_id': document["_id"]}))
-
-    if updates:
-        await conn.bulk_write(updates)
-        print(f"Garbage collection purged {len(updates)} documents from the database")
-        return len(updates)
-    return 0
+    Purges documents older than GARBAGE_TIMER with an indexed range delete on created_on
+    """
+    purged = await purge_expired(conn[settings.MDB_DATABASE][settings.MDB_COLLECTION], settings.GARBAGE_TIMER)
+    if purged:
+        print(f"Garbage collection purged {purged} documents from the database")
+    return purged
@@ -0,0 +1,74 @@
+"""
+Expiry of old ReCaptcha jobs
+
+Jobs store created_on as a native BSON date. A TTL index on created_on lets MongoDB delete expired jobs by itself,
+and purge_expired() is an indexed range delete for on-demand purges.
+Only depends on motor/pymongo so /local/server.py can share it.
+"""
+import datetime
+import logging
+from datetime import timezone
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+TTL_INDEX_NAME = "created_on_ttl"
+# IndexOptionsConflict: same key pattern, different expireAfterSeconds
+INDEX_OPTIONS_CONFLICT = 85
+
+logger = logging.getLogger(__name__)
+
+
+def parse_created_on(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+async def migrate_created_on(collection: AsyncIOMotorCollection, batch_size: int = 1000) -> int:
+    """
+    Converts created_on values stored as ISO strings (older create_recaptcha versions) to native dates
+    :return: Number of documents converted
+    """
+    converted = 0
+    updates = []
+    async for document in collection.find({"created_on": {"$type": "string"}}, projection={"created_on": 1}):
+        try:
+            created_on = parse_created_on(document["created_on"])
+        except ValueError:
+            logger.error(f"Unparseable created_on {document['created_on']!r} on {document['_id']}")
+            continue
+        updates.append(UpdateOne({"_id": document["_id"], "created_on": document["created_on"]},
+                                 {"$set": {"created_on": created_on}}))
+        if len(updates) >= batch_size:
+            converted += (await collection.bulk_write(updates, ordered=False)).modified_count
+            updates = []
+    if updates:
+        converted += (await collection.bulk_write(updates, ordered=False)).modified_count
+    if converted:
+        logger.info(f"Converted created_on to a native date on {converted} documents")
+    return converted
+
+
+async def ensure_ttl_index(collection: AsyncIOMotorCollection, garbage_minutes: int):
+    """
+    Creates the created_on TTL index, or updates its expiry if GARBAGE_TIMER changed
+    """
+    expire_after = int(garbage_minutes * 60)
+    try:
+        await collection.create_index([("created_on", 1)], name=TTL_INDEX_NAME, expireAfterSeconds=expire_after)
+    except OperationFailure as of:
+        if of.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        await collection.database.command("collMod", collection.name,
+                                          index={"name": TTL_INDEX_NAME, "expireAfterSeconds": expire_after})
+        logger.info(f"Updated {TTL_INDEX_NAME} expiry to {expire_after}s")
+
+
+async def purge_expired(collection: AsyncIOMotorCollection, garbage_minutes: int) -> int:
+    """
+    Deletes every job created more than garbage_minutes ago with one indexed range delete
+    :return: Number of documents deleted
+    """
+    cutoff = datetime.datetime.now(timezone.utc) - datetime.timedelta(minutes=garbage_minutes)
+    deleted = await collection.delete_many({"created_on": {"$lt": cutoff}})
+    return deleted.deleted_count
+
@@ -0,0 +1,94 @@
+"""
+Index definitions for the jobs and keys collections
+
+ensure_indexes() is idempotent and runs on startup of both FastAPI and /local/server.py.
+Only depends on motor/pymongo so /local/server.py can share it.
+"""
+import logging
+from typing import Dict, List
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from .expiry import ensure_ttl_index, migrate_created_on
+from .job_state import migrate_status
+
+JOB_INDEXES: List[IndexModel] = [
+    # Jobs by status, oldest first. Serves the listener claim ({"status": "pending"} sorted by created_on)
+    IndexModel([("status", ASCENDING), ("created_on", ASCENDING)], name="status_created_on"),
+    # Leased jobs only, for the lease reaper
+    IndexModel([("lease_expires", ASCENDING)], name="lease_expires",
+               partialFilterExpression={"lease_expires": {"$exists": True}}),
+    # Jobs with an undelivered pingback, for the pingback dispatcher claim
+    IndexModel([("pingback_due", ASCENDING)], name="pingback_due",
+               partialFilterExpression={"pingback_status": "pending"}),
+]
+
+# Replaced by a newer definition, dropped by ensure_indexes()
+OBSOLETE_JOB_INDEXES: List[str] = ["pending_created_on"]
+
+KEY_INDEXES: List[IndexModel] = [
+    IndexModel([("key", ASCENDING)], name="key_unique", unique=True),
+    IndexModel([("user", ASCENDING)], name="user"),
+]
+
+logger = logging.getLogger(__name__)
+
+
+async def create_indexes(collection: AsyncIOMotorCollection, indexes: List[IndexModel]) -> List[str]:
+    """
+    Creates each index on its own, so an index that cannot be built (e.g. duplicate keys for a unique index)
+    does not prevent the others
+    :return: Names of the indexes that exist afterwards
+    """
+    created = []
+    for index in indexes:
+        name = index.document["name"]
+        try:
+            await collection.create_indexes([index])
+            created.append(name)
+        except OperationFailure as of:
+            logger.error(f"Could not create index {name} on {collection.name}: {of}")
+    return created
+
+
+async def drop_indexes(collection: AsyncIOMotorCollection, names: List[str]):
+    existing = await collection.index_information()
+    for name in names:
+        if name in existing:
+            await collection.drop_index(name)
+            logger.info(f"Dropped obsolete index {name} on {collection.name}")
+
+
+async def ensure_indexes(jobs: AsyncIOMotorCollection, keys: AsyncIOMotorCollection, garbage_minutes: int):
+    """
+    Declares every index the jobs and keys collections need. Safe to run on every startup and from every node
+    Meant to run in the background, building an index on a large collection can take a while
+    """
+    try:
+        # The TTL index only applies to native dates
+        await migrate_created_on(jobs)
+        await ensure_ttl_index(jobs, garbage_minutes)
+        await drop_indexes(jobs, OBSOLETE_JOB_INDEXES)
+        await create_indexes(jobs, JOB_INDEXES)
+        await create_indexes(keys, KEY_INDEXES)
+        # Older pending jobs are invisible to the listener's status query until they have a status
+        await migrate_status(jobs)
+    except Exception as e:
+        logger.error(f"Could not ensure indexes: {e}")
+
+
+async def index_stats(collection: AsyncIOMotorCollection) -> List[Dict]:
+    """
+    Usage of every index on a collection since the mongod last restarted (or the index was built), from $indexStats
+    :return: [{"name", "key", "ops", "since"}]
+    """
+    stats = []
+    async for index in collection.aggregate([{"$indexStats": {}}]):
+        stats.append({
+            "name": index["name"],
+            "key": dict(index["key"]),
+            "ops": index["accesses"]["ops"],
+            "since": index["accesses"]["since"],
+        })
+    return sorted(stats, key=lambda s: s["name"])
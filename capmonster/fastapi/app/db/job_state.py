@@ -0,0 +1,113 @@
+"""
+ReCaptcha job state machine
+
+    pending -> claimed -> submitted -> solved
+                  |  ^        |------> failed  (critical CapMonster error, or proxy circuit open)
+                  |  |--------|  (attempt failed, retried after a backoff)
+                  |           |------> dead / expired  (SOLVE_ATTEMPTS used up, expired if every attempt timed out)
+                  |<----------|  (lease expired, back to pending)
+
+Every transition writes the status plus a timestamp field, so state is a single equality match on the
+status_created_on index instead of $exists checks. Documents written before the status field existed get one
+from migrate_status(), and infer_status() covers them until the migration has run.
+Only depends on motor/pymongo so /local/server.py can share it.
+"""
+import datetime
+import logging
+from datetime import timezone
+from typing import Optional, Tuple
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from ..schema.common import JobStatusEnum
+
+# Timestamp written on entering a status. pending uses created_on, which is only set on insert
+STATUS_TIMESTAMPS = {
+    JobStatusEnum.claimed: "claimed_on",
+    JobStatusEnum.submitted: "submitted_on",
+    JobStatusEnum.solved: "finished_on",
+    JobStatusEnum.failed: "finished_on",
+    JobStatusEnum.expired: "finished_on",
+    JobStatusEnum.dead: "finished_on",
+}
+
+# Statuses a job never leaves
+FINISHED_STATUSES = frozenset({JobStatusEnum.solved, JobStatusEnum.failed, JobStatusEnum.expired, JobStatusEnum.dead})
+
+# Fields infer_status() and result_2captcha() read, all a status read has to fetch
+STATUS_FIELDS = ("status", "solution", "error", "captcha_id", "in_queue")
+
+# Status of a document without one, by the fields it has. First match wins
+LEGACY_STATUS_RULES = [
+    (JobStatusEnum.solved, {"solution": {"$exists": True}}),
+    (JobStatusEnum.failed, {"error": {"$exists": True}}),
+    (JobStatusEnum.submitted, {"captcha_id": {"$exists": True}}),
+    (JobStatusEnum.claimed, {"in_queue": True}),
+    (JobStatusEnum.pending, {}),
+]
+
+logger = logging.getLogger(__name__)
+
+
+def transition(status: JobStatusEnum, at: Optional[datetime.datetime] = None) -> dict:
+    """
+    $set fields that move a job to status
+    """
+    fields = {"status": status.value}
+    if status in STATUS_TIMESTAMPS:
+        fields[STATUS_TIMESTAMPS[status]] = at or datetime.datetime.now(timezone.utc)
+    return fields
+
+
+def infer_status(document: dict) -> JobStatusEnum:
+    """
+    Status of a job document, derived from its fields if it predates the status field
+    """
+    if document.get("status"):
+        return JobStatusEnum(document["status"])
+    if "solution" in document:
+        return JobStatusEnum.solved
+    if "error" in document:
+        return JobStatusEnum.failed
+    if "captcha_id" in document:
+        return JobStatusEnum.submitted
+    if document.get("in_queue"):
+        return JobStatusEnum.claimed
+    return JobStatusEnum.pending
+
+
+def result_2captcha(document: Optional[dict]) -> Tuple[str, int]:
+    """
+    2Captcha res.php answer (text, HTTP status code) for a job document with at least STATUS_FIELDS, or None if
+    there is no such job
+    """
+    if document is None:
+        return "ERROR_WRONG_CAPTCHA_ID", 404
+    status = infer_status(document)
+    # The job is finished if the solution exists
+    if status == JobStatusEnum.solved:
+        return f"OK|{document.get('solution')}", 200
+    # Claimed by a local CapMonster server.py, or uploaded to CapMonster and not yet solved
+    if status in (JobStatusEnum.claimed, JobStatusEnum.submitted):
+        return "CAPCHA_NOT_READY", 200
+    # Failed, expired or dead-lettered, return the error code/message if there is one
+    if status in (JobStatusEnum.failed, JobStatusEnum.expired, JobStatusEnum.dead):
+        if document.get("error") is not None:
+            return str(document["error"]), 400
+        return "ERROR_CAPTCHA_UNSOLVABLE", 408
+    # The Local CapMonster script has not yet received the captcha job
+    return "CAPCHA_NOT_READY", 425
+
+
+async def migrate_status(collection: AsyncIOMotorCollection) -> int:
+    """
+    Sets status on documents written before the status field existed. Idempotent
+    :return: Number of documents migrated
+    """
+    migrated = 0
+    for status, condition in LEGACY_STATUS_RULES:
+        result = await collection.update_many({"status": {"$exists": False}, **condition},
+                                              {"$set": {"status": status.value}})
+        migrated += result.modified_count
+    if migrated:
+        logger.info(f"Set status on {migrated} documents")
+    return migrated
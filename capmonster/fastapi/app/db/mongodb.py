@@ -1,7 +1,9 @@
 """
 MongoDB
 """
+from typing import Optional
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.write_concern import WriteConcern
 from ..core.config import settings
 
 
@@ -12,6 +14,15 @@ class Database:
 db = Database()
 
 
+def parse_write_concern(value: Optional[str]) -> Optional[WriteConcern]:
+    """
+    WriteConcern from a setting such as "majority", "1" or "0". None (client default from MDB_URI) if empty
+    """
+    if not value:
+        return None
+    return WriteConcern(w=int(value) if value.isdigit() else value)
+
+
 async def get_database() -> AsyncIOMotorClient:
     return db.client
 
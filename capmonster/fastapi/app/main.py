@@ -1,17 +1,37 @@
+import asyncio
 from fastapi import FastAPI
 from starlette.middleware.gzip import GZipMiddleware
 from starlette.requests import Request
 from starlette.responses import Response
 from fastapi.responses import PlainTextResponse
+from prometheus_client import CONTENT_TYPE_LATEST
 from app.core.config import settings
+from app.core.metrics import latest_metrics, mark_worker_dead
 from app.api.api_v1.api import router as endpoint_router
-from app.db.mongodb import close, connect
+from app.core.notifier import job_notifier
+from app.core.pingback import pingback_dispatcher
+from app.core.stream import job_event_hub
+from app.crud.api_key import credit_leases, watch_api_keys
+from app.db.indexes import ensure_indexes
+from app.db.mongodb import close, connect, db
+
+
+class StreamingGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware that leaves the /stream SSE endpoint alone, the gzip buffer would hold its events back
+    """
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/stream"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
 
 app = FastAPI(title=settings.PROJECT_NAME,
               description=settings.APP_DESCRIPTION,
               version=settings.PROJECT_VERSION)
 
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(StreamingGZipMiddleware, minimum_size=1000)
 
 app.include_router(endpoint_router, prefix=settings.API_V1_STR)
 
@@ -22,6 +42,24 @@ async def on_app_start():
     Anything that needs to happen while the app starts
     """
     await connect()
+    # Builds missing indexes (and migrates legacy string dates) without holding up startup
+    app.state.index_task = asyncio.create_task(
+        ensure_indexes(db.client[settings.MDB_DATABASE][settings.MDB_COLLECTION],
+                       db.client[settings.MDB_DATABASE][settings.MDB_COLLECTION_KEYS],
+                       settings.GARBAGE_TIMER))
+    app.state.key_watch_task = None
+    if settings.API_KEY_CACHE_WATCH and settings.API_KEY_CACHE_TTL:
+        app.state.key_watch_task = asyncio.create_task(watch_api_keys(db.client))
+    app.state.credit_lease_task = None
+    if credit_leases.enabled:
+        app.state.credit_lease_task = asyncio.create_task(credit_leases.run(db.client))
+    app.state.pingback_task = None
+    if pingback_dispatcher.enabled:
+        job_notifier.add_listener(pingback_dispatcher.wake)
+        app.state.pingback_task = asyncio.create_task(pingback_dispatcher.run(db.client))
+    app.state.job_watch_task = None
+    if settings.JOB_WAIT_MAX or pingback_dispatcher.enabled:
+        app.state.job_watch_task = asyncio.create_task(job_notifier.run(db.client))
 
 
 @app.on_event("shutdown")
@@ -29,7 +67,19 @@ async def on_app_shutdown():
     """
     Anything that needs to happen while the app shuts down
     """
+    if app.state.key_watch_task:
+        app.state.key_watch_task.cancel()
+    if app.state.job_watch_task:
+        app.state.job_watch_task.cancel()
+    if app.state.pingback_task:
+        app.state.pingback_task.cancel()
+    job_event_hub.stop()
+    if app.state.credit_lease_task:
+        app.state.credit_lease_task.cancel()
+        # Unused leased credits go back to their keys
+        await credit_leases.release(db.client)
     await close()
+    mark_worker_dead()
 
 
 @app.get("/", response_class=PlainTextResponse)
@@ -38,3 +88,11 @@ async def home():
     The home page
     """
     return PlainTextResponse('{"online": True}', status_code=200)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Prometheus metrics, of all workers if PROMETHEUS_MULTIPROCESS_DIR is set
+    """
+    return Response(latest_metrics(), media_type=CONTENT_TYPE_LATEST)
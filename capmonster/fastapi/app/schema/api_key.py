@@ -1,5 +1,6 @@
 import random
 import string
+from typing import Optional
 from pydantic import BaseModel, validator
 
 from app.schema.common import DateTimeModelMixin, DBModelMixin
@@ -18,6 +19,10 @@ class APIKeyCaptcha(APIKeyCaptchaBase):
 class APIKeyCaptchaCreate(APIKeyCaptchaBase, DateTimeModelMixin):
     key: str = None
     credits: int = 10
+    # Scheduling on the local solver (capmonster/local/scheduler.py)
+    weight: int = 1
+    priority: int = 0
+    max_inflight: Optional[int] = None
 
     @validator("key", pre=True, always=True)
     def generate_key(cls, v) -> str:
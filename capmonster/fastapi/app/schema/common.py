@@ -6,6 +6,13 @@ from bson import ObjectId
 from pydantic import BaseModel, BaseConfig, validator, Field, Extra
 
 
+def utc_isoformat(dt: datetime) -> str:
+    """
+    JSON form of stored (UTC) dates, e.g. 2021-09-01T12:00:00Z
+    """
+    return dt.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
+
+
 class PyObjectId(ObjectId):
     @classmethod
     def __get_validators__(cls):
@@ -36,7 +43,7 @@ class ConfigModel(BaseModel):
         allow_population_by_alias = True
         allow_population_by_field_name = True
         json_encoders = {
-            datetime: lambda dt: dt.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z"),
+            datetime: utc_isoformat,
             ObjectId: str
         }
 
@@ -72,3 +79,22 @@ class ProxyTypeEnum(str, Enum):
     https = "HTTPS"
     socks4 = "SOCKS4"
     socks5 = "SOCKS5"
+
+
+class JobStatusEnum(str, Enum):
+    pending = "pending"
+    claimed = "claimed"
+    submitted = "submitted"
+    solved = "solved"
+    failed = "failed"
+    expired = "expired"
+    # Dead-lettered: every solve attempt failed, see the errors field
+    dead = "dead"
+
+
+class PingbackStatusEnum(str, Enum):
+    # Waiting for the job to finish, or for the next delivery attempt
+    pending = "pending"
+    delivered = "delivered"
+    # Every delivery attempt failed
+    failed = "failed"
@@ -1,8 +1,9 @@
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import List, Optional
 from pydantic import BaseModel, validator, Field, Extra, HttpUrl
 
-from ..schema.common import ConfigModel, DateTimeModelMixinTask, DBModelMixin, ProxyTypeEnum
+from ..schema.common import ConfigModel, DateTimeModelMixinTask, DBModelMixin, ProxyTypeEnum, JobStatusEnum, \
+    PingbackStatusEnum
 
 
 class CaptchaBase(ConfigModel):
@@ -27,6 +28,9 @@ class ReCaptcha(CaptchaBase):
     # Base ReCaptcha model
     method: str = "userrecaptcha"
     googlekey: str
+    # Result is POSTed here (id, code) once the job finishes, like 2Captcha's pingback
+    pingback: Optional[HttpUrl]
+    pingback_status: Optional[PingbackStatusEnum]
 
 
 class ReCaptchaCreate(ReCaptcha):
@@ -46,21 +50,37 @@ class ReCaptchaCreate(ReCaptcha):
 
 class ReCaptchaInCreate(ReCaptchaCreate, DateTimeModelMixinTask):
     # Adds DateTimeModelMixinTask field created_on
-    pass
+    status: JobStatusEnum = JobStatusEnum.pending
+    # Earliest next pingback delivery attempt, the job has to be finished too
+    pingback_due: Optional[datetime]
+
+    @validator("pingback_status", always=True)
+    def pending_pingback(cls, v, values):
+        if values.get("pingback"):
+            return PingbackStatusEnum.pending
+        return None
+
+    @validator("pingback_due", always=True)
+    def due_pingback(cls, v, values):
+        if values.get("pingback"):
+            return values.get("created_on") or datetime.now(tz=timezone.utc)
+        return None
 
 
 class ReCaptchaInDb(ReCaptcha, DBModelMixin):
-    # Inserts ID
-    pass
+    # Inserts ID. attempts counts solve attempts started by server.py
+    attempts: Optional[int]
 
 
 class ReCaptchaResponse(ReCaptcha, DateTimeModelMixinTask):
     action: str = "get"
     captcha_id: Optional[int]
-    status: Optional[str]
-    # Either remove status or change error to status
+    status: Optional[JobStatusEnum]
     error: Optional[str]
     in_queue: Optional[bool]
+    attempts: Optional[int]
+    pingback_attempts: Optional[int]
+    pingback_error: Optional[str]
 
 
 class ReCaptchaErrorResponse(ReCaptchaResponse, extra=Extra.allow):
@@ -74,5 +94,16 @@ class ReCaptchaSolved(ReCaptchaResponse, extra=Extra.allow):
     in_queue = False
 
 
+class ReCaptchaBatchItem(ConfigModel):
+    # One job of a batch submit, in request order. id if it was created, error (2Captcha code) if not
+    id: Optional[str]
+    error: Optional[str]
+
+
+class ReCaptchaBatchResponse(ConfigModel):
+    submitted: int
+    results: List[ReCaptchaBatchItem]
+
+
 class ReCaptchaResponse2Captcha(BaseModel):
     response: str = "CAPCHA_NOT_READY"
@@ -1,16 +1,23 @@
 import logging
-from datetime import datetime
 from typing import Union
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorCollection
 import httpx
 import asyncio
 import os
+import time
 from dotenv import find_dotenv, load_dotenv
 from mdb import MongoDB
-from capmonster.fastapi.app.schema.recaptcha import ReCaptchaCreate, ReCaptchaResponse, ReCaptchaSolved, ReCaptchaInDb, \
-    ReCaptchaErrorResponse
-from capmonster.fastapi.app.schema.common import ProxyTypeEnum
+from connections import HTTPX_TIMEOUT
+from poller import ResultPoller
+from endpoints import Endpoint, EndpointPool
+from proxy_health import ProxyCircuitOpen, ProxyHealthTracker
+from leases import LeaseLost, lease_expiry, NODE_ID
+from metrics import POLL_LATENCY, SOLVE_DURATION, SUBMIT_LATENCY
+from capmonster.fastapi.app.schema.recaptcha import ReCaptcha, ReCaptchaCreate, ReCaptchaResponse, ReCaptchaSolved, \
+    ReCaptchaInDb, ReCaptchaErrorResponse, ReCaptchaInCreate
+from capmonster.fastapi.app.schema.common import ProxyTypeEnum, JobStatusEnum
+from capmonster.fastapi.app.db.job_state import transition
 
 """
     Logic for GET/POST requests using 2Captcha API style
@@ -57,21 +64,34 @@ class CaptchaUpload:
     """
 
     def __init__(self, collection: AsyncIOMotorCollection,
-                 key: str = None, waittime: int = None, log=None):
+                 key: str = None, waittime: int = None, log=None, client: httpx.AsyncClient = None,
+                 poller: ResultPoller = None, endpoints: EndpointPool = None, proxies: ProxyHealthTracker = None,
+                 node_id: str = NODE_ID):
 
         self.collection = collection
+        # Job writes only apply while this node holds the job's lease (see leases.py)
+        self.node_id = node_id
+        # Shared keep-alive client (see connections.py). Without one, every request opens a new connection
+        self.client = client
+        # Shared batch poller (see poller.py). Without one, every job polls res.php on its own
+        self.poller = poller
         # self.key = key if key is not None else os.getenv("ROOT_API_KEY")
         self.key = key or os.getenv("ROOT_API_KEY")
         self.first_waittime = waittime or int(os.getenv("CLIENT_INIT_SLEEP"))
         self.waittime = int(os.getenv("CLIENT_RETRY_SLEEP")) or 5
-        self.timeout = int(os.getenv("HTTPX_TIMEOUT")) or 120
+        self.timeout = HTTPX_TIMEOUT
         if log:
             self.log = log
             self.logenabled = True
         else:
             self.logenabled = False
 
-        # 2CaptchaAPI endpoints
+        # CapMonster instances to route solves to (see endpoints.py). Defaults to CAPMONSTER_ENDPOINTS
+        self.endpoints = endpoints or EndpointPool(client=client, key=self.key)
+        # Per-proxy circuit breaker (see proxy_health.py), jobs with a failing proxy are not submitted
+        self.proxies = proxies or ProxyHealthTracker()
+
+        # 2CaptchaAPI endpoints, used when no Endpoint is given
         # CapMonster intercepts DNS for 2captcha.com
         self.api: dict = {
             "url_request": "http://2captcha.com/in.php",
@@ -80,206 +100,303 @@ class CaptchaUpload:
             "get": "http://2captcha.com/res.php",
         }
 
-    async def get_result(self, cap_id) -> str:
+    async def _request(self, method: str, url: str) -> httpx.Response:
+        """
+        Sends a request to CapMonster over the shared client, or a throwaway one if none was injected
+        """
+        started = time.perf_counter()
+        try:
+            if self.client:
+                return await self.client.request(method, url, timeout=self.timeout)
+            async with httpx.AsyncClient() as client:
+                return await client.request(method, url, timeout=self.timeout)
+        finally:
+            (SUBMIT_LATENCY if method == "POST" else POLL_LATENCY).observe(time.perf_counter() - started)
+
+    async def get_result(self, cap_id, endpoint: Endpoint = None) -> str:
         """
         This function checks for CapMonster status/completion and returns the result from CapMonster.
         If CapMonster fails to solve, will raise an error
         :param cap_id: id of the uploaded ReCaptcha job
+        :param endpoint: CapMonster instance the job was uploaded to
         :return: Captcha solution string
         """
-        if self.logenabled:
-            self.log.info(f"[CapMonster] Wait {self.waittime} second..")
-        await asyncio.sleep(self.waittime)
-
-        fullurl = f"{self.api['get']}?key={self.key}&action=get&id={cap_id}"
+        res_url = endpoint.res_url if endpoint else self.api['get']
+        fullurl = f"{res_url}?key={self.key}&action=get&id={cap_id}"
         # logger.info(fullurl)
 
-        if self.logenabled:
-            self.log.info(f"[CapMonster] Get Captcha solved with cap_id {cap_id}")
-        async with httpx.AsyncClient() as client:
-            request = await client.get(fullurl, timeout=self.timeout)
+        while True:
+            if self.logenabled:
+                self.log.info(f"[CapMonster] Wait {self.waittime} second..")
+            await asyncio.sleep(self.waittime)
+
+            if self.logenabled:
+                self.log.info(f"[CapMonster] Get Captcha solved with cap_id {cap_id}")
+            request = await self._request("GET", fullurl)
             # logger.info(f"Request: {request}\t{request.text}")
-            if request.text.split('|')[0] == "OK":
-                return request.text.split('|')[1]
-            elif request.text == "CAPCHA_NOT_READY":
+            if request.text == "CAPCHA_NOT_READY":
                 if self.logenabled:
                     self.log.error(f"[CapMonster] [{cap_id}] CAPTCHA is being solved, "
                                    "repeat the request several seconds later, wait "
                                    f"another {self.waittime} seconds")
-                return await self.get_result(cap_id)
+                continue
+            return self.check_result(cap_id, request.text)
 
-            # ERROR Responses
-            elif request.text == "ERROR_KEY_DOES_NOT_EXIST":
-                if self.logenabled:
-                    self.log.error("[CapMonster] You used the wrong key in the query")
-                raise ReCaptchaError('[CapMonster] You used the wrong key in the query', text=request.text)
+    def check_result(self, cap_id, text: str) -> str:
+        """
+        Interprets a finished res.php response, shared by get_result and the batch ResultPoller
+        :param cap_id: id of the uploaded ReCaptcha job
+        :param text: Response text, either OK|solution or an error code
+        :return: Captcha solution string
+        """
+        if text.split('|')[0] == "OK":
+            return text.split('|')[1]
 
-            elif request.text == "ERROR_WRONG_ID_FORMAT":
-                if self.logenabled:
-                    self.log.error("[CapMonster] Wrong format ID CAPTCHA.\nID must contain only numbers")
-                raise ReCaptchaError('[CapMonster] Wrong format ID CAPTCHA.\nID must contain only numbers.',
-                                     text=request.text)
+        # ERROR Responses
+        if text == "ERROR_KEY_DOES_NOT_EXIST":
+            if self.logenabled:
+                self.log.error("[CapMonster] You used the wrong key in the query")
+            raise ReCaptchaError('[CapMonster] You used the wrong key in the query', text=text)
 
-            elif request.text == "ERROR_CAPTCHA_UNSOLVABLE":
-                if self.logenabled:
-                    self.log.error("[CapMonster] After three attempts the captcha was still unsolved.")
-                raise ReCaptchaError('[CapMonster] After three attempts the captcha was still unsolved.',
-                                     text=request.text)
+        elif text == "ERROR_WRONG_ID_FORMAT":
+            if self.logenabled:
+                self.log.error("[CapMonster] Wrong format ID CAPTCHA.\nID must contain only numbers")
+            raise ReCaptchaError('[CapMonster] Wrong format ID CAPTCHA.\nID must contain only numbers.',
+                                 text=text)
 
-            elif "ERROR_RECAPTCHA_TIMEOUT" in request.text:
-                if self.logenabled:
-                    self.log.error("[CapMonster] TimeOut error, probably a bad proxy.")
-                raise ReCaptchaError('[CapMonster] TimeOut error, probably a bad proxy.',
-                                     text=request.text)
+        elif text == "ERROR_CAPTCHA_UNSOLVABLE":
+            if self.logenabled:
+                self.log.error("[CapMonster] After three attempts the captcha was still unsolved.")
+            raise ReCaptchaError('[CapMonster] After three attempts the captcha was still unsolved.',
+                                 text=text)
 
-            elif "ERROR_PROXY_BANNED" in request.text:
-                if self.logenabled:
-                    self.log.error("[CapMonster] Your proxy is banned and cannot be used to solve the recaptcha.")
-                raise ReCaptchaError('[CapMonster] Proxy is banned.',
-                                     text=request.text)
-            elif "ERROR_PROXY_FORMAT" == request.text:
-                if self.logenabled:
-                    self.log.error("[CapMonster] Malformed proxy format")
-                raise ReCaptchaError('[CapMonster] Malformed proxy format', text=request.text)
-            elif "ERROR" == request.text:
-                if self.logenabled:
-                    self.log.error("[CapMonster] Error message simply 'ERROR', likely malformed URL")
-                raise ReCaptchaError('[CapMonster] Error message simply "Error"', text=request.text)
-            elif "ERROR_RECAPTCHA_INVALID_SITEKEY" == request.text:
-                if self.logenabled:
-                    self.log.error("[CapMonster] SITEKEY Authentication is Invalid")
-                raise ReCaptchaError('[CapMonster] SITEKEY Authentication is Invalid', text=request.text)
-            else:
-                if self.logenabled:
-                    self.log.error(f"[CapMonster] Unexpected error response type: {request.text}")
-                    self.log.error(f"{request}")
-                raise ReCaptchaError(f'[CapMonster] Unexpected error response type: {request.text}.',
-                                     text=request.text)
+        elif "ERROR_RECAPTCHA_TIMEOUT" in text:
+            if self.logenabled:
+                self.log.error("[CapMonster] TimeOut error, probably a bad proxy.")
+            raise ReCaptchaError('[CapMonster] TimeOut error, probably a bad proxy.',
+                                 text=text)
+
+        elif "ERROR_PROXY_BANNED" in text:
+            if self.logenabled:
+                self.log.error("[CapMonster] Your proxy is banned and cannot be used to solve the recaptcha.")
+            raise ReCaptchaError('[CapMonster] Proxy is banned.',
+                                 text=text)
+        elif "ERROR_PROXY_FORMAT" == text:
+            if self.logenabled:
+                self.log.error("[CapMonster] Malformed proxy format")
+            raise ReCaptchaError('[CapMonster] Malformed proxy format', text=text)
+        elif "ERROR" == text:
+            if self.logenabled:
+                self.log.error("[CapMonster] Error message simply 'ERROR', likely malformed URL")
+            raise ReCaptchaError('[CapMonster] Error message simply "Error"', text=text)
+        elif "ERROR_RECAPTCHA_INVALID_SITEKEY" == text:
+            if self.logenabled:
+                self.log.error("[CapMonster] SITEKEY Authentication is Invalid")
+            raise ReCaptchaError('[CapMonster] SITEKEY Authentication is Invalid', text=text)
+        else:
+            if self.logenabled:
+                self.log.error(f"[CapMonster] Unexpected error response type: {text}")
+            raise ReCaptchaError(f'[CapMonster] Unexpected error response type: {text}.',
+                                 text=text)
+
+    def build_upload_url(self, recapcha: ReCaptcha, endpoint: Endpoint = None) -> str:
+        """
+        Builds the in.php url for a recaptcha, raising ReCaptchaError if required parameters are missing
+        """
+        if not (recapcha.googlekey and recapcha.pageurl and 'http' in recapcha.pageurl):
+            if self.logenabled:
+                self.log.error("[CapMonster] One or more parameters was incorrect")
+            raise ReCaptchaError(f'[CapMonster] One or more parameters was incorrect',
+                                 text="One or more parameters was incorrect")
+        in_url = endpoint.in_url if endpoint else self.api['post']
+        full_url = f"{in_url}?key={self.key}&method={recapcha.method}&googlekey={recapcha.googlekey}&pageurl={recapcha.pageurl}"
+        if recapcha.proxy and recapcha.proxytype:
+            full_url = f"{full_url}&proxy={recapcha.proxy}&proxytype={recapcha.proxytype}"
+        elif recapcha.proxy:
+            # Assume HTTP proxy by default
+            full_url = f"{full_url}&proxy={recapcha.proxy}&proxytype=HTTP"
+        return full_url
+
+    async def upload(self, full_url: str) -> str:
+        """
+        Submits a captcha to CapMonster
+        :param full_url: in.php url from build_upload_url
+        :return: CapMonster captcha id
+        """
+        request = await self._request("POST", full_url)
+        text = request.text
+        if not text:
+            logger.error("BAD REQUEST")
+            raise ReCaptchaError(f'[CapMonster] BAD REQUEST', text="BAD REQUEST")
+        if text.split('|')[0] == "OK":
+            if self.logenabled:
+                self.log.info("[CapMonster] Upload Ok")
+            # Received Job ID
+            return text.split('|')[1]
+        elif text == "ERROR_WRONG_USER_KEY":
+            if self.logenabled:
+                self.log.error(
+                    "[CapMonster] Wrong 'key' parameter format, it should contain 32 symbols")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_KEY_DOES_NOT_EXIST":
+            if self.logenabled:
+                self.log.error("[CapMonster] The 'key' doesn't exist")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_ZERO_BALANCE":
+            if self.logenabled:
+                self.log.error("[CapMonster] Your account balance is empty.")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_NO_SLOT_AVAILABLE":
+            if self.logenabled:
+                self.log.error("[CapMonster] The current bid is higher than the maximum bid set for "
+                               "your account.")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_ZERO_CAPTCHA_FILESIZE":
+            if self.logenabled:
+                self.log.error("[CapMonster] CAPTCHA size is too small (less than 100 bites)")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_TOO_BIG_CAPTCHA_FILESIZE":
+            if self.logenabled:
+                self.log.error("[CapMonster] CAPTCHA size is too large (is more than 100kb)")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_WRONG_FILE_EXTENSION":
+            if self.logenabled:
+                self.log.error("[CapMonster] The CAPTCHA has a wrong extension. Allowed extensions "
+                               "are: jpg,jpeg,gif,png")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_IMAGE_TYPE_NOT_SUPPORTED":
+            if self.logenabled:
+                self.log.error("[CapMonster] The server cannot recognize the CAPTCHA file type."
+                               "Allowed extensions are: jpg,jpeg,gif,png")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "ERROR_IP_NOT_ALLOWED":
+            if self.logenabled:
+                self.log.error("[CapMonster] The request has sent "
+                               "from the IP that is not on the list of"
+                               " your IPs.")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        elif text == "IP_BANNED":
+            if self.logenabled:
+                self.log.error("[CapMonster] The IP address you're"
+                               " trying to access the server with is "
+                               "banned due to many frequent attempts "
+                               "to access the server using wrong "
+                               "authorization keys.")
+            raise ReCaptchaError(f'[CapMonster] {text}', text=text)
+        else:
+            if self.logenabled:
+                self.log.error(f"[CapMonster] Unexpected upload response: {text}")
+            raise ReCaptchaError(f'[CapMonster] Unexpected upload response: {text}', text=text)
+
+    async def wait_result(self, job_id: str, endpoint: Endpoint = None) -> str:
+        """
+        Waits for CapMonster to finish an uploaded captcha, through the shared poller if there is one
+        :param endpoint: CapMonster instance the job was uploaded to
+        :return: Captcha solution string
+        """
+        with SOLVE_DURATION.time():
+            await asyncio.sleep(self.first_waittime)
+            if not self.poller:
+                return await self.get_result(job_id, endpoint)
+            res_url = endpoint.res_url if endpoint else self.api['get']
+            text = await self.poller.wait(job_id, res_url)
+        return self.check_result(job_id, text)
+
+    async def solve_token(self, recapcha: ReCaptcha) -> str:
+        """
+        Solves a recaptcha without touching the DB, e.g. to pre-solve tokens for the warm pool
+        :return: Captcha solution string
+        """
+        await self.proxies.admit(recapcha.proxy)
+        async with self.proxies.track(recapcha.proxy), self.endpoints.route() as endpoint:
+            return await self.wait_result(await self.upload(self.build_upload_url(recapcha, endpoint)), endpoint)
+
+    async def update_job(self, _id, update: dict):
+        """
+        Updates a job this node has claimed, fenced by its lease so a node whose lease was reaped cannot overwrite
+        the job another node now owns
+        :raises LeaseLost: The job is no longer leased by this node
+        """
+        updated = await self.collection.update_one({"_id": ObjectId(_id), "lease_owner": self.node_id}, update)
+        if not updated.matched_count:
+            raise LeaseLost(_id)
+
+    async def save_solution(self, _id, recapcha_upload: ReCaptchaResponse, solution: str) -> ReCaptchaSolved:
+        """
+        Writes a solution to the job document
+        :raises LeaseLost: The job is no longer leased by this node, nothing was written
+        """
+        solved = transition(JobStatusEnum.solved)
+        recapcha_answer = ReCaptchaSolved(solution=solution, **solved,
+                                          **recapcha_upload.dict(exclude_none=True,
+                                                                 exclude={"cap_id", "status", "finished_on"}))
+        # created_on is left alone, it is the job's pending timestamp and drives expiry
+        await self.update_job(_id, {"$set": recapcha_answer.dict(exclude_none=True, exclude={"cap_id", "created_on"})})
+        return recapcha_answer
 
     async def solve_recaptcha(self, recapcha: Union[ReCaptchaCreate, ReCaptchaInDb]) -> Union[
         ReCaptchaSolved, ReCaptchaErrorResponse]:
         """
         The function to handle, upload, solve, and update a recaptcha
-        :param recapcha: Pydantic instance of either ReCaptchaCreate or ReCaptchaInDb.
+        :param recapcha: Pydantic instance of either ReCaptchaCreate or ReCaptchaInDb, claimed by this node
         :return: The ReCaptchaSolved object that was written to the CloudDB
+        :raises LeaseLost: The job's lease was lost, the job belongs to the pending pool or another node now
         """
-        if recapcha.googlekey and recapcha.pageurl and 'http' in recapcha.pageurl:
-            full_url = f"{self.api['post']}?key={self.key}&method={recapcha.method}&googlekey={recapcha.googlekey}&pageurl={recapcha.pageurl}"
-            if recapcha.proxy and recapcha.proxytype:
-                full_url = f"{full_url}&proxy={recapcha.proxy}&proxytype={recapcha.proxytype}"
-            elif recapcha.proxy:
-                # Assume HTTP proxy by default
-                full_url = f"{full_url}&proxy={recapcha.proxy}&proxytype=HTTP"
-            logger.info(full_url)
-            # If type ReCaptchaCreate, job is not yet in DB with valid cap_id
-            if type(recapcha) == ReCaptchaCreate:
-                if self.logenabled:
-                    self.log.info(f"Model is ReCaptchaCreate and does not have an _id, adding new DB entry")
-                captcha_job = await self.collection.insert_one(recapcha.dict(exclude_none=True))
-                _id = captcha_job.inserted_id
-            else:
-                _id = recapcha.id
-            if self.logenabled:
-                self.log.info(f"Working on _id {_id}")
+        # Raises on missing parameters before anything is written
+        self.build_upload_url(recapcha)
+        # If type ReCaptchaCreate, job is not yet in DB with valid cap_id
+        if type(recapcha) == ReCaptchaCreate:
             if self.logenabled:
-                self.log.info(f"[CapMonster] Built url: {full_url} for DB _id {_id}")
-            async with httpx.AsyncClient() as client:
-                request = await client.post(full_url, timeout=self.timeout)
-                if request.text:
-                    if request.text.split('|')[0] == "OK":
-                        if self.logenabled:
-                            self.log.info("[CapMonster] Upload Ok")
-                        # Received Job ID
-                        job_id = request.text.split('|')[1]
-                        recapcha_upload = ReCaptchaResponse(captcha_id=job_id, **recapcha.dict())
-
-                        # Previously used exclude={"captcha_id"} because client.py used this as the job identifier
-                        # Since switched to ObjectId which does not change when SOLVE_ATTEMPTS > 1
-                        await self.collection.update_one({"_id": ObjectId(_id)},
-                                                         {"$set": recapcha_upload.dict(exclude_none=True)}
-                                                         )
-                        try:
-                            await asyncio.sleep(self.first_waittime)
-                            solution = await self.get_result(job_id)
-                        except ReCaptchaError as rce:
-                            logger.error(f"{rce.message}\t{rce.text}")
-                            if any(rce.text == critical_error for critical_error in CRITICAL_ERRORS):
-                                recapcha_error = ReCaptchaErrorResponse(finished_on=datetime.now(),
-                                                                        error=rce.text,
-                                                                        **recapcha_upload.dict(exclude_none=True,
-                                                                                               exclude={"cap_id"}))
-                                await self.collection.update_one({"_id": ObjectId(_id)},
-                                                                 {"$set": recapcha_error.dict(exclude_none=True,
-                                                                                              exclude={"cap_id"})})
-                                return recapcha_error
-                            raise
-
-                        recapcha_answer = ReCaptchaSolved(solution=solution, finished_on=datetime.now(),
-                                                          **recapcha_upload.dict(exclude_none=True, exclude={"cap_id"}))
-                        await self.collection.update_one({"_id": ObjectId(_id)},
-                                                         {"$set": recapcha_answer.dict(exclude_none=True,
-                                                                                       exclude={"cap_id"})}
-                                                         )
-                        return recapcha_answer
-
-                    elif request.text == "ERROR_WRONG_USER_KEY":
-                        if self.logenabled:
-                            self.log.error(
-                                "[CapMonster] Wrong 'key' parameter format, it should contain 32 symbols")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_KEY_DOES_NOT_EXIST":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] The 'key' doesn't exist")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_ZERO_BALANCE":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] Your account balance is empty.")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_NO_SLOT_AVAILABLE":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] The current bid is higher than the maximum bid set for "
-                                           "your account.")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_ZERO_CAPTCHA_FILESIZE":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] CAPTCHA size is too small (less than 100 bites)")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_TOO_BIG_CAPTCHA_FILESIZE":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] CAPTCHA size is too large (is more than 100kb)")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_WRONG_FILE_EXTENSION":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] The CAPTCHA has a wrong extension. Allowed extensions "
-                                           "are: jpg,jpeg,gif,png")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_IMAGE_TYPE_NOT_SUPPORTED":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] The server cannot recognize the CAPTCHA file type."
-                                           "Allowed extensions are: jpg,jpeg,gif,png")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "ERROR_IP_NOT_ALLOWED":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] The request has sent "
-                                           "from the IP that is not on the list of"
-                                           " your IPs.")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                    elif request.text == "IP_BANNED":
-                        if self.logenabled:
-                            self.log.error("[CapMonster] The IP address you're"
-                                           " trying to access the server with is "
-                                           "banned due to many frequent attempts "
-                                           "to access the server using wrong "
-                                           "authorization keys.")
-                        raise ReCaptchaError(f'[CapMonster] {request.text}', text=request.text)
-                else:
-                    logger.error("BAD REQUEST")
-                    raise ReCaptchaError(f'[CapMonster] BAD REQUEST', text="BAD REQUEST")
+                self.log.info(f"Model is ReCaptchaCreate and does not have an _id, adding new DB entry")
+            # Inserted already claimed by this node, so the listener leaves it alone
+            captcha_job = await self.collection.insert_one({**ReCaptchaInCreate(**recapcha.dict()).dict(),
+                                                            **transition(JobStatusEnum.claimed), "in_queue": True,
+                                                            "lease_owner": self.node_id,
+                                                            "lease_expires": lease_expiry()})
+            _id = captcha_job.inserted_id
         else:
+            _id = recapcha.id
+        if self.logenabled:
+            self.log.info(f"Working on _id {_id}")
+
+        try:
+            await self.proxies.admit(recapcha.proxy)
+        except ProxyCircuitOpen as pco:
+            # Fails without taking a CapMonster slot, the proxy has been failing for other jobs
+            logger.error(f"{pco.message}\t{_id}")
+            failed = transition(JobStatusEnum.failed)
+            await self.update_job(_id, {"$set": {"error": pco.text, "in_queue": False, **failed}})
+            return ReCaptchaErrorResponse(error=pco.text, **failed,
+                                          **recapcha.dict(exclude_none=True, exclude={"id", "status"}))
+
+        # The job stays on one CapMonster instance from upload to result
+        async with self.proxies.track(recapcha.proxy), self.endpoints.route() as endpoint:
+            # Not the url itself, it carries the CapMonster key and the proxy credentials
+            job_id = await self.upload(self.build_upload_url(recapcha, endpoint))
+            logger.info(f"Job {_id} uploaded to {endpoint.name} as captcha {job_id}")
             if self.logenabled:
-                self.log.error("[CapMonster] One or more parameters was incorrect")
-            raise ReCaptchaError(f'[CapMonster] One or more parameters was incorrect',
-                                 text="One or more parameters was incorrect")
+                self.log.info(f"[CapMonster] Uploaded DB _id {_id} to {endpoint.name} as captcha {job_id}")
+            submitted = transition(JobStatusEnum.submitted)
+            recapcha_upload = ReCaptchaResponse(captcha_id=job_id, status=submitted["status"], **recapcha.dict())
+
+            # Previously used exclude={"captcha_id"} because client.py used this as the job identifier
+            # Since switched to ObjectId which does not change when SOLVE_ATTEMPTS > 1
+            await self.update_job(_id, {"$set": {**recapcha_upload.dict(exclude_none=True, exclude={"created_on"}),
+                                                 **submitted}})
+            try:
+                solution = await self.wait_result(job_id, endpoint)
+            except ReCaptchaError as rce:
+                logger.error(f"{rce.message}\t{rce.text}")
+                if any(rce.text == critical_error for critical_error in CRITICAL_ERRORS):
+                    recapcha_error = ReCaptchaErrorResponse(error=rce.text, **transition(JobStatusEnum.failed),
+                                                            **recapcha_upload.dict(exclude_none=True,
+                                                                                   exclude={"cap_id", "status"}))
+                    await self.update_job(_id, {"$set": recapcha_error.dict(exclude_none=True,
+                                                                            exclude={"cap_id", "created_on"})})
+                    return recapcha_error
+                raise
+
+        return await self.save_solution(_id, recapcha_upload, solution)
 
 
 async def test_captcha_solver():
@@ -1,6 +1,8 @@
 import asyncio
 import os
+import time
 from pprint import pprint
+from typing import List
 import httpx
 from bson import ObjectId
 from dotenv import load_dotenv, find_dotenv
@@ -12,7 +14,7 @@ from pathlib import Path
 fastpath = Path(__file__).resolve().parent.parent.parent
 sys.path.append(str(fastpath))
 from mdb import MongoDB
-from capmonster.fastapi.app.schema.recaptcha import ProxyTypeEnum, ReCaptchaCreate
+from capmonster.fastapi.app.schema.recaptcha import ProxyTypeEnum, ReCaptchaInCreate, ReCaptchaCreate
 
 """
     Example of a client script to request and wait for ReCaptcha solves from server.py
@@ -28,6 +30,8 @@ ROOT_API_KEY: str = str(os.getenv("ROOT_API_KEY"))
 # Uses same sleep settings as the captcha_solver get result
 INITIAL_WAIT: int = int(os.getenv("CLIENT_INIT_SLEEP")) or 3
 RETRY_WAIT: int = int(os.getenv("CLIENT_RETRY_SLEEP")) or 3
+# Seconds the FastAPI /2captcha endpoint holds each request until the job finishes (0 polls every RETRY_WAIT)
+CLIENT_WAIT: int = int(os.getenv("CLIENT_WAIT", 55))
 
 # Set timeout to max possible time
 HTTP_TIMEOUT: int = int(os.getenv("HTTPX_TIMEOUT")) or 120
@@ -66,31 +70,30 @@ async def check_for_solution_local(mdb_id: ObjectId, collection: AsyncIOMotorCol
 
 async def check_for_solution_fastapi(mdb_id: str, fastapi_endpoint_url: str) -> str:
     """
-
+    Waits for a solution through the FastAPI /2captcha endpoint. With CLIENT_WAIT each request is held by the API
+    until the job finishes, so the answer arrives as soon as it is solved instead of on the next poll
     """
-    # Captcha solving takes time, initial wait of 30 seconds
-    await asyncio.sleep(25)
-    # Loop through the max number of times that 3x timeouts could take
-    for _ in range(int(TIMEOUT / RETRY_WAIT)):
-        await asyncio.sleep(RETRY_WAIT)
-
-        fullurl = f"{fastapi_endpoint_url}?key={ROOT_API_KEY}&action=get&id={mdb_id}"
-        print(f"[2CaptchaUpload] Get Captcha with id {mdb_id}")
-        async with httpx.AsyncClient() as client:
-            request = await client.get(fullurl, timeout=60)
+    fullurl = f"{fastapi_endpoint_url}?key={ROOT_API_KEY}&action=get&id={mdb_id}&wait={CLIENT_WAIT}"
+    deadline = time.monotonic() + TIMEOUT
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            print(f"[2CaptchaUpload] Get Captcha with id {mdb_id}")
+            started = time.monotonic()
+            request = await client.get(fullurl, timeout=CLIENT_WAIT + 60)
             print(request.text)
 
             # Ensure captcha is solved before returning key or errors
-            while request.text == "CAPCHA_NOT_READY":
-                await asyncio.sleep(RETRY_WAIT)
-                request = await client.get(fullurl, timeout=60)
-                print(request.text)
+            if request.text == "CAPCHA_NOT_READY":
+                # Answered right away: waiting is disabled (or not supported) by the API, poll instead
+                if time.monotonic() - started < RETRY_WAIT:
+                    await asyncio.sleep(RETRY_WAIT)
+                continue
 
             if request.text.split('|')[0] == "OK":
                 return request.text.split('|')[1]
             else:
                 print("Handle response errors here")
-                raise CaptchaSolveError
+                raise CaptchaSolveError(message=request.text)
 
     raise TimeoutError
 
@@ -104,11 +107,27 @@ async def submit_job(collection: AsyncIOMotorCollection,
     """
     Submits the job requirements to the MongoDB Atlas
     """
-    recapcha = ReCaptchaCreate(pageurl=pageurl, googlekey=googlekey, proxy=proxy, proxytype=proxytype, api_key=api_key)
+    # ReCaptchaInCreate adds created_on as a native date, used for ordering and expiry
+    recapcha = ReCaptchaInCreate(pageurl=pageurl, googlekey=googlekey, proxy=proxy, proxytype=proxytype,
+                                 api_key=api_key)
     captcha_job = await collection.insert_one(recapcha.dict(exclude_none=True))
     return captcha_job.inserted_id
 
 
+async def submit_jobs(fastapi_endpoint_url: str, jobs: List[ReCaptchaCreate]) -> List[dict]:
+    """
+    Submits many jobs with one request to the FastAPI /submit/batch endpoint
+    :param fastapi_endpoint_url: API base, e.g. https://api.example.com/api/v1
+    :param jobs: Jobs to create, each with its own api_key
+    :return: One {"id": ...} or {"error": ...} per job, in order
+    """
+    payload = [job.dict(exclude_none=True) for job in jobs]
+    async with httpx.AsyncClient() as client:
+        request = await client.post(f"{fastapi_endpoint_url}/submit/batch", json=payload, timeout=HTTP_TIMEOUT)
+        request.raise_for_status()
+        return request.json()["results"]
+
+
 async def get_captcha_answer(pageurl: str,
                              googlekey: str,
                              proxy: str = None,
@@ -145,8 +164,8 @@ async def client_example_local():
     db = MongoDB()
     collection = await db.get_collection()
 
-    recapcha = ReCaptchaCreate(api_key=ROOT_API_KEY, pageurl=TEST_URL, googlekey=TEST_GOOGLEKEY,
-                               proxy=TEST_PROXY, proxytype=ProxyTypeEnum["http"])
+    recapcha = ReCaptchaInCreate(api_key=ROOT_API_KEY, pageurl=TEST_URL, googlekey=TEST_GOOGLEKEY,
+                                 proxy=TEST_PROXY, proxytype=ProxyTypeEnum["http"])
 
     captcha_job = await collection.insert_one(recapcha.dict(exclude_none=True))
     print(f"Hold on to {captcha_job.inserted_id} and query DB to check if updated")
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Optional
+from dotenv import load_dotenv, find_dotenv
+
+"""
+    Adaptive (AIMD) concurrency limit for CapMonster solves
+
+    The in-flight limit grows by roughly one slot per limit-many fast solves (additive increase) while solve latency
+    stays near its baseline, and is multiplied by AIMD_BACKOFF (multiplicative decrease) on ERROR_NO_SLOT_AVAILABLE,
+    timeouts, or latency rising above AIMD_LATENCY_TOLERANCE x baseline.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+AIMD_MIN: int = int(os.getenv("AIMD_MIN", 1))
+AIMD_INITIAL: int = int(os.getenv("AIMD_INITIAL", 3))
+# Multiplier applied to the limit when CapMonster is overloaded
+AIMD_BACKOFF: float = float(os.getenv("AIMD_BACKOFF", 0.7))
+# Latency above baseline * tolerance counts as overload
+AIMD_LATENCY_TOLERANCE: float = float(os.getenv("AIMD_LATENCY_TOLERANCE", 1.5))
+# Seconds after a decrease during which further overload signals are ignored
+AIMD_COOLDOWN: float = float(os.getenv("AIMD_COOLDOWN", 10))
+
+# CapMonster responses that mean "send less"
+OVERLOAD_ERRORS = [
+    "ERROR_NO_SLOT_AVAILABLE",
+    "TimeoutError",
+]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class AIMDLimiter:
+    """
+    Async semaphore whose size follows CapMonster's observed capacity
+
+        await limiter.acquire()
+        try:
+            started = time.monotonic()
+            await captcha.solve_recaptcha(job)
+            limiter.on_success(time.monotonic() - started)
+        except ...:
+            limiter.on_overload("ERROR_NO_SLOT_AVAILABLE")
+        finally:
+            limiter.release()
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = AIMD_MIN, initial: int = AIMD_INITIAL,
+                 backoff: float = AIMD_BACKOFF, latency_tolerance: float = AIMD_LATENCY_TOLERANCE,
+                 cooldown: float = AIMD_COOLDOWN, smoothing: float = 0.2):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit: float = float(min(max(initial, self.min_limit), self.max_limit))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.in_flight = 0
+        # Exponentially weighted solve latency and the lowest value it has reached (the no-load baseline)
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def available(self) -> int:
+        """
+        Number of slots that can be acquired right now
+        """
+        return max(0, int(self.limit) - self.in_flight - len(self._waiters))
+
+    def snapshot(self) -> dict:
+        return {"limit": int(self.limit), "in_flight": self.in_flight, "waiting": len(self._waiters),
+                "latency": self.latency, "baseline": self.baseline}
+
+    async def acquire(self):
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was handed over just before cancellation, give it back
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def on_success(self, latency: float):
+        """
+        Records a finished solve. Grows the limit while latency stays near the baseline
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        else:
+            # Let the baseline drift up slowly so one lucky fast solve does not pin it forever
+            self.baseline += 0.01 * (self.latency - self.baseline)
+
+        if self.latency > self.baseline * self.latency_tolerance:
+            self.on_overload(f"latency {self.latency:.1f}s > baseline {self.baseline:.1f}s")
+        elif self.limit < self.max_limit:
+            self._set_limit(self.limit + 1 / self.limit)
+
+    def on_overload(self, reason: str):
+        """
+        Shrinks the limit on a slot error, timeout or latency spike. At most once per cooldown
+        """
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self._set_limit(self.limit * self.backoff, reason)
+
+    def _set_limit(self, limit: float, reason: str = None):
+        previous = int(self.limit)
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        if int(self.limit) != previous:
+            logger.info(f"Concurrency limit {previous} -> {int(self.limit)}" + (f" ({reason})" if reason else ""))
+        self._wake()
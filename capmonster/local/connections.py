@@ -0,0 +1,64 @@
+import logging
+import os
+import httpx
+from motor.motor_asyncio import AsyncIOMotorCollection
+from dotenv import load_dotenv, find_dotenv
+
+from mdb import MongoDB
+
+"""
+    Process-wide connection pools for the local solver
+
+    One Motor client (and its TLS connection pool to Atlas) and one keep-alive httpx client to CapMonster are created
+    at startup, shared by the listener, workers and CaptchaUpload, and closed once on shutdown.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# Max simultaneous connections to CapMonster. Should be >= SERVER_WORKERS
+HTTP_MAX_CONNECTIONS: int = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+# Idle connections kept open to CapMonster between requests
+HTTP_MAX_KEEPALIVE: int = int(os.getenv("HTTP_MAX_KEEPALIVE", 10))
+# Seconds an idle keep-alive connection stays open
+HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+# Seconds before a request to CapMonster times out, for every module of the local solver
+HTTPX_TIMEOUT: int = int(os.getenv("HTTPX_TIMEOUT", 120))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Connections:
+    """
+    Owns the shared MongoDB and HTTP clients. Use as an async context manager:
+
+        async with Connections() as connections:
+            collection = await connections.get_collection()
+            captcha = CaptchaUpload(collection, client=connections.http)
+    """
+
+    def __init__(self, mongo: MongoDB = None, http: httpx.AsyncClient = None):
+        self.mongo = mongo or MongoDB()
+        self.http = http or httpx.AsyncClient(
+            timeout=HTTPX_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        )
+
+    async def get_collection(self, collection: str = None) -> AsyncIOMotorCollection:
+        """
+        Returns a collection on the shared Motor client, defaults to MDB_COLLECTION
+        """
+        return await self.mongo.get_collection(collection=collection)
+
+    async def close(self):
+        await self.http.aclose()
+        self.mongo.client.close()
+        logger.info("Closed MongoDB and CapMonster connection pools")
+
+    async def __aenter__(self) -> "Connections":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
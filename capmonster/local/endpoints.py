@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, List, Optional
+import httpx
+from dotenv import load_dotenv, find_dotenv
+
+from connections import HTTPX_TIMEOUT
+
+"""
+    Pool of CapMonster instances for one server.py
+
+    Each solve is routed to the healthy endpoint with the fewest outstanding captchas, and stays on it from in.php
+    to the last res.php poll (captcha ids are local to an instance). Endpoints are addressed by host:port, so no
+    hosts-file interception of 2captcha.com is needed. An endpoint is ejected after ENDPOINT_EJECT_FAILURES
+    consecutive connection errors/HTTP timeouts, or immediately on ERROR_NO_SLOT_AVAILABLE, and is probed every
+    ENDPOINT_PROBE_INTERVAL seconds to bring it back. While no endpoint is healthy the listener stops claiming jobs.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# Comma separated CapMonster addresses, e.g. 192.168.1.20:80,192.168.1.21:80
+# Empty keeps the old behaviour of one CapMonster intercepting 2captcha.com
+CAPMONSTER_ENDPOINTS: str = os.getenv("CAPMONSTER_ENDPOINTS", "")
+# Max captchas in flight per endpoint, 0 for no limit. Roughly the CapMonster thread count
+ENDPOINT_MAX_OUTSTANDING: int = int(os.getenv("ENDPOINT_MAX_OUTSTANDING", 0))
+# Seconds between health probes
+ENDPOINT_PROBE_INTERVAL: int = int(os.getenv("ENDPOINT_PROBE_INTERVAL", 10))
+# Consecutive failures before an endpoint is ejected, and seconds it stays ejected
+ENDPOINT_EJECT_FAILURES: int = int(os.getenv("ENDPOINT_EJECT_FAILURES", 3))
+ENDPOINT_EJECT_SECONDS: int = int(os.getenv("ENDPOINT_EJECT_SECONDS", 30))
+
+# Endpoint answered, but has no capacity right now
+SATURATED_ERRORS = ["ERROR_NO_SLOT_AVAILABLE"]
+# Endpoint did not answer (httpx.TimeoutException is a TransportError)
+FAILURE_EXCEPTIONS = (httpx.TransportError, ConnectionError)
+# Endpoint answered every poll, the captcha just was not solved within POLLER_MAX_WAIT. Says nothing about its health
+NEUTRAL_EXCEPTIONS = (TimeoutError,)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Endpoint:
+    """
+    One CapMonster instance and its routing state
+    """
+    __slots__ = ("name", "in_url", "res_url", "outstanding", "failures", "ejected_until")
+
+    def __init__(self, address: str):
+        base = address.rstrip("/") if "://" in address else f"http://{address.rstrip('/')}"
+        self.name = address
+        self.in_url = f"{base}/in.php"
+        self.res_url = f"{base}/res.php"
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+
+def parse_endpoints(raw: str = CAPMONSTER_ENDPOINTS) -> List[Endpoint]:
+    addresses = [address.strip() for address in raw.split(",") if address.strip()]
+    return [Endpoint(address) for address in addresses or ["2captcha.com"]]
+
+
+class EndpointPool:
+    """
+    Least-outstanding routing with passive (solve results) and active (probe) health checks
+
+        async with pool.route() as endpoint:
+            cap_id = await captcha.upload(captcha.build_upload_url(job, endpoint))
+            solution = await captcha.wait_result(cap_id, endpoint)
+    """
+
+    def __init__(self, endpoints: List[Endpoint] = None, client: httpx.AsyncClient = None, key: str = None,
+                 max_outstanding: int = ENDPOINT_MAX_OUTSTANDING, probe_interval: int = ENDPOINT_PROBE_INTERVAL,
+                 eject_failures: int = ENDPOINT_EJECT_FAILURES, eject_seconds: int = ENDPOINT_EJECT_SECONDS):
+        self.endpoints = endpoints or parse_endpoints()
+        self.client = client
+        self.key = key or os.getenv("ROOT_API_KEY")
+        self.max_outstanding = max_outstanding
+        self.probe_interval = probe_interval
+        self.eject_failures = max(1, eject_failures)
+        self.eject_seconds = eject_seconds
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def healthy(self) -> List[Endpoint]:
+        now = time.monotonic()
+        return [endpoint for endpoint in self.endpoints if endpoint.healthy(now)]
+
+    def available(self) -> bool:
+        """
+        True if at least one endpoint is healthy, i.e. claimed jobs can be served
+        """
+        return bool(self.healthy())
+
+    def _pick(self) -> Optional[Endpoint]:
+        candidates = [endpoint for endpoint in self.healthy()
+                      if not self.max_outstanding or endpoint.outstanding < self.max_outstanding]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda endpoint: endpoint.outstanding)
+
+    async def _wait(self):
+        # Ejections end on a timer, so re-check at least every probe interval
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout=self.probe_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    async def wait_available(self):
+        """
+        Returns once at least one endpoint is healthy
+        """
+        warned = False
+        while not self.available():
+            if not warned:
+                logger.warning("No healthy CapMonster endpoint, pausing job claims")
+                warned = True
+            await self._wait()
+        if warned:
+            logger.info("CapMonster endpoint available again, resuming job claims")
+
+    async def acquire(self) -> Endpoint:
+        """
+        Waits for a healthy endpoint with spare capacity and counts one captcha against it
+        """
+        while True:
+            endpoint = self._pick()
+            if endpoint:
+                endpoint.outstanding += 1
+                return endpoint
+            await self._wait()
+
+    def release(self, endpoint: Endpoint):
+        endpoint.outstanding -= 1
+        self._wake()
+
+    def report_success(self, endpoint: Endpoint):
+        if endpoint.failures or endpoint.ejected_until:
+            logger.info(f"CapMonster endpoint {endpoint.name} is healthy")
+        endpoint.failures = 0
+        endpoint.ejected_until = 0.0
+        self._wake()
+
+    def report_failure(self, endpoint: Endpoint, reason: str, saturated: bool = False):
+        """
+        Counts a failure against an endpoint and ejects it once ENDPOINT_EJECT_FAILURES is reached (at once if
+        saturated)
+        """
+        if not saturated:
+            endpoint.failures += 1
+        if saturated or endpoint.failures >= self.eject_failures:
+            # Saturation clears up by itself, only back off for one probe interval
+            seconds = min(self.eject_seconds, self.probe_interval) if saturated else self.eject_seconds
+            if endpoint.healthy(time.monotonic()):
+                logger.warning(f"Ejecting CapMonster endpoint {endpoint.name} for {seconds}s: {reason}")
+            endpoint.ejected_until = time.monotonic() + seconds
+
+    @asynccontextmanager
+    async def route(self) -> AsyncIterator[Endpoint]:
+        """
+        Holds an endpoint for one solve and feeds the outcome into its health
+        """
+        endpoint = await self.acquire()
+        try:
+            yield endpoint
+        except FAILURE_EXCEPTIONS as e:
+            self.report_failure(endpoint, repr(e))
+            raise
+        except NEUTRAL_EXCEPTIONS:
+            raise
+        except Exception as e:
+            text = getattr(e, "text", None)
+            if text in SATURATED_ERRORS:
+                self.report_failure(endpoint, text, saturated=True)
+            else:
+                # Any other CapMonster error still means the endpoint is up
+                self.report_success(endpoint)
+            raise
+        else:
+            self.report_success(endpoint)
+        finally:
+            self.release(endpoint)
+
+    async def probe(self, endpoint: Endpoint) -> bool:
+        """
+        Asks an endpoint for its balance. Any HTTP answer counts as alive
+        """
+        try:
+            if self.client:
+                await self.client.get(endpoint.res_url, params={"key": self.key, "action": "getbalance"},
+                                      timeout=HTTPX_TIMEOUT)
+            else:
+                async with httpx.AsyncClient() as client:
+                    await client.get(endpoint.res_url, params={"key": self.key, "action": "getbalance"},
+                                     timeout=HTTPX_TIMEOUT)
+        except FAILURE_EXCEPTIONS as e:
+            self.report_failure(endpoint, f"probe failed: {e!r}")
+            return False
+        # Only brings back endpoints ejected for failing. A saturated endpoint still answers probes, its ejection
+        # runs out on its own
+        if endpoint.failures:
+            self.report_success(endpoint)
+        return True
+
+    async def run(self):
+        """
+        Probes every endpoint each ENDPOINT_PROBE_INTERVAL seconds forever
+        """
+        logger.info(f"Routing to {len(self.endpoints)} CapMonster endpoint(s): "
+                    f"{', '.join(endpoint.name for endpoint in self.endpoints)}")
+        while True:
+            await asyncio.gather(*(self.probe(endpoint) for endpoint in self.endpoints))
+            await asyncio.sleep(self.probe_interval)
+
+    def snapshot(self) -> List[dict]:
+        now = time.monotonic()
+        return [{"endpoint": endpoint.name, "outstanding": endpoint.outstanding, "healthy": endpoint.healthy(now),
+                 "failures": endpoint.failures} for endpoint in self.endpoints]
+
+    def _wake(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+from dotenv import load_dotenv, find_dotenv
+
+# Grab and append root path for imports
+fastpath = Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(fastpath))
+
+from mdb import MongoDB
+from capmonster.fastapi.app.db.indexes import JOB_INDEXES, KEY_INDEXES, ensure_indexes, index_stats
+from capmonster.fastapi.app.db.expiry import TTL_INDEX_NAME
+
+"""
+    Reports index usage for the jobs and keys collections
+
+    python index_stats.py           Prints ops per index since the last mongod restart, and declared indexes that are missing
+    python index_stats.py --ensure  Creates missing indexes first
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+MDB_COLLECTION_KEYS: str = os.getenv("MDB_COLLECTION_KEYS", "keys")
+GARBAGE_TIMER: int = int(os.getenv("GARBAGE_TIMER")) or (60 * 24)
+
+
+async def report(ensure: bool = False):
+    db = MongoDB()
+    jobs = await db.get_collection()
+    keys = await db.get_collection(collection=MDB_COLLECTION_KEYS)
+    if ensure:
+        await ensure_indexes(jobs, keys, GARBAGE_TIMER)
+
+    declared = {
+        jobs.name: [index.document["name"] for index in JOB_INDEXES] + [TTL_INDEX_NAME],
+        keys.name: [index.document["name"] for index in KEY_INDEXES],
+    }
+    for collection in (jobs, keys):
+        stats = await index_stats(collection)
+        print(f"{collection.name} ({await collection.estimated_document_count()} documents)")
+        for index in stats:
+            print(f"    {index['name']:<24} {index['ops']:>12} ops since {index['since']:%Y-%m-%d %H:%M}  {index['key']}")
+        missing = set(declared[collection.name]) - {index["name"] for index in stats}
+        for name in sorted(missing):
+            print(f"    {name:<24} MISSING, run with --ensure")
+    db.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(report(ensure="--ensure" in sys.argv[1:]))
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import OperationFailure, PyMongoError
+from dotenv import load_dotenv, find_dotenv
+
+from capmonster.fastapi.app.schema.common import JobStatusEnum
+
+"""
+    Job intake for server.py listener()
+
+    Subscribes to a MongoDB change stream on the jobs collection so new jobs reach a worker as soon as they are
+    inserted. Change streams require a replica set (Atlas always is one), so standalone mongod and mongomock raise
+    ChangeStreamUnavailable and the listener falls back to polling.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# "auto" tries a change stream first, "stream" or "poll" forces one mode
+INTAKE_MODE: str = os.getenv("INTAKE_MODE", "auto").lower()
+# Collection storing the last processed resume token, so a restarted listener picks up where it left off
+INTAKE_STATE_COLLECTION: str = os.getenv("MDB_COLLECTION_INTAKE", "intake_state")
+INTAKE_NAME: str = os.getenv("INTAKE_NAME", "listener")
+# Seconds between full pending-job queries while streaming. Catches jobs that never produce an insert event
+INTAKE_RECONCILE: int = int(os.getenv("INTAKE_RECONCILE", 60))
+# Milliseconds the server holds an idle getMore open before returning an empty batch
+INTAKE_MAX_AWAIT_MS: int = int(os.getenv("INTAKE_MAX_AWAIT_MS", 1000))
+
+# Jobs that have not been picked up by any listener
+PENDING_QUERY: dict = {"status": JobStatusEnum.pending.value}
+
+# $changeStream stage is only supported on replica sets
+CHANGE_STREAM_UNSUPPORTED = {40573}
+# Resume token is no longer in the oplog / cannot be resumed from
+CHANGE_STREAM_HISTORY_LOST = {280, 286}
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ChangeStreamUnavailable(Exception):
+    """Raised when the MongoDB deployment cannot open a change stream"""
+
+
+class ResumeTokenStore:
+    """
+    Persists the change stream resume token in a small state collection
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, name: str = INTAKE_NAME):
+        self.collection = collection
+        self.name = name
+
+    async def load(self) -> Optional[dict]:
+        state = await self.collection.find_one({"_id": self.name})
+        if not state:
+            return None
+        return state.get("resume_token")
+
+    async def save(self, token: dict):
+        await self.collection.update_one({"_id": self.name}, {"$set": {"resume_token": token}}, upsert=True)
+
+    async def clear(self):
+        await self.collection.delete_one({"_id": self.name})
+
+
+class ChangeStreamIntake:
+    """
+    Hands pending jobs to a callback as soon as they are inserted into the jobs collection
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, store: ResumeTokenStore,
+                 reconcile_interval: int = INTAKE_RECONCILE, max_await_ms: int = INTAKE_MAX_AWAIT_MS):
+        self.collection = collection
+        self.store = store
+        self.reconcile_interval = reconcile_interval
+        self.max_await_ms = max_await_ms
+        self.pipeline = [{"$match": {
+            "operationType": "insert",
+            **{f"fullDocument.{field}": condition for field, condition in PENDING_QUERY.items()},
+        }}]
+
+    async def run(self, on_pending: Callable[[dict], Awaitable[None]],
+                  on_reconcile: Callable[[], Awaitable[None]],
+                  on_idle: Callable[[], Awaitable[None]] = None):
+        """
+        Streams insert events forever, calling on_pending with the inserted document
+        :param on_pending: Coroutine receiving each new pending job document
+        :param on_reconcile: Coroutine that picks up pending jobs without an insert event (inserted while no stream
+            was open, or returned to the pool by the lease reaper). Called when the stream opens and every
+            reconcile_interval seconds
+        :param on_idle: Optional coroutine called whenever the stream returns an empty batch
+        """
+        resume_token = await self.store.load()
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                async with self.collection.watch(self.pipeline, resume_after=resume_token,
+                                                 max_await_time_ms=self.max_await_ms) as stream:
+                    logger.info(f"Change stream opened on {self.collection.name}"
+                                f"{' (resumed)' if resume_token else ''}")
+                    await on_reconcile()
+                    last_reconcile = loop.time()
+                    while stream.alive:
+                        change = await stream.try_next()
+                        if change is not None:
+                            await on_pending(change["fullDocument"])
+                            resume_token = stream.resume_token
+                            await self.store.save(resume_token)
+                            continue
+                        if loop.time() - last_reconcile >= self.reconcile_interval:
+                            await on_reconcile()
+                            last_reconcile = loop.time()
+                        if on_idle:
+                            await on_idle()
+            except NotImplementedError as nie:
+                raise ChangeStreamUnavailable(str(nie)) from nie
+            except OperationFailure as of:
+                if of.code in CHANGE_STREAM_UNSUPPORTED:
+                    raise ChangeStreamUnavailable(str(of)) from of
+                if resume_token and of.code in CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning(f"Resume token expired, restarting change stream from now: {of}")
+                    resume_token = None
+                    await self.store.clear()
+                    continue
+                raise
+            except PyMongoError as pme:
+                # Network blips etc. The driver already retried once, reopen from the last saved token
+                logger.error(f"Change stream interrupted: {pme}")
+                await asyncio.sleep(1)
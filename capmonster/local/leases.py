@@ -0,0 +1,165 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+from datetime import timezone
+from typing import Optional
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from dotenv import load_dotenv, find_dotenv
+
+from intake import PENDING_QUERY
+from capmonster.fastapi.app.db.job_state import transition
+from capmonster.fastapi.app.schema.common import JobStatusEnum
+
+"""
+    Lease-based job claiming so several server.py instances can share one jobs collection
+
+    A node claims a pending job with a single find_one_and_update that sets status "claimed", in_queue, lease_owner
+    and lease_expires.
+    The lease is renewed while the job is being solved. If a node dies, reap_expired_leases() returns its jobs to the
+    pending pool once the lease runs out.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# Unique name of this solver node. Defaults to hostname + pid
+NODE_ID: str = os.getenv("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Seconds a claim stays valid without renewal
+LEASE_SECONDS: int = int(os.getenv("LEASE_SECONDS", 90))
+# Seconds between lease renewals while a job is being solved. Must be well below LEASE_SECONDS
+LEASE_RENEW: int = int(os.getenv("LEASE_RENEW", 30))
+# Seconds between reaper sweeps for expired leases
+LEASE_REAP_INTERVAL: int = int(os.getenv("LEASE_REAP_INTERVAL", 30))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class LeaseLost(Exception):
+    """Raised when a write to a claimed job finds that the node no longer holds its lease"""
+    def __init__(self, job_id):
+        self.job_id = job_id
+        super().__init__(f"Lease on job {job_id} was lost")
+
+
+def lease_expiry(lease_seconds: int = LEASE_SECONDS) -> datetime.datetime:
+    return datetime.datetime.now(timezone.utc) + datetime.timedelta(seconds=lease_seconds)
+
+
+async def claim_job(collection: AsyncIOMotorCollection, node_id: str = NODE_ID,
+                    lease_seconds: int = LEASE_SECONDS, query: dict = None) -> Optional[dict]:
+    """
+    Atomically claims the oldest pending job (optionally narrowed by query) for node_id
+    :return: The claimed job document, or None if nothing was pending
+    """
+    return await collection.find_one_and_update(
+        {**PENDING_QUERY, **(query or {})},
+        {"$set": {**transition(JobStatusEnum.claimed), "in_queue": True, "lease_owner": node_id,
+                  "lease_expires": lease_expiry(lease_seconds)}},
+        sort=[("created_on", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def renew_lease(collection: AsyncIOMotorCollection, job_id: ObjectId, node_id: str = NODE_ID,
+                      lease_seconds: int = LEASE_SECONDS, count_attempt: bool = False) -> bool:
+    """
+    Extends the lease on a job this node still owns
+    :param count_attempt: Also increments the job's persisted attempts, in the same write
+    :return: False if the lease was lost (reaped and possibly claimed by another node)
+    """
+    update = {"$set": {"lease_expires": lease_expiry(lease_seconds)}}
+    if count_attempt:
+        update["$inc"] = {"attempts": 1}
+    renewed = await collection.update_one({"_id": job_id, "lease_owner": node_id}, update)
+    return bool(renewed.matched_count)
+
+
+async def release_lease(collection: AsyncIOMotorCollection, job_id: ObjectId, node_id: str = NODE_ID):
+    """
+    Drops the lease fields once a job is finished (solved or failed) so the reaper ignores it
+    """
+    await collection.update_one({"_id": job_id, "lease_owner": node_id},
+                                {"$unset": {"lease_owner": "", "lease_expires": ""}})
+
+
+async def reap_expired_leases(collection: AsyncIOMotorCollection) -> int:
+    """
+    Returns unfinished jobs with an expired lease to the pending pool
+    :return: Number of jobs returned
+    """
+    reaped = await collection.update_many(
+        {
+            "status": {"$in": [JobStatusEnum.claimed.value, JobStatusEnum.submitted.value]},
+            "lease_expires": {"$lt": datetime.datetime.now(timezone.utc)},
+        },
+        {"$set": transition(JobStatusEnum.pending),
+         "$unset": {"in_queue": "", "captcha_id": "", "lease_owner": "", "lease_expires": ""}},
+    )
+    if reaped.modified_count:
+        logger.info(f"Reaper returned {reaped.modified_count} expired jobs to the pending pool")
+    return reaped.modified_count
+
+
+async def lease_reaper(collection: AsyncIOMotorCollection, interval: int = LEASE_REAP_INTERVAL):
+    """
+    Runs reap_expired_leases() forever. Safe to run on every node
+    """
+    while True:
+        try:
+            await reap_expired_leases(collection)
+        except PyMongoError as pme:
+            logger.error(f"Lease reaper failed: {pme}")
+        await asyncio.sleep(interval)
+
+
+class LeaseKeeper:
+    """
+    Async context manager that renews a job lease in the background while the job is being solved
+
+        async with LeaseKeeper(collection, job_id):
+            await captcha.solve_recaptcha(job)
+
+    With count_attempt the initial renewal also counts one solve attempt on the job document
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, job_id: ObjectId, node_id: str = NODE_ID,
+                 lease_seconds: int = LEASE_SECONDS, renew_every: int = LEASE_RENEW, count_attempt: bool = False):
+        self.collection = collection
+        self.job_id = job_id
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.renew_every = renew_every
+        self.count_attempt = count_attempt
+        self.lost = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.renew_every)
+            try:
+                if not await renew_lease(self.collection, self.job_id, self.node_id, self.lease_seconds):
+                    self.lost = True
+                    logger.error(f"Lease on job {self.job_id} was lost by {self.node_id}")
+                    return
+            except PyMongoError as pme:
+                # Keep trying, the lease is still valid until lease_expires
+                logger.error(f"Failed to renew lease on job {self.job_id}: {pme}")
+
+    async def __aenter__(self) -> "LeaseKeeper":
+        # The job may have waited in the queue, make sure it was not reaped in the meantime
+        self.lost = not await renew_lease(self.collection, self.job_id, self.node_id, self.lease_seconds,
+                                          self.count_attempt)
+        self._task = asyncio.create_task(self._renew())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
@@ -9,6 +9,7 @@ from dotenv import load_dotenv, find_dotenv
 
 # Load env
 load_dotenv(find_dotenv())
+MDB_MAX_POOL_SIZE: int = int(os.getenv("MDB_MAX_POOL_SIZE", 20))
 
 
 class MongoDB:
@@ -19,11 +20,14 @@ class MongoDB:
                  mdb_uri: str = os.getenv("MDB_URI"),
                  database: str = str(os.getenv("MDB_DATABASE")),
                  collection: str = str(os.getenv("MDB_COLLECTION")),
+                 **client_options,
                  ):
         # For Windows
         self.ca = certifi.where()
         self.mdb_uri = mdb_uri
-        self.client: AsyncIOMotorClient = AsyncIOMotorClient(self.mdb_uri, tlsCAFile=self.ca)
+        # Extra AsyncIOMotorClient kwargs, e.g. event_listeners. tlsCAFile=None for a local mongod without TLS
+        self.client_options = {"tlsCAFile": self.ca, "maxPoolSize": MDB_MAX_POOL_SIZE, **client_options}
+        self.client: AsyncIOMotorClient = AsyncIOMotorClient(self.mdb_uri, **self.client_options)
         self.database_name = database
         # self.database = self.client[f"{self.database_name}"]
         self.collection_name = collection
@@ -37,7 +41,7 @@ class MongoDB:
             An instance of AsyncIOMotorClient
         """
         if not self.client:
-            self.client = AsyncIOMotorClient(self.mdb_uri, tlsCAFile=self.ca)
+            self.client = AsyncIOMotorClient(self.mdb_uri, **self.client_options)
         return self.client
 
     async def get_collection(self, client: AsyncIOMotorClient = None, collection: str = None) -> AsyncIOMotorCollection:
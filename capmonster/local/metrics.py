@@ -0,0 +1,103 @@
+import logging
+import os
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from pymongo import monitoring
+from dotenv import load_dotenv, find_dotenv
+
+"""
+    Prometheus metrics for server.py, served on METRICS_PORT
+
+    Hot paths only touch pre-bound label children (a lock and an add). Queue depth, in-flight counts and the
+    concurrency limit are gauges read through callbacks at scrape time, so they cost nothing between scrapes.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# Port of the /metrics HTTP server, 0 disables it
+METRICS_PORT: int = int(os.getenv("METRICS_PORT", 9108))
+
+# Error codes CapMonster answers with (see captcha_solver.py). Anything else is counted as OTHER
+KNOWN_OUTCOMES = {
+    "OK", "CAPCHA_NOT_READY", "TimeoutError", "ERROR", "ERROR_KEY_DOES_NOT_EXIST", "ERROR_WRONG_ID_FORMAT",
+    "ERROR_CAPTCHA_UNSOLVABLE", "ERROR_RECAPTCHA_TIMEOUT", "ERROR_PROXY_BANNED", "ERROR_PROXY_FORMAT",
+    "ERROR_PROXY_CONNECTION_FAILED", "ERROR_PROXY_CIRCUIT_OPEN", "ERROR_RECAPTCHA_INVALID_SITEKEY",
+    "ERROR_WRONG_USER_KEY", "ERROR_ZERO_BALANCE", "ERROR_NO_SLOT_AVAILABLE", "ERROR_ZERO_CAPTCHA_FILESIZE",
+    "ERROR_TOO_BIG_CAPTCHA_FILESIZE", "ERROR_WRONG_FILE_EXTENSION", "ERROR_IMAGE_TYPE_NOT_SUPPORTED",
+    "ERROR_IP_NOT_ALLOWED", "IP_BANNED", "ERROR_BAD_PARAMETERS", "BAD REQUEST",
+}
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+SOLVE_BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+
+QUEUE_DEPTH = Gauge("capmonster_queue_depth", "Claimed jobs buffered in the scheduler, not yet taken by a worker")
+IN_FLIGHT = Gauge("capmonster_jobs_in_flight", "Jobs a worker is solving")
+CONCURRENCY_LIMIT = Gauge("capmonster_concurrency_limit", "Current adaptive (AIMD) concurrency limit")
+POLLER_OUTSTANDING = Gauge("capmonster_poller_outstanding", "Captcha ids waiting on the batch result poller")
+RETRY_WAITING = Gauge("capmonster_retry_waiting", "Failed jobs waiting out their backoff before the next attempt")
+PROXY_CIRCUITS_OPEN = Gauge("capmonster_proxy_circuits_open", "Proxies whose jobs currently fail without a solve")
+ENDPOINT_OUTSTANDING = Gauge("capmonster_endpoint_outstanding", "Captchas in flight per CapMonster endpoint",
+                             ["endpoint"])
+JOBS_CLAIMED = Counter("capmonster_jobs_claimed_total", "Jobs claimed from MongoDB by this node")
+JOBS_FINISHED = Counter("capmonster_jobs_finished_total", "Jobs finished by this node, by final status", ["status"])
+SOLVE_OUTCOMES = Counter("capmonster_solve_outcomes_total", "Solve attempts by CapMonster answer or error code",
+                         ["outcome"])
+CAPMONSTER_LATENCY = Histogram("capmonster_request_seconds", "CapMonster in.php/res.php request latency",
+                               ["request"], buckets=LATENCY_BUCKETS)
+SOLVE_DURATION = Histogram("capmonster_solve_seconds", "Seconds from in.php upload to final res.php answer",
+                           buckets=SOLVE_BUCKETS)
+MONGO_LATENCY = Histogram("capmonster_mongo_command_seconds", "MongoDB command latency", ["command"],
+                          buckets=LATENCY_BUCKETS)
+
+SUBMIT_LATENCY = CAPMONSTER_LATENCY.labels("submit")
+POLL_LATENCY = CAPMONSTER_LATENCY.labels("poll")
+BATCH_POLL_LATENCY = CAPMONSTER_LATENCY.labels("poll_batch")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def outcome_label(text: str) -> str:
+    """
+    Bounded label for a CapMonster answer, so unexpected responses cannot blow up the series count
+    """
+    if not text:
+        return "OTHER"
+    code = text.split("|")[0]
+    if code in KNOWN_OUTCOMES:
+        return code
+    return next((known for known in KNOWN_OUTCOMES if known.startswith("ERROR_") and known in text), "OTHER")
+
+
+def record_outcome(text: str):
+    SOLVE_OUTCOMES.labels(outcome_label(text)).inc()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Observes every command on the Motor client it is passed to: MongoDB(event_listeners=[MongoCommandMetrics()])
+    """
+
+    def __init__(self):
+        self._children = {}
+
+    def _observe(self, event):
+        child = self._children.get(event.command_name)
+        if child is None:
+            child = self._children[event.command_name] = MONGO_LATENCY.labels(event.command_name)
+        child.observe(event.duration_micros / 1e6)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event)
+
+    def failed(self, event):
+        self._observe(event)
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    if not port:
+        return
+    start_http_server(port)
+    logger.info(f"Prometheus metrics on :{port}/metrics")
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Tuple
+import httpx
+from dotenv import load_dotenv, find_dotenv
+
+from connections import HTTPX_TIMEOUT
+from metrics import BATCH_POLL_LATENCY, POLL_LATENCY
+
+"""
+    Centralized result poller for CapMonster
+
+    Instead of every worker sleeping and polling res.php?action=get&id=... on its own, workers register their captcha
+    id with one ResultPoller and await a future. A single task checks all outstanding ids together using the 2Captcha
+    multi-id query res.php?action=get&ids=a,b,c, which answers with one |-separated value per id in the same order.
+    Endpoints that do not understand ids= are detected and polled one id at a time.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# Seconds between poll rounds, same setting captcha_solver.py uses between single polls
+POLLER_INTERVAL: int = int(os.getenv("CLIENT_RETRY_SLEEP", 5))
+# Max ids per res.php request
+POLLER_BATCH_SIZE: int = int(os.getenv("POLLER_BATCH_SIZE", 50))
+# Seconds after which an id that is still CAPCHA_NOT_READY fails with TimeoutError
+POLLER_MAX_WAIT: int = int(os.getenv("POLLER_MAX_WAIT", 300))
+
+NOT_READY = "CAPCHA_NOT_READY"
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ResultPoller:
+    """
+    Tracks outstanding CapMonster captcha ids and resolves one future per id with the final res.php response text,
+    normalized to the single-id format: OK|solution or the error code
+    """
+
+    def __init__(self, client: httpx.AsyncClient, key: str = None, interval: float = POLLER_INTERVAL,
+                 batch_size: int = POLLER_BATCH_SIZE, max_wait: float = POLLER_MAX_WAIT):
+        self.client = client
+        self.key = key or os.getenv("ROOT_API_KEY")
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        # res.php url -> captcha id -> (future, deadline)
+        self._pending: Dict[str, Dict[str, Tuple[asyncio.Future, float]]] = {}
+        # res.php url -> False once the endpoint answered a multi-id query with something unusable
+        self.batch_supported: Dict[str, bool] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+
+    @property
+    def outstanding(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    async def wait(self, cap_id, url: str) -> str:
+        """
+        Waits until CapMonster finishes cap_id
+        :param cap_id: CapMonster captcha id returned by in.php
+        :param url: res.php url of the CapMonster instance that owns cap_id
+        :return: OK|solution or the error code
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        cap_id = str(cap_id)
+        self._pending.setdefault(url, {})[cap_id] = (future, loop.time() + self.max_wait)
+        self.start()
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            jobs = self._pending.get(url, {})
+            jobs.pop(cap_id, None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for jobs in self._pending.values():
+            for future, _ in jobs.values():
+                future.cancel()
+        self._pending.clear()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.outstanding:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            for url, jobs in list(self._pending.items()):
+                ids = []
+                for cap_id, (future, deadline) in list(jobs.items()):
+                    if future.done():
+                        continue
+                    if now >= deadline:
+                        future.set_exception(TimeoutError(f"CapMonster did not finish {cap_id} in {self.max_wait}s"))
+                        continue
+                    ids.append(cap_id)
+                batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+                results = await asyncio.gather(*(self._poll(url, batch) for batch in batches),
+                                               return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        # Network errors are retried next round, the deadline still applies
+                        logger.error(f"[CapMonster] Polling {url} failed: {result!r}")
+
+    async def _get(self, url: str, params: dict) -> str:
+        with (BATCH_POLL_LATENCY if "ids" in params else POLL_LATENCY).time():
+            response = await self.client.get(url, params={"key": self.key, "action": "get", **params},
+                                             timeout=HTTPX_TIMEOUT)
+        return response.text
+
+    async def _poll(self, url: str, ids: List[str]):
+        if len(ids) > 1 and self.batch_supported.get(url, True):
+            text = await self._get(url, {"ids": ",".join(ids)})
+            answers = text.split("|")
+            # A single-id style OK|solution means the endpoint ignored ids=
+            if len(answers) == len(ids) and answers[0] != "OK":
+                for cap_id, answer in zip(ids, answers):
+                    if answer != NOT_READY and not answer.startswith("ERROR"):
+                        answer = f"OK|{answer}"
+                    self._resolve(url, cap_id, answer)
+                return
+            logger.warning(f"[CapMonster] {url} does not support multi-id polling ({text}), polling ids one by one")
+            self.batch_supported[url] = False
+
+        for cap_id in ids:
+            self._resolve(url, cap_id, await self._get(url, {"id": cap_id}))
+
+    def _resolve(self, url: str, cap_id: str, text: str):
+        if text == NOT_READY:
+            return
+        pending = self._pending.get(url, {}).get(cap_id)
+        if pending and not pending[0].done():
+            pending[0].set_result(text)
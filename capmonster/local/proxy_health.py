@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+from dotenv import load_dotenv, find_dotenv
+from capmonster.fastapi.app.schema.recaptcha import CaptchaBase
+
+"""
+    Proxy health scoring and circuit breaker
+
+    Every solve is scored against the job's proxy, keyed by the proxy string as cleaned by
+    CaptchaBase.incorrect_proxy_format. After PROXY_OPEN_FAILURES consecutive proxy errors (banned, timed out,
+    unreachable) the circuit opens for PROXY_OPEN_SECONDS: jobs using that proxy fail at once with
+    ERROR_PROXY_CIRCUIT_OPEN instead of taking a CapMonster slot. Once the time is up a single job is let through
+    (half-open), its outcome closes or re-opens the circuit.
+    With PROXY_PROBE=1, proxies never seen before get a TCP connect check before their first submission.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# Consecutive proxy errors before a proxy's circuit opens, and seconds it stays open
+PROXY_OPEN_FAILURES: int = int(os.getenv("PROXY_OPEN_FAILURES", 3))
+PROXY_OPEN_SECONDS: int = int(os.getenv("PROXY_OPEN_SECONDS", 300))
+# Connect to unseen proxies before their first job is submitted, and the connect timeout in seconds
+PROXY_PROBE: bool = os.getenv("PROXY_PROBE", "0").lower() in ("1", "true", "yes")
+PROXY_PROBE_TIMEOUT: float = float(os.getenv("PROXY_PROBE_TIMEOUT", 5))
+# Max proxies remembered, least recently used ones are forgotten first
+PROXY_TRACK_MAX: int = int(os.getenv("PROXY_TRACK_MAX", 10000))
+
+# CapMonster answers that blame the proxy rather than the captcha or the endpoint
+PROXY_ERRORS = [
+    "ERROR_PROXY_BANNED",
+    "ERROR_PROXY_CONNECTION_FAILED",
+    "ERROR_RECAPTCHA_TIMEOUT",
+]
+PROXY_CIRCUIT_OPEN = "ERROR_PROXY_CIRCUIT_OPEN"
+# Weight of the latest outcome in the moving score
+SCORE_ALPHA = 0.3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ProxyCircuitOpen(Exception):
+    """Raised instead of submitting a job whose proxy is known to be failing"""
+
+    def __init__(self, proxy: str, seconds: float):
+        self.message = f"[CapMonster] Proxy {proxy} failed repeatedly, not retried for {seconds:.0f}s"
+        self.text = PROXY_CIRCUIT_OPEN
+        super().__init__(self.message)
+
+
+def normalize_proxy(proxy: Optional[str]) -> Optional[str]:
+    """
+    Tracker key for a proxy, the same form CaptchaBase stores. None for jobs without a proxy
+    """
+    if not proxy:
+        return None
+    return CaptchaBase.incorrect_proxy_format(proxy.strip())
+
+
+def proxy_address(proxy: str) -> Tuple[str, int]:
+    """
+    host and port of a normalized proxy, e.g. username:password@192.168.0.1:1500
+    """
+    host, _, port = proxy.rpartition("@")[2].rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+def is_proxy_error(text: Optional[str]) -> bool:
+    return bool(text) and any(error in text for error in PROXY_ERRORS)
+
+
+class ProxyHealth:
+    """
+    Outcome history of one proxy
+    """
+    __slots__ = ("score", "failures", "open_until", "trial", "successes", "errors")
+
+    def __init__(self):
+        # Moving success rate, 1.0 = every recent job worked
+        self.score = 1.0
+        self.failures = 0
+        self.open_until = 0.0
+        # A half-open trial job is in flight
+        self.trial = False
+        self.successes = 0
+        self.errors = 0
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+
+class ProxyHealthTracker:
+    """
+    Scores proxies from solve outcomes and fails jobs fast while a proxy's circuit is open
+
+        await tracker.admit(job.proxy)  # raises ProxyCircuitOpen
+        async with tracker.track(job.proxy):
+            ...upload and wait for the result...
+    """
+
+    def __init__(self, open_failures: int = PROXY_OPEN_FAILURES, open_seconds: int = PROXY_OPEN_SECONDS,
+                 probe: bool = PROXY_PROBE, probe_timeout: float = PROXY_PROBE_TIMEOUT,
+                 max_tracked: int = PROXY_TRACK_MAX):
+        self.open_failures = max(1, open_failures)
+        self.open_seconds = open_seconds
+        self.probe_enabled = probe
+        self.probe_timeout = probe_timeout
+        self.max_tracked = max_tracked
+        self._proxies: "OrderedDict[str, ProxyHealth]" = OrderedDict()
+        # One probe per unseen proxy, concurrent jobs with the same proxy wait for it
+        self._probes: Dict[str, asyncio.Future] = {}
+
+    def _get(self, key: str) -> ProxyHealth:
+        health = self._proxies.get(key)
+        if health is None:
+            health = self._proxies[key] = ProxyHealth()
+            while len(self._proxies) > self.max_tracked:
+                self._proxies.popitem(last=False)
+        else:
+            self._proxies.move_to_end(key)
+        return health
+
+    def is_open(self, proxy: Optional[str]) -> bool:
+        """
+        True if jobs with this proxy are currently failed without submitting them
+        """
+        key = normalize_proxy(proxy)
+        health = self._proxies.get(key) if key else None
+        return bool(health) and health.is_open(time.monotonic())
+
+    def open_circuits(self) -> int:
+        now = time.monotonic()
+        return sum(1 for health in self._proxies.values() if health.is_open(now))
+
+    def _open(self, key: str, health: ProxyHealth, reason: str):
+        if not health.is_open(time.monotonic()):
+            logger.warning(f"Opening circuit for proxy {key} for {self.open_seconds}s after {health.failures} "
+                           f"proxy error(s): {reason}")
+        health.open_until = time.monotonic() + self.open_seconds
+
+    def record(self, proxy: Optional[str], text: Optional[str]):
+        """
+        Scores one finished solve by its CapMonster answer. Only proxy errors count against the proxy
+        """
+        key = normalize_proxy(proxy)
+        if not key:
+            return
+        health = self._get(key)
+        health.trial = False
+        if is_proxy_error(text):
+            health.errors += 1
+            health.failures += 1
+            health.score *= 1 - SCORE_ALPHA
+            if health.failures >= self.open_failures:
+                self._open(key, health, text)
+        else:
+            if health.open_until:
+                logger.info(f"Proxy {key} is healthy again, closing its circuit")
+            health.successes += 1
+            health.failures = 0
+            health.open_until = 0.0
+            health.score = health.score * (1 - SCORE_ALPHA) + SCORE_ALPHA
+
+    async def probe(self, key: str) -> bool:
+        """
+        TCP connect to the proxy. Only shows the proxy is reachable, not that Google accepts it
+        """
+        try:
+            host, port = proxy_address(key)
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=self.probe_timeout)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            logger.warning(f"Proxy {key} failed its connectivity probe: {e!r}")
+            return False
+        writer.close()
+        return True
+
+    async def _probe_unseen(self, key: str):
+        if key in self._proxies:
+            return
+        future = self._probes.get(key)
+        if future is None:
+            future = self._probes[key] = asyncio.ensure_future(self.probe(key))
+            future.add_done_callback(lambda _: self._probes.pop(key, None))
+        reachable = await asyncio.shield(future)
+        if key in self._proxies:
+            return
+        # Seen from now on, probed once
+        health = self._get(key)
+        if not reachable:
+            health.failures = self.open_failures
+            health.score = 0.0
+            self._open(key, health, "unreachable")
+
+    async def admit(self, proxy: Optional[str]):
+        """
+        Raises ProxyCircuitOpen if a job with this proxy should not be submitted right now
+        Lets one trial job through once an open circuit has run out
+        """
+        key = normalize_proxy(proxy)
+        if not key:
+            return
+        if self.probe_enabled:
+            await self._probe_unseen(key)
+        health = self._proxies.get(key)
+        if not health or health.failures < self.open_failures:
+            return
+        now = time.monotonic()
+        if health.is_open(now) or health.trial:
+            raise ProxyCircuitOpen(key, max(health.open_until - now, 0))
+        health.trial = True
+
+    @asynccontextmanager
+    async def track(self, proxy: Optional[str]) -> AsyncIterator[None]:
+        """
+        Records the outcome of an admitted solve against the proxy
+        """
+        try:
+            yield
+        except BaseException as e:
+            text = getattr(e, "text", None)
+            if text:
+                # A CapMonster answer (ReCaptchaError)
+                self.record(proxy, text)
+            else:
+                # Timeouts, cancellation and endpoint failures say nothing about the proxy, free the trial slot
+                health = self._proxies.get(normalize_proxy(proxy))
+                if health:
+                    health.trial = False
+            raise
+        else:
+            self.record(proxy, None)
+
+    def snapshot(self) -> list:
+        now = time.monotonic()
+        return [{"proxy": key, "score": round(health.score, 3), "failures": health.failures,
+                 "open": health.is_open(now), "successes": health.successes, "errors": health.errors}
+                for key, health in self._proxies.items()]
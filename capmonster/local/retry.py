@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from typing import List, Optional, Tuple
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from dotenv import load_dotenv, find_dotenv
+
+from scheduler import FairScheduler
+from leases import lease_expiry, NODE_ID, LEASE_SECONDS
+from metrics import JOBS_FINISHED
+from capmonster.fastapi.app.db.job_state import transition
+from capmonster.fastapi.app.schema.common import JobStatusEnum
+from capmonster.fastapi.app.schema.recaptcha import ReCaptchaInDb
+
+"""
+    Delayed retries for failed solve attempts, off the worker
+
+    A worker makes one attempt per job it takes. A failed attempt is handed to the RetryScheduler, which keeps the job
+    in a heap ordered by due time and puts it back on the FairScheduler once its jittered exponential backoff has
+    passed, so no worker sleeps on a job. Attempts are counted on the job document (see LeaseKeeper), and a job that
+    has used SOLVE_ATTEMPTS is dead-lettered: status "dead", with every attempt's error in its errors field. A job
+    whose every attempt timed out waiting on CapMonster is "expired" instead.
+
+    The lease of a waiting job is extended past its due time. If the node stops, the lease runs out and the reaper
+    returns the job to the pending pool with its attempt count intact.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# Solve attempts per job, including the first, before it is dead-lettered
+SOLVE_ATTEMPTS: int = int(os.getenv("SOLVE_ATTEMPTS", 3))
+# Backoff in seconds before the 2nd attempt, doubled for each further one up to RETRY_MAX_DELAY
+RETRY_BASE_DELAY: float = float(os.getenv("RETRY_BASE_DELAY", 5))
+RETRY_MAX_DELAY: float = float(os.getenv("RETRY_MAX_DELAY", 120))
+
+# Error of an attempt that timed out waiting on CapMonster (see server.solve_attempt)
+TIMEOUT_ERROR = "TimeoutError"
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class RetryScheduler:
+    """
+    Timer heap of failed jobs, re-queued when their backoff has passed
+
+        error = ...one attempt...
+        if retries.exhausted(job):
+            await retries.dead_letter(job, error)
+        else:
+            await retries.retry(job, key, error)
+    """
+
+    def __init__(self, queue: FairScheduler, collection: AsyncIOMotorCollection, attempts: int = SOLVE_ATTEMPTS,
+                 base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY, node_id: str = NODE_ID):
+        self.queue = queue
+        self.collection = collection
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.node_id = node_id
+        # (due, tie breaker, API key, job)
+        self._heap: List[Tuple[float, int, Optional[str], ReCaptchaInDb]] = []
+        self._seq = itertools.count()
+        # Created in run(), on the running event loop
+        self._changed: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def exhausted(self, job: ReCaptchaInDb) -> bool:
+        return (job.attempts or 0) >= self.attempts
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Seconds to wait after the attempt-th failed attempt, with equal jitter so retries of jobs that failed
+        together do not arrive together
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def retry(self, job: ReCaptchaInDb, key: Optional[str], error: str, delay: float = None) -> bool:
+        """
+        Records a failed attempt and schedules the next one
+        :param delay: Seconds until the next attempt, defaults to the backoff for the attempts made so far
+        :return: False if the job's lease was lost, the job is then left alone
+        """
+        if delay is None:
+            delay = self.backoff(job.attempts or 1)
+        try:
+            kept = await self.collection.update_one(
+                {"_id": ObjectId(job.id), "lease_owner": self.node_id},
+                {"$set": {**transition(JobStatusEnum.claimed), "lease_expires": lease_expiry(delay + LEASE_SECONDS)},
+                 "$unset": {"captcha_id": ""},
+                 "$push": {"errors": error}})
+            if not kept.matched_count:
+                logger.warning(f"Not retrying job {job.id}, its lease was lost")
+                return False
+        except PyMongoError as pme:
+            # Retry anyway, the in-memory attempt count still bounds it
+            logger.error(f"Failed to record attempt {job.attempts} of job {job.id}: {pme}")
+        logger.info(f"Retrying job {job.id} in {delay:.1f}s after attempt {job.attempts}/{self.attempts}: {error}")
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), key, job))
+        if self._changed is not None:
+            self._changed.set()
+        return True
+
+    async def dead_letter(self, job: ReCaptchaInDb, error: str):
+        """
+        Finishes a job that used up its attempts and releases its lease, in one write. The status is expired if every
+        attempt, including ones made by other nodes, timed out, dead otherwise
+        """
+        logger.error(f"Dead-lettering job {job.id} after {job.attempts} attempt(s): {error}")
+        fields = transition(JobStatusEnum.dead)
+        fields["status"] = {"$cond": [
+            {"$allElementsTrue": [{"$map": {"input": "$errors", "in": {"$eq": ["$$this", TIMEOUT_ERROR]}}}]},
+            JobStatusEnum.expired.value, JobStatusEnum.dead.value]}
+        # Pipeline update (MongoDB 4.2+), the status depends on the errors array after this attempt's is added
+        finished = await self.collection.find_one_and_update(
+            {"_id": ObjectId(job.id), "lease_owner": self.node_id},
+            [{"$set": {"errors": {"$concatArrays": [{"$ifNull": ["$errors", []]}, [{"$literal": error}]]}}},
+             {"$set": {**fields, "error": {"$literal": error}, "in_queue": False}},
+             {"$unset": ["lease_owner", "lease_expires"]}],
+            projection={"status": 1}, return_document=ReturnDocument.AFTER)
+        if finished:
+            JOBS_FINISHED.labels(finished["status"]).inc()
+
+    async def run(self):
+        """
+        Moves jobs whose backoff has passed back onto the queue, forever
+        """
+        self._changed = asyncio.Event()
+        while True:
+            self._changed.clear()
+            if not self._heap:
+                await self._changed.wait()
+                continue
+            wait = self._heap[0][0] - time.monotonic()
+            if wait > 0:
+                # Woken early if a job with an earlier due time is pushed
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, key, job = heapq.heappop(self._heap)
+            await self.queue.put(job, key)
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+from motor.motor_asyncio import AsyncIOMotorCollection
+from dotenv import load_dotenv, find_dotenv
+
+from capmonster.fastapi.app.schema.recaptcha import ReCaptchaInDb
+
+"""
+    Per-tenant (API key) fair scheduling between listener() and the captcha workers
+
+    Claimed jobs are buffered in one sub-queue per API key and handed to workers by deficit round robin, weighted by
+    the key's "weight". Keys with a higher "priority" are served first, and "max_inflight" caps how many of a key's
+    jobs are solved at once. All three are optional fields on the key's document in the keys collection.
+
+    Fairness has to start at claim time: a key whose sub-queue is full is excluded from the next claim (see
+    claim_filter), so one key with thousands of pending jobs cannot fill the whole buffer.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+MDB_COLLECTION_KEYS: str = os.getenv("MDB_COLLECTION_KEYS", "keys")
+# Claimed jobs a node may hold beyond the ones its workers are solving. Everything else stays unclaimed in MongoDB
+INTAKE_PREFETCH: int = int(os.getenv("INTAKE_PREFETCH", 4))
+# Claimed jobs a single key may hold in the buffer
+SCHEDULER_KEY_PREFETCH: int = int(os.getenv("SCHEDULER_KEY_PREFETCH", 1))
+# Seconds a key's weight/priority/max_inflight are cached
+SCHEDULER_POLICY_TTL: int = int(os.getenv("SCHEDULER_POLICY_TTL", 60))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TenantPolicy(NamedTuple):
+    weight: int = 1
+    priority: int = 0
+    max_inflight: Optional[int] = None
+
+
+class KeyPolicies:
+    """
+    Reads scheduling settings from the keys collection, cached for SCHEDULER_POLICY_TTL seconds
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection = None, ttl: int = SCHEDULER_POLICY_TTL):
+        self.collection = collection
+        self.ttl = ttl
+        self._cache: Dict[Optional[str], Tuple[TenantPolicy, float]] = {}
+
+    async def get(self, key: Optional[str]) -> TenantPolicy:
+        cached = self._cache.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        policy = TenantPolicy()
+        if self.collection is not None and key:
+            try:
+                found = await self.collection.find_one({"key": key},
+                                                       projection={"weight": 1, "priority": 1, "max_inflight": 1})
+            except Exception as e:
+                logger.error(f"Could not load scheduling policy for key {key}: {e}")
+                found = None
+            if found:
+                policy = TenantPolicy(weight=max(1, int(found.get("weight") or 1)),
+                                      priority=int(found.get("priority") or 0),
+                                      max_inflight=found.get("max_inflight"))
+        self._cache[key] = (policy, time.monotonic() + self.ttl)
+        return policy
+
+
+class _Tenant:
+    __slots__ = ("jobs", "policy", "deficit", "has_turn", "in_flight")
+
+    def __init__(self, policy: TenantPolicy):
+        self.jobs: Deque[ReCaptchaInDb] = deque()
+        self.policy = policy
+        self.deficit = 0.0
+        self.has_turn = False
+        self.in_flight = 0
+
+
+class FairScheduler:
+    """
+    Bounded, per-key job buffer served by weighted deficit round robin
+
+        await scheduler.wait_for_space()
+        claimed = await claim_job(collection, query=scheduler.claim_filter())
+        await scheduler.put(ReCaptchaInDb(**claimed), claimed.get("key"))
+        ...
+        key, job = await scheduler.get()
+        ...
+        scheduler.done(key)
+    """
+
+    def __init__(self, policies: KeyPolicies = None, maxsize: int = INTAKE_PREFETCH,
+                 key_prefetch: int = SCHEDULER_KEY_PREFETCH):
+        self.policies = policies or KeyPolicies()
+        self.maxsize = max(1, maxsize)
+        self.key_prefetch = max(1, key_prefetch)
+        self._tenants: Dict[Optional[str], _Tenant] = {}
+        # Keys with buffered jobs, in round robin order
+        self._ring: Deque[Optional[str]] = deque()
+        self._size = 0
+        self._unfinished = 0
+        self._getters: Deque[asyncio.Future] = deque()
+        self._space_waiters: Deque[asyncio.Future] = deque()
+        self._finished: Optional[asyncio.Event] = None
+        # Set when a pending job was skipped because its key was saturated, so the listener knows to come back
+        self.backlog = False
+
+    def qsize(self) -> int:
+        return self._size
+
+    def full(self) -> bool:
+        return self._size >= self.maxsize
+
+    @property
+    def free_slots(self) -> int:
+        return max(0, self.maxsize - self._size)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(tenant.in_flight for tenant in self._tenants.values())
+
+    def is_saturated(self, key: Optional[str]) -> bool:
+        """
+        True if this node should not claim another job for key right now
+        """
+        tenant = self._tenants.get(key)
+        if not tenant:
+            return False
+        if len(tenant.jobs) >= self.key_prefetch:
+            return True
+        cap = tenant.policy.max_inflight
+        return cap is not None and tenant.in_flight + len(tenant.jobs) >= cap
+
+    def saturated_keys(self) -> List[Optional[str]]:
+        return [key for key in self._tenants if self.is_saturated(key)]
+
+    def claim_filter(self) -> dict:
+        """
+        Extra claim_job query that skips keys which already have enough jobs buffered or in flight
+        """
+        saturated = self.saturated_keys()
+        if not saturated:
+            return {}
+        return {"key": {"$nin": saturated}}
+
+    async def wait_for_space(self):
+        """
+        Returns once the buffer can take another job
+        """
+        while self.full():
+            future = asyncio.get_running_loop().create_future()
+            self._space_waiters.append(future)
+            await future
+
+    async def put(self, job: ReCaptchaInDb, key: Optional[str] = None):
+        """
+        Buffers a claimed job under its API key. Never blocks on a full buffer (requeued jobs must always fit), the
+        listener calls wait_for_space() before claiming instead
+        """
+        if key not in self._tenants:
+            policy = await self.policies.get(key)
+            self._tenants.setdefault(key, _Tenant(policy))
+        tenant = self._tenants[key]
+        if not tenant.jobs:
+            self._ring.append(key)
+        tenant.jobs.append(job)
+        self._size += 1
+        self._unfinished += 1
+        self._wake(self._getters)
+
+    async def get(self) -> Tuple[Optional[str], ReCaptchaInDb]:
+        """
+        Waits for the next job by priority, then weighted round robin across keys under their in-flight cap
+        :return: (API key, job)
+        """
+        while True:
+            picked = self._pick()
+            if picked:
+                self._wake(self._space_waiters)
+                return picked
+            future = asyncio.get_running_loop().create_future()
+            self._getters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Pass the wakeup on, another getter may be able to use it
+                self._wake(self._getters)
+                raise
+
+    def done(self, key: Optional[str]):
+        """
+        Marks a job from get() as finished and frees its key's in-flight slot
+        """
+        tenant = self._tenants.get(key)
+        if tenant:
+            tenant.in_flight -= 1
+            if not tenant.jobs and not tenant.in_flight:
+                del self._tenants[key]
+        self._unfinished -= 1
+        if self._unfinished <= 0 and self._finished:
+            self._finished.set()
+        self._wake(self._getters)
+
+    async def join(self):
+        while self._unfinished > 0:
+            self._finished = asyncio.Event()
+            await self._finished.wait()
+
+    def _eligible(self, tenant: _Tenant) -> bool:
+        cap = tenant.policy.max_inflight
+        return bool(tenant.jobs) and (cap is None or tenant.in_flight < cap)
+
+    def _pick(self) -> Optional[Tuple[Optional[str], ReCaptchaInDb]]:
+        eligible = [key for key in self._ring if self._eligible(self._tenants[key])]
+        if not eligible:
+            return None
+        top = max(self._tenants[key].policy.priority for key in eligible)
+        eligible = {key for key in eligible if self._tenants[key].policy.priority == top}
+
+        while True:
+            key = self._ring[0]
+            tenant = self._tenants[key]
+            if key in eligible:
+                if not tenant.has_turn:
+                    tenant.deficit += tenant.policy.weight
+                    tenant.has_turn = True
+                if tenant.deficit >= 1:
+                    tenant.deficit -= 1
+                    return key, self._pop(key, tenant)
+            tenant.has_turn = False
+            self._ring.rotate(-1)
+
+    def _pop(self, key: Optional[str], tenant: _Tenant) -> ReCaptchaInDb:
+        job = tenant.jobs.popleft()
+        tenant.in_flight += 1
+        self._size -= 1
+        if not tenant.jobs:
+            self._ring.remove(key)
+            tenant.deficit = 0.0
+            tenant.has_turn = False
+        return job
+
+    @staticmethod
+    def _wake(waiters: Deque[asyncio.Future]):
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(None)
@@ -1,12 +1,11 @@
 import asyncio
 import logging
 import os
-import random
-import datetime
-from datetime import timezone
+import time
+from typing import Optional
+import httpx
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorCollection
-from pymongo import UpdateOne, DeleteOne
 from pymongo.errors import ServerSelectionTimeoutError
 from dotenv import load_dotenv, find_dotenv
 import sys
@@ -15,13 +14,30 @@ from pathlib import Path
 fastpath = Path(__file__).resolve().parent.parent.parent
 sys.path.append(str(fastpath))
 from captcha_solver import CaptchaUpload, ReCaptchaError
+from concurrency import AIMDLimiter, OVERLOAD_ERRORS
+from connections import Connections
+from scheduler import FairScheduler, KeyPolicies, MDB_COLLECTION_KEYS
+from poller import ResultPoller
+from endpoints import EndpointPool
+from proxy_health import ProxyHealthTracker, PROXY_CIRCUIT_OPEN
+from retry import TIMEOUT_ERROR, RetryScheduler
+from leases import LeaseKeeper, LeaseLost, claim_job, lease_reaper, release_lease, NODE_ID
+from intake import ChangeStreamIntake, ChangeStreamUnavailable, ResumeTokenStore, INTAKE_MODE, \
+    INTAKE_STATE_COLLECTION
+from warm_pool import WarmPool
 from mdb import MongoDB
-from capmonster.fastapi.app.schema.recaptcha import ReCaptchaInDb
+from metrics import CONCURRENCY_LIMIT, ENDPOINT_OUTSTANDING, IN_FLIGHT, JOBS_CLAIMED, JOBS_FINISHED, \
+    POLLER_OUTSTANDING, PROXY_CIRCUITS_OPEN, QUEUE_DEPTH, RETRY_WAITING, MongoCommandMetrics, record_outcome, \
+    start_metrics_server
+from capmonster.fastapi.app.schema.recaptcha import ReCaptchaInDb, ReCaptchaResponse, ReCaptchaErrorResponse
+from capmonster.fastapi.app.db.expiry import purge_expired
+from capmonster.fastapi.app.db.indexes import ensure_indexes
+from capmonster.fastapi.app.schema.common import JobStatusEnum
 
 """
     Infinite async producer/consumer loop that runs on the Windows computer with CapMonster
     
-    Listens for CloudDB updates, passes the requests to CapMonster, and updates the DB once finished
+    Listens for CloudDB updates (change stream, or polling as a fallback), passes the requests to CapMonster, and updates the DB once finished
 """
 
 # Load env for Windows server script
@@ -36,66 +52,139 @@ logger.setLevel(logging.INFO)
 async def purge_garbage(collection: AsyncIOMotorCollection):
     """
     Purges documents older than GARBAGE_TIMER
-    Can implement here or via cron/scheduled FastAPI endpoints
-    """
-    updates = []
-    all_documents = collection.find({})
-    async for document in all_documents:
-        if "created_on" in document.keys():
-            created_on = document['created_on']
-            if isinstance(document['created_on'], str):
-                created_on = datetime.datetime.fromisoformat(document['created_on'].replace(
-                    "Z", "+00:00")).replace(tzinfo=timezone.utc)
-            elif isinstance(document['created_on'], datetime.datetime):
-                created_on = (document['created_on']).replace(tzinfo=timezone.utc)
-            else:
-                raise TypeError
-            if ((datetime.datetime.now(timezone.utc) - created_on).total_seconds() / 60) >= GARBAGE_TIMER:
-                logger.info(f"Time delta: {(datetime.datetime.now(timezone.utc) - created_on).total_seconds() / 60}")
-                updates.append(DeleteOne({'_id': document["_id"]}))
+    The created_on TTL index normally deletes them first, this is an indexed range delete as a backstop
+    """
+    purged = await purge_expired(collection, GARBAGE_TIMER)
+    if purged:
+        logger.info(f"Garbage collection purged {purged} documents from the database")
 
-    if updates:
-        await collection.bulk_write(updates)
-        logger.info(f"Garbage collection purged {len(updates)} documents from the database")
 
+async def garbage_collector(collection: AsyncIOMotorCollection):
+    """
+    Purges expired jobs every GARBAGE_TIMER minutes, beside the listener
+    """
+    while True:
+        try:
+            await purge_garbage(collection)
+        except ServerSelectionTimeoutError as sste:
+            logger.error(sste)
+        except Exception as e:
+            logger.error(e)
+        await asyncio.sleep(GARBAGE_TIMER * 60)
 
-async def listener(queue: asyncio.Queue, remove_garbage: bool = True):
+
+async def hand_off(queue: FairScheduler, collection: AsyncIOMotorCollection, claimed: dict,
+                   warm_pool: WarmPool = None):
     """
-    Checks DB for new ReCaptcha jobs that are not in_queue and adds them to the shared queue for captcha_worker to solve
+    Passes a freshly claimed job to the workers, or completes it on the spot with a pre-solved warm pool token
     """
-    # Check for new requests inside the MongoDB Collection. If found, add to queue.
-    # Immediately add 'in_queue' flag to prevent network errors from delaying 'captcha_id'
-    db = MongoDB()
-    collection = await db.get_collection()
-    if remove_garbage:
-        await purge_garbage(collection)
-    garbage_collection_interval = int((GARBAGE_TIMER * 60) / HIT_DB_SLEEP)
+    JOBS_CLAIMED.inc()
+    if warm_pool and warm_pool.enabled:
+        token = warm_pool.take(claimed.get("googlekey"), claimed.get("pageurl"), claimed.get("proxy"))
+        if token:
+            job = ReCaptchaInDb(**claimed)
+            try:
+                await warm_pool.captcha.save_solution(job.id, ReCaptchaResponse(**job.dict()), token)
+            except LeaseLost:
+                logger.warning(f"Job {job.id} was reaped before its warm pool token was saved")
+                JOBS_FINISHED.labels("lease_lost").inc()
+                return
+            await release_lease(collection, claimed["_id"])
+            logger.info(f"Job {job.id} served from the warm pool")
+            JOBS_FINISHED.labels("warm_pool").inc()
+            return
+    await queue.put(ReCaptchaInDb(**claimed), claimed.get("key"))
+
+
+async def wait_to_claim(queue: FairScheduler, endpoints: EndpointPool = None):
+    """
+    Returns once the queue has room for another job and a CapMonster endpoint is healthy to serve it
+    """
+    await queue.wait_for_space()
+    if endpoints:
+        await endpoints.wait_available()
+
+
+async def enqueue_pending(queue: FairScheduler, collection: AsyncIOMotorCollection, document: dict,
+                          warm_pool: WarmPool = None, endpoints: EndpointPool = None):
+    """
+    Claims a pending job for this node and hands it to the captcha_workers, once the queue has room for it.
+    The claim only succeeds if the job is still pending, so a job seen by both the stream and a reconcile query
+    (or by another server.py instance) is queued once.
+    Jobs of an API key that already has its share buffered are left for fill_queue to pick up later.
+    """
+    if queue.is_saturated(document.get("key")):
+        queue.backlog = True
+        return
+    await wait_to_claim(queue, endpoints)
+    claimed = await claim_job(collection, query={"_id": document["_id"], **queue.claim_filter()})
+    if claimed:
+        await hand_off(queue, collection, claimed, warm_pool)
+
 
+async def fill_queue(queue: FairScheduler, collection: AsyncIOMotorCollection, warm_pool: WarmPool = None,
+                     endpoints: EndpointPool = None) -> int:
+    """
+    Claims the oldest pending jobs of unsaturated API keys one at a time, waiting for a free queue slot before each
+    claim. Returns once nothing claimable is pending. Jobs this node has no room for stay unclaimed for other
+    server.py instances
+    """
+    claimed_count = 0
+    while True:
+        await wait_to_claim(queue, endpoints)
+        claim_filter = queue.claim_filter()
+        claimed = await claim_job(collection, query=claim_filter)
+        if not claimed:
+            # Saturated keys may still have pending jobs, come back once they free up
+            queue.backlog = bool(claim_filter)
+            return claimed_count
+        await hand_off(queue, collection, claimed, warm_pool)
+        claimed_count += 1
+
+
+async def poll_listener(queue: FairScheduler, collection: AsyncIOMotorCollection, warm_pool: WarmPool = None,
+                        endpoints: EndpointPool = None):
+    """
+    Polls the DB every HIT_DB_SLEEP seconds for pending jobs. Used when change streams are unavailable
+    """
     while True:
         try:
-            for _ in range(garbage_collection_interval):
-                updates = []
-                query = {
-                    "captcha_id": {"$exists": False},
-                    "in_queue": {"$exists": False},
-                }
-                check = await collection.count_documents(query)
-                if not check:
-                    # logger.info("No job requests found, sleeping.")
-                    await asyncio.sleep(HIT_DB_SLEEP)
-                    continue
-                results = collection.find(query)
-                async for result in results:
-                    updates.append(UpdateOne({'_id': result["_id"]}, {'$set': {'in_queue': True}}))
-                    job = ReCaptchaInDb(**result)
-                    await queue.put(job)
-                in_queue = await collection.bulk_write(updates)
-                await asyncio.sleep(HIT_DB_SLEEP)
-
-            # Do garbage collection
-            if remove_garbage:
-                await purge_garbage(collection)
+            await fill_queue(queue, collection, warm_pool, endpoints)
+            await asyncio.sleep(HIT_DB_SLEEP)
+        except ServerSelectionTimeoutError as sste:
+            logger.error(sste)
+            await asyncio.sleep(HIT_DB_SLEEP * 2)
+        except (TimeoutError, Exception) as e:
+            logger.error(e)
+            await asyncio.sleep(HIT_DB_SLEEP)
+
 
+async def stream_listener(queue: FairScheduler, collection: AsyncIOMotorCollection,
+                          state_collection: AsyncIOMotorCollection, warm_pool: WarmPool = None,
+                          endpoints: EndpointPool = None):
+    """
+    Receives pending jobs from a MongoDB change stream the moment they are inserted
+    Raises ChangeStreamUnavailable if the deployment does not support change streams
+    """
+    intake = ChangeStreamIntake(collection, ResumeTokenStore(state_collection))
+
+    async def on_pending(document: dict):
+        await enqueue_pending(queue, collection, document, warm_pool, endpoints)
+        if queue.backlog and not queue.full():
+            await fill_queue(queue, collection, warm_pool, endpoints)
+
+    async def on_reconcile():
+        await fill_queue(queue, collection, warm_pool, endpoints)
+
+    async def on_idle():
+        if queue.backlog and not queue.full():
+            await fill_queue(queue, collection, warm_pool, endpoints)
+
+    while True:
+        try:
+            await intake.run(on_pending, on_reconcile, on_idle)
+        except ChangeStreamUnavailable:
+            raise
         except ServerSelectionTimeoutError as sste:
             logger.error(sste)
             await asyncio.sleep(HIT_DB_SLEEP * 2)
@@ -104,82 +193,180 @@ async def listener(queue: asyncio.Queue, remove_garbage: bool = True):
             await asyncio.sleep(HIT_DB_SLEEP)
 
 
-async def captcha_worker(queue: asyncio.Queue, worker_id: int):
+async def listener(queue: FairScheduler, connections: Connections, warm_pool: WarmPool = None,
+                   endpoints: EndpointPool = None):
+    """
+    Checks DB for new ReCaptcha jobs with status "pending" and adds them to the shared queue for captcha_worker to solve
+    """
+    # Check for new requests inside the MongoDB Collection. If found, add to queue.
+    # Claiming immediately sets status "claimed" to prevent network errors from delaying 'captcha_id'
+    collection = await connections.get_collection()
+
+    if INTAKE_MODE != "poll":
+        try:
+            state_collection = await connections.get_collection(INTAKE_STATE_COLLECTION)
+            await stream_listener(queue, collection, state_collection, warm_pool, endpoints)
+        except ChangeStreamUnavailable as csu:
+            if INTAKE_MODE == "stream":
+                raise
+            logger.warning(f"Change streams unavailable, falling back to polling every {HIT_DB_SLEEP}s: {csu}")
+    await poll_listener(queue, collection, warm_pool, endpoints)
+
+
+async def solve_attempt(captcha: CaptchaUpload, captcha_request: ReCaptchaInDb,
+                        limiter: AIMDLimiter) -> Optional[str]:
+    """
+    Makes one CapMonster attempt at a job
+    :return: None once the job is finished (solved, or failed for good), otherwise the error to retry it on
+    :raises LeaseLost: The job's lease was lost before its result could be written
+    """
+    started = time.monotonic()
+    try:
+        result = await captcha.solve_recaptcha(captcha_request)
+    except (TimeoutError, httpx.TimeoutException):
+        record_outcome(TIMEOUT_ERROR)
+        limiter.on_overload(TIMEOUT_ERROR)
+        return TIMEOUT_ERROR
+    except LeaseLost:
+        raise
+    except ReCaptchaError as rce:
+        record_outcome(rce.text)
+        if rce.text in OVERLOAD_ERRORS:
+            limiter.on_overload(rce.text)
+        return rce.text or rce.message
+    except Exception as e:
+        record_outcome("")
+        return str(e) or repr(e)
+
+    # Failed fast on an open proxy circuit, CapMonster was never asked
+    if not (isinstance(result, ReCaptchaErrorResponse) and result.error == PROXY_CIRCUIT_OPEN):
+        limiter.on_success(time.monotonic() - started)
+    # Critical errors come back as a finished ReCaptchaErrorResponse
+    if isinstance(result, ReCaptchaErrorResponse):
+        record_outcome(result.error)
+        JOBS_FINISHED.labels(JobStatusEnum.failed.value).inc()
+    else:
+        record_outcome("OK")
+        JOBS_FINISHED.labels(JobStatusEnum.solved.value).inc()
+    return None
+
+
+async def captcha_worker(queue: FairScheduler, worker_id: int, captcha: CaptchaUpload, limiter: AIMDLimiter,
+                         retries: RetryScheduler):
     """
     Captcha workers get jobs from the queue and submit them to CapMonster via captcha_solver.py CaptchaUpload class
+    All workers share one CaptchaUpload, and with it the process-wide Mongo and HTTP connection pools
+    A worker only takes a job once the adaptive limiter grants it a slot, so at most limiter.limit jobs are in flight
+    Each take is a single attempt. Failed attempts wait out their backoff in the RetryScheduler, not in the worker
     """
+    collection = captcha.collection
     while True:
-        captcha_request = await queue.get()
-        success_flag = False
-        attempts: int = int(os.getenv("SOLVE_ATTEMPTS")) or 3
+        await limiter.acquire()
+        key, captcha_request = await queue.get()
+        job_id = ObjectId(captcha_request.id)
         try:
             logger.info(f"Captcha Worker #{worker_id} received task from queue")
-            db = MongoDB()
-            collection = await db.get_collection()
-            captcha = CaptchaUpload(collection, log=logging.getLogger(__name__))
-
-            # Solve captcha
-            possible_error_msg = ""
-            for _ in range(attempts):
-                try:
-                    result = await captcha.solve_recaptcha(captcha_request)
-                    success_flag = True
-                    break
-                except TimeoutError:
-                    possible_error_msg = "TimeoutError"
-                    continue
-                except ReCaptchaError as rce:
-                    if rce.text:
-                        possible_error_msg = rce.text
-                    if "ERROR_RECAPTCHA_TIMEOUT" in rce.text:
-                        await asyncio.sleep(random.randint(5, 10))
-                        continue
-                    elif "banned" in rce.text.lower() or "error" in rce.text.lower():
-                        await asyncio.sleep(10)
-                        continue
-                    else:
-                        logger.error(rce)
-                        # # Unhandled Errors, could exit immediately
-                        # break
-                except Exception as e:
-                    possible_error_msg = str(e)
-
-            if not success_flag:
-                try:
-                    u = await collection.update_one({"_id": ObjectId(captcha_request.id)},
-                                                    {"$set":
-                                                         {"error": str(possible_error_msg),
-                                                          "in_queue": False,
-                                                          "finished_on": datetime.datetime.now(tz=timezone.utc)}
-                                                     })
-                except Exception as e:
-                    logger.error(f"MongoDB Exception thrown updating error message: {e}")
-                    raise e
-            queue.task_done()
+            if retries.exhausted(captcha_request):
+                # Claimed again after attempts that never reported back, e.g. a node dying on it
+                await retries.dead_letter(captcha_request, "Solve attempts exhausted")
+                continue
+
+            error = None
+            # Keep the lease alive while CapMonster works, other nodes would otherwise reap the job
+            # Entering also counts the attempt on the job document
+            async with LeaseKeeper(collection, job_id, count_attempt=True) as lease:
+                if not lease.lost:
+                    captcha_request.attempts = (captcha_request.attempts or 0) + 1
+                    try:
+                        error = await solve_attempt(captcha, captcha_request, limiter)
+                    except LeaseLost:
+                        # Noticed by a job write before the next renewal
+                        lease.lost = True
+
+            if lease.lost:
+                # The job was reaped and belongs to the pending pool (or another node) now
+                logger.warning(f"Worker #{worker_id} dropped job {captcha_request.id} after losing its lease")
+                JOBS_FINISHED.labels("lease_lost").inc()
+            elif error is None:
+                await release_lease(collection, job_id)
+            elif retries.exhausted(captcha_request):
+                await retries.dead_letter(captcha_request, error)
+            else:
+                # An open proxy circuit fails the next attempt at once, no point waiting for it
+                delay = 0 if captcha.proxies.is_open(captcha_request.proxy) else None
+                await retries.retry(captcha_request, key, error, delay)
             logger.info(f"{worker_id} finished task.")
         except Exception as e:
             logger.error(e)
-            # Place unhandled Exceptions (failed jobs) back into queue indefinitely
-            # (Bad idea to do this without a retry limit)
-            logger.info("Placing request back in queue")
-            await queue.put(captcha_request)
+            # Unhandled errors (e.g. MongoDB) back off and count against the attempts like any other failure
+            try:
+                await retries.retry(captcha_request, key, repr(e))
+            except Exception as retry_error:
+                logger.error(f"Could not schedule a retry of job {captcha_request.id}, its lease will expire: "
+                             f"{retry_error}")
+        finally:
+            queue.done(key)
+            limiter.release()
 
 
-async def run_indefinitely():
+async def run_indefinitely(connections: Connections = None):
     """
     Function to create captcha worker tasks that continuously wait for recaptcha jobs, solve, and update
+    :param connections: Shared pools to use instead of the defaults from .env, e.g. for the benchmark
     """
-    queue = asyncio.Queue()
+    # MongoDB command latencies for the metrics endpoint
+    connections = connections or Connections(mongo=MongoDB(event_listeners=[MongoCommandMetrics()]))
+    async with connections:
+        collection = await connections.get_collection()
+        # Bounded and fair: the listener only claims what this node can start on soon, shared across API keys
+        keys_collection = await connections.get_collection(MDB_COLLECTION_KEYS)
+        queue = FairScheduler(KeyPolicies(keys_collection))
+        poller = ResultPoller(connections.http)
+        # CapMonster instances from CAPMONSTER_ENDPOINTS, probed in the background
+        endpoints = EndpointPool(client=connections.http)
+        # Jobs behind a repeatedly failing proxy are failed before they take a solver slot
+        proxies = ProxyHealthTracker()
+        captcha = CaptchaUpload(collection, log=logging.getLogger(__name__), client=connections.http, poller=poller,
+                                endpoints=endpoints, proxies=proxies)
+        # SERVER_WORKERS is the upper bound, the limiter decides how many of them may hold a job at once
+        limiter = AIMDLimiter(max_limit=SERVER_WORKERS)
+        # Opt-in, does nothing unless WARM_POOL_PAIRS is set. Its solves share the workers' limiter
+        warm_pool = WarmPool(captcha, limiter=limiter)
+        # Failed attempts wait here for their backoff, then go back on the queue
+        retries = RetryScheduler(queue, collection)
 
-    listen_producer = [asyncio.create_task(listener(queue))]
-    workers = [asyncio.create_task(captcha_worker(queue, _))
-               for _ in range(SERVER_WORKERS)]
-    logger.info(f"{SERVER_WORKERS} workers started")
+        # Gauges are read at scrape time
+        QUEUE_DEPTH.set_function(queue.qsize)
+        IN_FLIGHT.set_function(lambda: queue.in_flight)
+        CONCURRENCY_LIMIT.set_function(lambda: limiter.limit)
+        POLLER_OUTSTANDING.set_function(lambda: poller.outstanding)
+        PROXY_CIRCUITS_OPEN.set_function(proxies.open_circuits)
+        RETRY_WAITING.set_function(lambda: len(retries))
+        for endpoint in endpoints.endpoints:
+            ENDPOINT_OUTSTANDING.labels(endpoint.name).set_function(lambda endpoint=endpoint: endpoint.outstanding)
+        start_metrics_server()
+        # Index builds and the created_on migration run in the background, jobs are picked up meanwhile
+        index_task = asyncio.create_task(ensure_indexes(collection, keys_collection, GARBAGE_TIMER))
+        listen_producer = [asyncio.create_task(listener(queue, connections, warm_pool=warm_pool,
+                                                        endpoints=endpoints)),
+                           asyncio.create_task(endpoints.run()),
+                           asyncio.create_task(retries.run()),
+                           asyncio.create_task(lease_reaper(collection)),
+                           asyncio.create_task(garbage_collector(collection)),
+                           asyncio.create_task(warm_pool.run())]
+        workers = [asyncio.create_task(captcha_worker(queue, _, captcha, limiter, retries))
+                   for _ in range(SERVER_WORKERS)]
+        logger.info(f"{SERVER_WORKERS} workers started on node {NODE_ID}, concurrency limit {limiter.snapshot()}")
 
-    await asyncio.gather(*listen_producer)
-    await queue.join()
-    for w in workers:
-        w.cancel()
+        try:
+            await asyncio.gather(*listen_producer)
+            await queue.join()
+        finally:
+            for task in listen_producer + workers + [index_task]:
+                task.cancel()
+            await asyncio.gather(*listen_producer, *workers, index_task, return_exceptions=True)
+            await poller.close()
 
 
-asyncio.run(run_indefinitely())
+if __name__ == "__main__":
+    asyncio.run(run_indefinitely())
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from dotenv import load_dotenv, find_dotenv
+
+from captcha_solver import CaptchaUpload, ReCaptchaError
+from concurrency import AIMDLimiter, OVERLOAD_ERRORS
+from retry import TIMEOUT_ERROR
+from capmonster.fastapi.app.schema.recaptcha import ReCaptcha
+
+"""
+    Opt-in pool of pre-solved reCAPTCHA tokens for hot (googlekey, pageurl) pairs
+
+    Tokens are solved in the background, evicted before Google's ~120s validity runs out, and handed out once each
+    when a matching job is claimed. A job only matches a pair with the same proxy (or both without one), since sites
+    may bind a token to the IP it was solved from. The number of tokens kept per pair follows the observed arrival
+    rate for that pair, so a pair nobody is requesting right now costs no solves. Background solves take a slot of the
+    workers' AIMD limiter and report to it, so they count against CapMonster's capacity like any other solve.
+"""
+
+# Load env
+load_dotenv(find_dotenv())
+# JSON list of hot pairs, e.g. [["6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-", "https://www.google.com/recaptcha/api2/demo"]]
+# An optional third element is a proxy used for the background solves, only jobs with that proxy get those tokens
+WARM_POOL_PAIRS: str = os.getenv("WARM_POOL_PAIRS", "")
+# Max tokens kept per pair
+WARM_POOL_MAX: int = int(os.getenv("WARM_POOL_MAX", 5))
+# Seconds a token is handed out for after it was solved. reCAPTCHA tokens expire after 120s
+WARM_TOKEN_TTL: int = int(os.getenv("WARM_TOKEN_TTL", 100))
+# Seconds of arrivals used to estimate the request rate per pair
+WARM_RATE_WINDOW: int = int(os.getenv("WARM_RATE_WINDOW", 300))
+# Max background solves at once, across all pairs
+WARM_POOL_CONCURRENCY: int = int(os.getenv("WARM_POOL_CONCURRENCY", 2))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def pair_key(googlekey: str, pageurl: str, proxy: Optional[str] = None) -> Tuple[str, str, Optional[str]]:
+    return str(googlekey), str(pageurl).rstrip("/"), proxy or None
+
+
+def parse_pairs(raw: str = WARM_POOL_PAIRS) -> List[ReCaptcha]:
+    """
+    Parses WARM_POOL_PAIRS into the recaptchas to pre-solve
+    """
+    if not raw:
+        return []
+    pairs = []
+    for entry in json.loads(raw):
+        googlekey, pageurl = entry[0], entry[1]
+        proxy = entry[2] if len(entry) > 2 else None
+        pairs.append(ReCaptcha(googlekey=googlekey, pageurl=pageurl, proxy=proxy))
+    return pairs
+
+
+class _HotPair:
+    __slots__ = ("recaptcha", "tokens", "arrivals", "refilling", "solve_time")
+
+    def __init__(self, recaptcha: ReCaptcha, solve_time: float):
+        self.recaptcha = recaptcha
+        # (token, solved at) oldest first
+        self.tokens: Deque[Tuple[str, float]] = deque()
+        self.arrivals: Deque[float] = deque()
+        self.refilling = 0
+        # Smoothed background solve time, the lead time a refill needs
+        self.solve_time = solve_time
+
+
+class WarmPool:
+    """
+    Keeps pre-solved tokens for the configured hot pairs. Call run() as a task, take() per claimed job
+    """
+
+    def __init__(self, captcha: CaptchaUpload, pairs: List[ReCaptcha] = None, max_size: int = WARM_POOL_MAX,
+                 ttl: float = WARM_TOKEN_TTL, window: float = WARM_RATE_WINDOW,
+                 concurrency: int = WARM_POOL_CONCURRENCY, tick: float = 1, limiter: AIMDLimiter = None):
+        self.captcha = captcha
+        # The workers' limiter, background solves wait for a slot like jobs do
+        self.limiter = limiter
+        self.max_size = max_size
+        self.ttl = ttl
+        self.window = window
+        self.tick = tick
+        self.concurrency = max(1, concurrency)
+        self._pairs: Dict[Tuple[str, str, Optional[str]], _HotPair] = {
+            pair_key(recaptcha.googlekey, recaptcha.pageurl, recaptcha.proxy): _HotPair(recaptcha,
+                                                                                        captcha.first_waittime)
+            for recaptcha in (parse_pairs() if pairs is None else pairs)
+        }
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._pairs)
+
+    def rate(self, pair: _HotPair, now: float) -> float:
+        """
+        Arrivals per second over the last window
+        """
+        while pair.arrivals and pair.arrivals[0] < now - self.window:
+            pair.arrivals.popleft()
+        return len(pair.arrivals) / self.window
+
+    def target(self, pair: _HotPair, now: float) -> int:
+        """
+        Tokens to keep for a pair: enough to cover arrivals during one refill, but no more than can be used before
+        they expire
+        """
+        rate = self.rate(pair, now)
+        needed = math.ceil(rate * pair.solve_time * 1.2)
+        usable = math.floor(rate * self.ttl)
+        return max(0, min(needed, usable, self.max_size))
+
+    def take(self, googlekey: str, pageurl: str, proxy: Optional[str] = None) -> Optional[str]:
+        """
+        Records an arrival and returns a fresh pre-solved token for the pair, if one is available. Single use
+        :param proxy: The job's proxy, tokens are only handed to jobs with the proxy they were solved through
+        """
+        pair = self._pairs.get(pair_key(googlekey, pageurl, proxy))
+        if not pair:
+            return None
+        now = time.monotonic()
+        pair.arrivals.append(now)
+        self._evict(pair, now)
+        if not pair.tokens:
+            self.misses += 1
+            return None
+        self.hits += 1
+        token, _ = pair.tokens.popleft()
+        return token
+
+    def _evict(self, pair: _HotPair, now: float):
+        while pair.tokens and now - pair.tokens[0][1] >= self.ttl:
+            pair.tokens.popleft()
+            self.expired += 1
+
+    async def run(self):
+        """
+        Refills every pair up to its target forever
+        """
+        if not self.enabled:
+            return
+        logger.info(f"Warm pool enabled for {len(self._pairs)} sitekey/pageurl pairs")
+        try:
+            while True:
+                now = time.monotonic()
+                for pair in self._pairs.values():
+                    self._evict(pair, now)
+                    missing = self.target(pair, now) - len(pair.tokens) - pair.refilling
+                    while missing > 0 and len(self._tasks) < self.concurrency:
+                        pair.refilling += 1
+                        task = asyncio.create_task(self._refill(pair))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+                        missing -= 1
+                await asyncio.sleep(self.tick)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    async def _refill(self, pair: _HotPair):
+        if self.limiter:
+            await self.limiter.acquire()
+        started = time.monotonic()
+        try:
+            token = await self.captcha.solve_token(pair.recaptcha)
+            solved = time.monotonic()
+            pair.solve_time += 0.2 * ((solved - started) - pair.solve_time)
+            pair.tokens.append((token, solved))
+            if self.limiter:
+                self.limiter.on_success(solved - started)
+        except (ReCaptchaError, TimeoutError) as e:
+            logger.error(f"Warm pool solve failed for {pair.recaptcha.googlekey}: {e}")
+            error = TIMEOUT_ERROR if isinstance(e, TimeoutError) else e.text
+            if self.limiter and (error == TIMEOUT_ERROR or error in OVERLOAD_ERRORS):
+                self.limiter.on_overload(error)
+            # Do not hammer CapMonster with a failing pair
+            await asyncio.sleep(self.tick * 10)
+        except Exception as e:
+            logger.error(f"Warm pool solve failed for {pair.recaptcha.googlekey}: {e!r}")
+            await asyncio.sleep(self.tick * 10)
+        finally:
+            pair.refilling -= 1
+            if self.limiter:
+                self.limiter.release()
@@ -0,0 +1,38 @@
+"""
+Unit tests, no MongoDB or CapMonster needed
+
+    pip install -r tests/requirements.txt
+    python -m pytest tests
+
+/local/ modules import each other by file name and capmonster.* from the repo root, as when server.py is run, and
+the FastAPI app imports app.* from /fastapi/, so all three directories are put on sys.path. Coroutines are run with
+asyncio.run, no pytest plugin needed.
+"""
+import os
+import sys
+from pathlib import Path
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+for path in (ROOT, ROOT / "capmonster" / "local", ROOT / "capmonster" / "fastapi"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+# Settings app.core.config needs without a .env
+os.environ.setdefault("REGISTRATION_ENABLED", "false")
+os.environ.setdefault("MDB_DATABASE", "capmonster")
+os.environ.setdefault("MDB_COLLECTION", "recaptcha")
+
+
+@pytest.fixture
+def make_job():
+    """
+    Factory of ReCaptchaInDb jobs as listener() claims them
+    """
+    from bson import ObjectId
+    from capmonster.fastapi.app.schema.recaptcha import ReCaptchaInDb
+
+    def make(attempts: int = 1) -> ReCaptchaInDb:
+        return ReCaptchaInDb(_id=str(ObjectId()), pageurl="https://www.google.com/recaptcha/api2/demo",
+                             googlekey="6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-", attempts=attempts)
+    return make
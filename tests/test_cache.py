@@ -0,0 +1,75 @@
+from capmonster.fastapi.app.core import cache
+from capmonster.fastapi.app.core.cache import MISSING, TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_get_missing():
+    assert TTLCache().get("job") is MISSING
+
+
+def test_entry_expires_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    jobs = TTLCache(ttl=30)
+    jobs.set("job", {"status": "pending"})
+    clock.now += 29
+    assert jobs.get("job") == {"status": "pending"}
+    clock.now += 1
+    assert jobs.get("job") is MISSING
+    # Dropped on the read that found it expired
+    assert len(jobs) == 0
+
+
+def test_per_entry_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    jobs = TTLCache(ttl=30)
+    jobs.set("solved", "OK|token", ttl=600)
+    jobs.set("pending", "CAPCHA_NOT_READY", ttl=1)
+    clock.now += 60
+    assert jobs.get("solved") == "OK|token"
+    assert jobs.get("pending") is MISSING
+
+
+def test_negative_entry():
+    jobs = TTLCache()
+    jobs.set("unknown", None)
+    assert jobs.get("unknown") is None
+
+
+def test_non_positive_ttl_is_not_cached():
+    jobs = TTLCache(ttl=0)
+    assert not jobs.enabled
+    jobs.set("job", 1)
+    assert jobs.get("job") is MISSING
+    jobs = TTLCache(ttl=30)
+    jobs.set("job", 1, ttl=0)
+    assert jobs.get("job") is MISSING
+
+
+def test_least_recently_used_is_evicted():
+    jobs = TTLCache(maxsize=2)
+    jobs.set("a", 1)
+    jobs.set("b", 2)
+    # Reading a makes b the least recently used
+    jobs.get("a")
+    jobs.set("c", 3)
+    assert len(jobs) == 2
+    assert jobs.get("b") is MISSING
+    assert jobs.get("a") == 1
+    assert jobs.get("c") == 3
+
+
+def test_invalidate():
+    jobs = TTLCache()
+    jobs.set("a", 1)
+    jobs.invalidate("a")
+    jobs.invalidate("never cached")
+    assert jobs.get("a") is MISSING
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from bson import ObjectId
+
+from captcha_solver import CaptchaUpload
+from leases import LeaseLost
+from capmonster.fastapi.app.schema.recaptcha import ReCaptchaResponse
+
+
+class LeasedJobs:
+    """
+    Jobs collection holding one job leased by owner
+    """
+
+    def __init__(self, owner: str):
+        self.owner = owner
+        self.updates = []
+
+    async def update_one(self, query: dict, update: dict):
+        self.updates.append((query, update))
+        return SimpleNamespace(matched_count=int(query.get("lease_owner") == self.owner))
+
+
+@pytest.fixture
+def captcha_upload(monkeypatch):
+    monkeypatch.setenv("CLIENT_RETRY_SLEEP", "5")
+
+    def make(owner: str) -> CaptchaUpload:
+        return CaptchaUpload(LeasedJobs(owner), key="key", waittime=1, node_id="node-1")
+    return make
+
+
+def submitted_job() -> ReCaptchaResponse:
+    return ReCaptchaResponse(captcha_id=123, status="submitted", pageurl="https://www.google.com/recaptcha/api2/demo",
+                             googlekey="6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-")
+
+
+def test_solution_is_written_under_the_lease(captcha_upload):
+    captcha = captcha_upload("node-1")
+    job_id = str(ObjectId())
+    solved = asyncio.run(captcha.save_solution(job_id, submitted_job(), "token"))
+    assert solved.solution == "token"
+    query, update = captcha.collection.updates[0]
+    assert query == {"_id": ObjectId(job_id), "lease_owner": "node-1"}
+    assert update["$set"]["status"] == "solved"
+
+
+def test_solution_of_a_reaped_job_is_a_lost_lease(captcha_upload):
+    # Reaped and claimed by another node while this one was solving
+    captcha = captcha_upload("node-2")
+    with pytest.raises(LeaseLost):
+        asyncio.run(captcha.save_solution(str(ObjectId()), submitted_job(), "token"))
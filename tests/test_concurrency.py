@@ -0,0 +1,89 @@
+import asyncio
+
+from concurrency import AIMDLimiter
+
+
+def test_acquire_up_to_limit():
+    async def run():
+        limiter = AIMDLimiter(max_limit=10, initial=2)
+        await limiter.acquire()
+        await limiter.acquire()
+        assert limiter.available == 0
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        # The released slot is handed straight to the waiter
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        return limiter.in_flight
+
+    assert asyncio.run(run()) == 2
+
+
+def test_additive_increase():
+    limiter = AIMDLimiter(max_limit=10, initial=3)
+    for _ in range(3):
+        limiter.on_success(1.0)
+    # +1/limit per solve, about one slot per limit-many solves
+    assert int(limiter.limit) == 3
+    limiter.on_success(1.0)
+    assert int(limiter.limit) == 4
+
+
+def test_increase_stops_at_max_limit():
+    limiter = AIMDLimiter(max_limit=4, initial=4)
+    for _ in range(20):
+        limiter.on_success(1.0)
+    assert limiter.limit == 4
+
+
+def test_multiplicative_decrease():
+    limiter = AIMDLimiter(max_limit=10, initial=10, backoff=0.5, cooldown=0)
+    limiter.on_overload("ERROR_NO_SLOT_AVAILABLE")
+    assert int(limiter.limit) == 5
+    limiter.on_overload("ERROR_NO_SLOT_AVAILABLE")
+    assert int(limiter.limit) == 2
+
+
+def test_decrease_stops_at_min_limit():
+    limiter = AIMDLimiter(max_limit=10, min_limit=2, initial=10, backoff=0.1, cooldown=0)
+    for _ in range(5):
+        limiter.on_overload("TimeoutError")
+    assert limiter.limit == 2
+
+
+def test_one_decrease_per_cooldown():
+    limiter = AIMDLimiter(max_limit=10, initial=8, backoff=0.5, cooldown=3600)
+    # As if the last decrease was long ago, whatever time.monotonic() starts at
+    limiter._last_decrease = -3600.0
+    limiter.on_overload("ERROR_NO_SLOT_AVAILABLE")
+    limiter.on_overload("ERROR_NO_SLOT_AVAILABLE")
+    assert int(limiter.limit) == 4
+
+
+def test_latency_spike_is_overload():
+    limiter = AIMDLimiter(max_limit=10, initial=8, backoff=0.5, cooldown=0)
+    limiter.on_success(1.0)
+    assert limiter.baseline == 1.0
+    # Smoothed latency 2.8s > 1.5 x baseline
+    limiter.on_success(10.0)
+    assert int(limiter.limit) == 4
+
+
+def test_decrease_does_not_revoke_slots():
+    async def run():
+        limiter = AIMDLimiter(max_limit=10, initial=4, backoff=0.5, cooldown=0)
+        for _ in range(4):
+            await limiter.acquire()
+        limiter.on_overload("ERROR_NO_SLOT_AVAILABLE")
+        waiting = asyncio.create_task(limiter.acquire())
+        limiter.release()
+        limiter.release()
+        await asyncio.sleep(0)
+        # 2 still in flight at the new limit of 2
+        assert not waiting.done()
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        return limiter.in_flight
+
+    assert asyncio.run(run()) == 2
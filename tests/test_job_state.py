@@ -0,0 +1,40 @@
+import pytest
+
+from capmonster.fastapi.app.db.job_state import infer_status, result_2captcha, transition
+from capmonster.fastapi.app.schema.common import JobStatusEnum
+
+
+@pytest.mark.parametrize("document, status", [
+    ({"status": "expired", "solution": "token"}, JobStatusEnum.expired),
+    # Written before the status field existed
+    ({"solution": "token", "error": "ERROR_CAPTCHA_UNSOLVABLE"}, JobStatusEnum.solved),
+    ({"error": "ERROR_CAPTCHA_UNSOLVABLE", "captcha_id": 1}, JobStatusEnum.failed),
+    ({"captcha_id": 1, "in_queue": True}, JobStatusEnum.submitted),
+    ({"in_queue": True}, JobStatusEnum.claimed),
+    ({"in_queue": False}, JobStatusEnum.pending),
+    ({}, JobStatusEnum.pending),
+])
+def test_infer_status(document, status):
+    assert infer_status(document) == status
+
+
+@pytest.mark.parametrize("document, result", [
+    (None, ("ERROR_WRONG_CAPTCHA_ID", 404)),
+    ({"status": "solved", "solution": "token"}, ("OK|token", 200)),
+    ({"solution": "token"}, ("OK|token", 200)),
+    ({"status": "claimed", "in_queue": True}, ("CAPCHA_NOT_READY", 200)),
+    ({"status": "submitted", "captcha_id": 1}, ("CAPCHA_NOT_READY", 200)),
+    ({"status": "failed", "error": "ERROR_PROXY_BANNED"}, ("ERROR_PROXY_BANNED", 400)),
+    ({"status": "dead", "error": "TimeoutError"}, ("TimeoutError", 400)),
+    ({"status": "expired"}, ("ERROR_CAPTCHA_UNSOLVABLE", 408)),
+    ({"status": "pending"}, ("CAPCHA_NOT_READY", 425)),
+])
+def test_result_2captcha(document, result):
+    assert result_2captcha(document) == result
+
+
+def test_transition_timestamps():
+    assert transition(JobStatusEnum.pending) == {"status": "pending"}
+    assert set(transition(JobStatusEnum.submitted)) == {"status", "submitted_on"}
+    for status in (JobStatusEnum.solved, JobStatusEnum.failed, JobStatusEnum.expired, JobStatusEnum.dead):
+        assert set(transition(status)) == {"status", "finished_on"}
@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from bson import ObjectId
+
+from app.core import pingback
+from app.core.pingback import PingbackDispatcher
+from app.schema.common import JobStatusEnum, PingbackStatusEnum
+
+
+class RecordingClient:
+    """
+    httpx.AsyncClient stand-in that answers every POST with 200
+    """
+
+    def __init__(self):
+        self.posted = []
+
+    async def post(self, url: str, data: dict = None):
+        self.posted.append(url)
+        return SimpleNamespace(is_success=True, status_code=200)
+
+
+@pytest.fixture
+def recorded(monkeypatch):
+    records = []
+
+    async def record_pingback(conn, job_id, status, error=None, retry_in=None):
+        records.append((status, error, retry_in))
+
+    monkeypatch.setattr(pingback, "record_pingback", record_pingback)
+    return records
+
+
+def deliver(url: str, **kwargs) -> RecordingClient:
+    client = RecordingClient()
+    job = {"_id": ObjectId(), "pingback": url, "status": JobStatusEnum.solved.value, "solution": "token",
+           "pingback_attempts": 1}
+    asyncio.run(PingbackDispatcher(**kwargs).deliver(client, None, job))
+    return client
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/callback",
+    "http://localhost:8000/callback",
+    "http://10.0.0.5/callback",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]/callback",
+    "http://0.0.0.0/callback",
+])
+def test_non_public_hosts_are_not_called(recorded, url):
+    client = deliver(url, attempts=5)
+
+    assert client.posted == []
+    [(status, error, retry_in)] = recorded
+    # Fails at once, a retry would resolve to the same address
+    assert status == PingbackStatusEnum.failed
+    assert "non-public address" in error
+
+
+def test_public_hosts_are_called(recorded):
+    client = deliver("http://93.184.216.34/callback")
+
+    assert client.posted == ["http://93.184.216.34/callback"]
+    assert recorded == [(PingbackStatusEnum.delivered, None, None)]
+
+
+def test_allowed_hosts_skip_the_check(recorded):
+    client = deliver("http://127.0.0.1:8000/callback", allowed_hosts=["127.0.0.1"])
+
+    assert client.posted == ["http://127.0.0.1:8000/callback"]
+    assert recorded == [(PingbackStatusEnum.delivered, None, None)]
@@ -0,0 +1,86 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Callable, List, Tuple
+import pytest
+
+from poller import ResultPoller
+
+RES_URL = "http://127.0.0.1:8090/res.php"
+
+
+class ResClient:
+    """
+    httpx.AsyncClient stand-in answering res.php polls with answer(params)
+    """
+
+    def __init__(self, answer: Callable[[dict], str]):
+        self.answer = answer
+        self.requests: List[dict] = []
+
+    async def get(self, url: str, params: dict = None, timeout: float = None):
+        self.requests.append(params)
+        return SimpleNamespace(text=self.answer(params))
+
+
+def wait_all(client: ResClient, cap_ids: List[str], **kwargs) -> Tuple[List[str], ResultPoller]:
+    """
+    Waits on every cap_id at once
+    :return: (answers in cap_ids order, the poller)
+    """
+    async def run():
+        poller = ResultPoller(client, key="key", interval=0, **kwargs)
+        try:
+            answers = await asyncio.wait_for(asyncio.gather(*(poller.wait(cap_id, RES_URL) for cap_id in cap_ids)), 1)
+            return answers, poller
+        finally:
+            await poller.close()
+
+    return asyncio.run(run())
+
+
+def polled(client: ResClient) -> List[str]:
+    return [params.get("ids", params.get("id")) for params in client.requests]
+
+
+def test_batch_answers_are_split_by_id():
+    client = ResClient(lambda params: "token1|ERROR_CAPTCHA_UNSOLVABLE|token3")
+    answers, _ = wait_all(client, ["1", "2", "3"])
+    assert answers == ["OK|token1", "ERROR_CAPTCHA_UNSOLVABLE", "OK|token3"]
+    assert client.requests == [{"key": "key", "action": "get", "ids": "1,2,3"}]
+
+
+def test_not_ready_ids_are_polled_again():
+    responses = iter(["CAPCHA_NOT_READY|token2", "OK|token1"])
+    client = ResClient(lambda params: next(responses))
+    answers, _ = wait_all(client, ["1", "2"])
+    assert answers == ["OK|token1", "OK|token2"]
+    # Only the id still outstanding the second time, with the single-id query
+    assert polled(client) == ["1,2", "1"]
+
+
+def test_batches_of_batch_size():
+    client = ResClient(lambda params: f"OK|token{params['id']}" if "id" in params else
+                       "|".join(f"token{cap_id}" for cap_id in params["ids"].split(",")))
+    answers, _ = wait_all(client, ["1", "2", "3"], batch_size=2)
+    assert answers == ["OK|token1", "OK|token2", "OK|token3"]
+    assert polled(client) == ["1,2", "3"]
+
+
+def test_single_id_fallback():
+    def answer(params: dict) -> str:
+        # An endpoint that ignores ids= and answers for one captcha
+        if "ids" in params:
+            return "OK|token"
+        return f"OK|token{params['id']}"
+
+    client = ResClient(answer)
+    answers, poller = wait_all(client, ["1", "2"])
+    assert answers == ["OK|token1", "OK|token2"]
+    assert polled(client) == ["1,2", "1", "2"]
+    assert poller.batch_supported == {RES_URL: False}
+
+
+def test_timeout():
+    client = ResClient(lambda params: "CAPCHA_NOT_READY")
+    with pytest.raises(TimeoutError):
+        wait_all(client, ["1"], max_wait=0)
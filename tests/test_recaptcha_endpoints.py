@@ -0,0 +1,181 @@
+import asyncio
+import time
+from types import SimpleNamespace
+import pytest
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
+from app.api.api_v1.endpoints import recaptcha as endpoints
+from app.core.config import settings
+from app.core.notifier import job_notifier
+from app.crud import recaptcha as crud_recaptcha
+from app.schema.common import JobStatusEnum
+from app.schema.recaptcha import ReCaptchaCreate, ReCaptchaInDb
+
+GOOGLEKEY = "6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-"
+PAGEURL = "https://www.google.com/recaptcha/api2/demo"
+
+
+class Credits:
+    """
+    API keys collection stand-in, credits by key, spent and refunded the way crud.api_key does
+    """
+
+    def __init__(self):
+        self.balances = {}
+        self.refunds = []
+
+    async def get_api_key(self, conn, apikey: str = None):
+        return SimpleNamespace(key=apikey) if apikey in self.balances else None
+
+    async def consume_credit(self, conn, apikey: str) -> bool:
+        return await self.consume_credits(conn, apikey, 1) == 1
+
+    async def consume_credits(self, conn, apikey: str, count: int) -> int:
+        spent = min(count, self.balances[apikey])
+        self.balances[apikey] -= spent
+        return spent
+
+    async def refund_credit(self, conn, apikey: str, amount: int = 1):
+        self.balances[apikey] += amount
+        self.refunds.append((apikey, amount))
+
+
+@pytest.fixture
+def credits(monkeypatch):
+    credits = Credits()
+    for name in ("get_api_key", "consume_credit", "consume_credits", "refund_credit"):
+        monkeypatch.setattr(endpoints, name, getattr(credits, name))
+    return credits
+
+
+def recaptcha(key: str = "key-a") -> ReCaptchaCreate:
+    return ReCaptchaCreate(api_key=key, googlekey=GOOGLEKEY, pageurl=PAGEURL)
+
+
+async def created(conn, job: ReCaptchaCreate) -> ReCaptchaInDb:
+    return ReCaptchaInDb(_id=str(ObjectId()), **job.dict())
+
+
+async def insert_failed(conn, job: ReCaptchaCreate):
+    raise AutoReconnect("connection closed")
+
+
+def test_submit_spends_one_credit(monkeypatch, credits):
+    credits.balances["key-a"] = 2
+    monkeypatch.setattr(endpoints, "create_recaptcha", created)
+
+    job = asyncio.run(endpoints.submit_recaptcha(recaptcha(), db=None))
+
+    assert job.googlekey == GOOGLEKEY
+    assert credits.balances["key-a"] == 1
+
+
+def test_submit_without_credits_creates_no_job(monkeypatch, credits):
+    credits.balances["key-a"] = 0
+    monkeypatch.setattr(endpoints, "create_recaptcha", insert_failed)
+
+    response = asyncio.run(endpoints.submit_recaptcha(recaptcha(), db=None))
+
+    assert (response.status_code, response.body) == (401, b"ERROR_ZERO_BALANCE")
+    assert credits.refunds == []
+
+
+def test_failed_insert_refunds_the_credit(monkeypatch, credits):
+    credits.balances["key-a"] = 1
+    monkeypatch.setattr(endpoints, "create_recaptcha", insert_failed)
+
+    with pytest.raises(AutoReconnect):
+        asyncio.run(endpoints.submit_recaptcha(recaptcha(), db=None))
+
+    assert credits.balances["key-a"] == 1
+    assert credits.refunds == [("key-a", 1)]
+
+
+def test_batch_refunds_only_the_jobs_that_were_not_inserted(monkeypatch, credits):
+    credits.balances["key-a"] = 2
+    inserted = []
+
+    async def create_recaptchas(conn, jobs):
+        inserted.extend(jobs)
+        # The second accepted job hit a write error
+        return [ReCaptchaInDb(_id=str(ObjectId()), **job.dict()) for job in jobs], {1}
+
+    monkeypatch.setattr(endpoints, "create_recaptchas", create_recaptchas)
+
+    jobs = [recaptcha("key-a"), recaptcha("key-a"), recaptcha("key-a"), recaptcha("unknown")]
+    response = asyncio.run(endpoints.submit_recaptcha_batch(jobs, db=None))
+
+    assert response.submitted == 1
+    assert response.results[0].id and not response.results[0].error
+    assert [result.error for result in response.results] == [
+        None, "ERROR_INTERNAL_SERVER_ERROR", "ERROR_ZERO_BALANCE", "ERROR_WRONG_USER_KEY"]
+    # Only the covered jobs were inserted, and the failed one got its credit back
+    assert len(inserted) == 2
+    assert credits.refunds == [("key-a", 1)]
+    assert credits.balances["key-a"] == 1
+
+
+def test_batch_insert_error_keeps_the_credits(monkeypatch, credits):
+    credits.balances["key-a"] = 2
+
+    async def create_recaptchas(conn, jobs):
+        raise AutoReconnect("connection closed")
+
+    monkeypatch.setattr(endpoints, "create_recaptchas", create_recaptchas)
+
+    with pytest.raises(AutoReconnect):
+        asyncio.run(endpoints.submit_recaptcha_batch([recaptcha(), recaptcha()], db=None))
+
+    # Some of the jobs may have been written, so nothing is refunded
+    assert credits.refunds == []
+    assert credits.balances["key-a"] == 0
+
+
+@pytest.fixture
+def job_reads(monkeypatch):
+    """
+    Status reads of one job, answered from the list of documents in order, the last one repeats
+    """
+    documents = []
+    reads = []
+
+    async def get_job(conn, job_id, view=None):
+        reads.append(job_id)
+        return documents[min(len(reads), len(documents)) - 1]
+
+    monkeypatch.setattr(crud_recaptcha, "get_job", get_job)
+    return SimpleNamespace(documents=documents, reads=reads)
+
+
+def wait_2captcha(job_id: ObjectId, wait: float):
+    return endpoints.get_recaptcha_job_2captcha(key=settings.ROOT_API_KEY, job_id=str(job_id), action="get",
+                                                wait=wait, db=None)
+
+
+def test_wait_answers_not_ready_at_the_deadline(job_reads):
+    job_reads.documents.append({"_id": ObjectId(), "status": JobStatusEnum.submitted.value})
+
+    started = time.monotonic()
+    response = asyncio.run(wait_2captcha(job_reads.documents[0]["_id"], 0.05))
+
+    assert (response.status_code, response.body) == (200, b"CAPCHA_NOT_READY")
+    assert time.monotonic() - started >= 0.05
+    # Once before waiting and once at the deadline
+    assert len(job_reads.reads) == 2
+
+
+def test_wait_answers_once_the_job_finishes(job_reads):
+    job_id = ObjectId()
+    job_reads.documents.extend([{"_id": job_id, "status": JobStatusEnum.submitted.value},
+                                {"_id": job_id, "status": JobStatusEnum.solved.value, "solution": "token"}])
+
+    async def solve_while_waiting():
+        asyncio.get_running_loop().call_later(0.01, job_notifier.notify, job_id, JobStatusEnum.solved.value)
+        return await wait_2captcha(job_id, 30)
+
+    started = time.monotonic()
+    response = asyncio.run(solve_while_waiting())
+
+    assert (response.status_code, response.body) == (200, b"OK|token")
+    assert time.monotonic() - started < 1
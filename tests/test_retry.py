@@ -0,0 +1,101 @@
+import asyncio
+import random
+from types import SimpleNamespace
+import pytest
+
+from retry import RetryScheduler
+
+
+class RecordingQueue:
+    """
+    FairScheduler stand-in that records the jobs put back
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    async def put(self, job, key=None):
+        self.jobs.append((key, job))
+
+
+class JobsCollection:
+    """
+    Jobs collection whose updates match as long as the node still holds the lease
+    """
+
+    def __init__(self, leased: bool = True):
+        self.leased = leased
+        self.updates = []
+
+    async def update_one(self, query: dict, update: dict):
+        self.updates.append((query, update))
+        return SimpleNamespace(matched_count=int(self.leased))
+
+
+def retry_scheduler(collection: JobsCollection = None, **kwargs) -> RetryScheduler:
+    return RetryScheduler(RecordingQueue(), collection or JobsCollection(), node_id="node-1", **kwargs)
+
+
+@pytest.mark.parametrize("attempt, delay", [(1, 5), (2, 10), (3, 20), (5, 80), (6, 120), (30, 120)])
+def test_backoff_doubles_up_to_max_delay(monkeypatch, attempt, delay):
+    retries = retry_scheduler(base_delay=5, max_delay=120)
+    monkeypatch.setattr(random, "uniform", lambda low, high: low)
+    assert retries.backoff(attempt) == delay / 2
+    monkeypatch.setattr(random, "uniform", lambda low, high: high)
+    assert retries.backoff(attempt) == delay
+
+
+def test_backoff_jitter_spreads_retries():
+    retries = retry_scheduler(base_delay=5, max_delay=120)
+    delays = [retries.backoff(3) for _ in range(100)]
+    assert all(10 <= delay <= 20 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_exhausted(make_job):
+    retries = retry_scheduler(attempts=3)
+    assert not retries.exhausted(make_job(attempts=2))
+    assert retries.exhausted(make_job(attempts=3))
+
+
+def test_jobs_are_requeued_by_due_time(make_job):
+    async def run():
+        retries = retry_scheduler()
+        runner = asyncio.create_task(retries.run())
+        # Pushed out of order, the earliest due time is pushed last and wakes the runner early
+        for key, delay in (("c", 0.15), ("b", 0.1), ("a", 0.05)):
+            assert await retries.retry(make_job(), key, "ERROR_CAPTCHA_UNSOLVABLE", delay=delay)
+        assert len(retries) == 3
+        for _ in range(100):
+            if len(retries.queue.jobs) == 3:
+                break
+            await asyncio.sleep(0.01)
+        runner.cancel()
+        return [key for key, _ in retries.queue.jobs]
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+
+
+def test_retry_records_the_attempt(make_job):
+    async def run():
+        collection = JobsCollection()
+        retries = retry_scheduler(collection)
+        await retries.retry(make_job(attempts=2), "a", "ERROR_PROXY_BANNED", delay=60)
+        return collection.updates
+
+    updates = asyncio.run(run())
+    assert len(updates) == 1
+    query, update = updates[0]
+    assert query["lease_owner"] == "node-1"
+    assert update["$set"]["status"] == "claimed"
+    assert update["$push"] == {"errors": "ERROR_PROXY_BANNED"}
+    assert update["$unset"] == {"captcha_id": ""}
+
+
+def test_lost_lease_is_not_retried(make_job):
+    async def run():
+        retries = retry_scheduler(JobsCollection(leased=False))
+        retried = await retries.retry(make_job(), "a", "ERROR_CAPTCHA_UNSOLVABLE", delay=0)
+        return retried, len(retries)
+
+    assert asyncio.run(run()) == (False, 0)
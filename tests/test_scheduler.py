@@ -0,0 +1,143 @@
+import asyncio
+from typing import Dict, Optional
+import pytest
+
+from scheduler import FairScheduler, TenantPolicy
+
+
+class StaticPolicies:
+    """
+    KeyPolicies without the keys collection
+    """
+
+    def __init__(self, policies: Dict[Optional[str], TenantPolicy] = None):
+        self.policies = policies or {}
+
+    async def get(self, key: Optional[str]) -> TenantPolicy:
+        return self.policies.get(key, TenantPolicy())
+
+
+def fair_scheduler(maxsize: int = 100, key_prefetch: int = 100, **policies: TenantPolicy) -> FairScheduler:
+    return FairScheduler(StaticPolicies(policies), maxsize=maxsize, key_prefetch=key_prefetch)
+
+
+async def fill(scheduler: FairScheduler, key: str, jobs: int):
+    for i in range(jobs):
+        await scheduler.put(f"{key}{i}", key)
+
+
+async def take(scheduler: FairScheduler, jobs: int):
+    return [(await scheduler.get())[0] for _ in range(jobs)]
+
+
+def test_round_robin_across_keys():
+    async def run():
+        scheduler = fair_scheduler()
+        await fill(scheduler, "a", 3)
+        await fill(scheduler, "b", 3)
+        return await take(scheduler, 6)
+
+    assert asyncio.run(run()) == ["a", "b", "a", "b", "a", "b"]
+
+
+def test_jobs_of_a_key_keep_their_order():
+    async def run():
+        scheduler = fair_scheduler()
+        await fill(scheduler, "a", 3)
+        return [(await scheduler.get())[1] for _ in range(3)]
+
+    assert asyncio.run(run()) == ["a0", "a1", "a2"]
+
+
+def test_weight_is_jobs_per_turn():
+    async def run():
+        scheduler = fair_scheduler(a=TenantPolicy(weight=2))
+        await fill(scheduler, "a", 6)
+        await fill(scheduler, "b", 6)
+        return await take(scheduler, 9)
+
+    assert asyncio.run(run()) == ["a", "a", "b", "a", "a", "b", "a", "a", "b"]
+
+
+def test_deficit_is_dropped_when_a_key_runs_dry():
+    async def run():
+        scheduler = fair_scheduler(a=TenantPolicy(weight=3))
+        await fill(scheduler, "a", 1)
+        await fill(scheduler, "b", 2)
+        first = await take(scheduler, 3)
+        # a's unused credit from its last turn does not carry over to new jobs
+        await fill(scheduler, "a", 3)
+        await fill(scheduler, "b", 1)
+        return first, await take(scheduler, 4)
+
+    assert asyncio.run(run()) == (["a", "b", "b"], ["a", "a", "a", "b"])
+
+
+def test_higher_priority_first():
+    async def run():
+        scheduler = fair_scheduler(urgent=TenantPolicy(priority=1))
+        await fill(scheduler, "bulk", 2)
+        await fill(scheduler, "urgent", 2)
+        return await take(scheduler, 4)
+
+    assert asyncio.run(run()) == ["urgent", "urgent", "bulk", "bulk"]
+
+
+def test_max_inflight():
+    async def run():
+        scheduler = fair_scheduler(a=TenantPolicy(max_inflight=1))
+        await fill(scheduler, "a", 2)
+        await fill(scheduler, "b", 1)
+        taken = await take(scheduler, 2)
+        # a0 and b0 in flight, a1 waits for a0
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.get(), 0.05)
+        scheduler.done("a")
+        taken.append((await asyncio.wait_for(scheduler.get(), 1))[0])
+        return taken
+
+    assert asyncio.run(run()) == ["a", "b", "a"]
+
+
+def test_claim_filter_skips_saturated_keys():
+    async def run():
+        scheduler = fair_scheduler(key_prefetch=1, b=TenantPolicy(max_inflight=1))
+        assert scheduler.claim_filter() == {}
+        await fill(scheduler, "a", 1)
+        await fill(scheduler, "b", 1)
+        await fill(scheduler, "c", 1)
+        await take(scheduler, 3)
+        # Nothing buffered, but b is at its in-flight cap
+        assert scheduler.claim_filter() == {"key": {"$nin": ["b"]}}
+        await fill(scheduler, "a", 1)
+        return scheduler.claim_filter()
+
+    assert asyncio.run(run()) == {"key": {"$nin": ["a", "b"]}}
+
+
+def test_put_past_maxsize_never_blocks():
+    async def run():
+        scheduler = fair_scheduler(maxsize=2)
+        await fill(scheduler, "a", 3)
+        assert scheduler.full()
+        assert scheduler.free_slots == 0
+        await take(scheduler, 2)
+        await asyncio.wait_for(scheduler.wait_for_space(), 1)
+        return scheduler.qsize()
+
+    assert asyncio.run(run()) == 1
+
+
+def test_join_waits_for_done():
+    async def run():
+        scheduler = fair_scheduler()
+        await fill(scheduler, "a", 1)
+        key, _ = await scheduler.get()
+        join = asyncio.create_task(scheduler.join())
+        await asyncio.sleep(0)
+        assert not join.done()
+        scheduler.done(key)
+        await asyncio.wait_for(join, 1)
+        return scheduler.in_flight
+
+    assert asyncio.run(run()) == 0
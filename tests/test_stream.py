@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+from datetime import timezone
+import orjson
+from bson import ObjectId
+
+from app.core.stream import JobEventHub
+
+
+class IdleChangeStream:
+    """
+    Change stream that never sees a change
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.Event().wait()
+
+
+class IdleDatabase:
+    """
+    Client, database and jobs collection in one, for conn[MDB_DATABASE][MDB_COLLECTION].watch()
+    """
+
+    def __getitem__(self, name: str):
+        return self
+
+    def watch(self, pipeline, **kwargs):
+        return IdleChangeStream()
+
+
+def solved_job(key: str) -> dict:
+    return {"_id": ObjectId(), "key": key, "status": "solved", "solution": "token",
+            "pageurl": "https://www.google.com/recaptcha/api2/demo",
+            "googlekey": "6Le-wvkSAAAAAPBMRTvw0Q4Muexq9bi0DJwx_mJ-",
+            "created_on": datetime.datetime(2021, 9, 1, 12, tzinfo=timezone.utc), "lease_owner": "server-1"}
+
+
+def test_event_has_the_job_id():
+    job = solved_job("key")
+
+    async def run():
+        hub = JobEventHub()
+        subscriber = hub.subscribe(IdleDatabase(), "key")
+        try:
+            hub.publish(job)
+            return await subscriber.get(1)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    event = orjson.loads(asyncio.run(run()))
+    assert event["id"] == str(job["_id"])
+    assert event["status"] == "solved"
+    assert event["solution"] == "token"
+    assert event["created_on"] == "2021-09-01T12:00:00Z"
+    assert "lease_owner" not in event
+
+
+def test_events_only_go_to_the_job_key():
+    async def run():
+        hub = JobEventHub()
+        subscriber = hub.subscribe(IdleDatabase(), "key")
+        try:
+            hub.publish(solved_job("other key"))
+            return await subscriber.get(0.05)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    assert asyncio.run(run()) is None